@@ -0,0 +1,178 @@
+"""
+Minimal benchmark runner with stored baselines and regression thresholds.
+
+Every benchmark returns a cost where lower is better: seconds per operation, seconds per
+connection or bytes per client. A result regresses when it exceeds its baseline by more
+than the benchmark threshold. Baselines record the host they were measured on, and are
+only compared on the same host (timings) or the same runtime (memory).
+"""
+import contextlib
+import gc
+import json
+import os
+import platform
+import time
+
+BENCHMARKS = []
+
+# baseline key of the host description, benchmark names never start with an underscore
+HOST_KEY = "_host"
+
+# host fields memory costs depend on, timings depend on all of them
+RUNTIME_FIELDS = ("implementation", "python", "machine")
+
+
+class Benchmark(object):
+    def __init__(self, name, fn, unit, threshold, group, budget=None):
+        self.name = name
+        self.fn = fn
+        self.unit = unit
+        self.threshold = threshold
+        self.group = group
+        self.budget = budget
+
+
+def benchmark(unit="s/op", threshold=0.25, group="micro", budget=None):
+    """
+    Register a benchmark function. The function receives a quick flag and returns its cost
+    :param str unit: Unit of the cost. Default ('s/op')
+    :param float threshold: Allowed relative increase over the baseline. Default (0.25)
+    :param str group: Benchmark group, e.g. 'micro', 'hub' or 'memory'. Default ('micro')
+    :param float budget: Absolute cost limit, independent of the machine baseline. Default (None)
+    """
+
+    def register(fn):
+        BENCHMARKS.append(Benchmark(fn.__name__, fn, unit, threshold, group, budget))
+        return fn
+
+    return register
+
+
+def per_op(fn, number, repeat=7):
+    """
+    Time fn(number) and return the best time per operation over repeats.
+    The garbage collector is disabled while timing, as in timeit.
+    :rtype: float
+    """
+    best = None
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn(number)
+            elapsed = (time.perf_counter() - start) / number
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return best
+
+
+@contextlib.contextmanager
+def quiet():
+    # library debug prints go to /dev/null, their cost is still measured
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def _cpu_model():
+    # platform.processor() is empty on most Linux distributions
+    try:
+        with open("/proc/cpuinfo") as fh:
+            for line in fh:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def host_info():
+    """
+    Describe the machine and interpreter running the benchmarks
+    :rtype: dict
+    """
+    return {
+        "implementation": platform.python_implementation(),
+        "python": platform.python_version(),
+        "system": platform.system(),
+        "machine": platform.machine(),
+        "cpu": _cpu_model(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def format_host(host):
+    if not host:
+        return "an unknown host"
+    return "{} {} on {} {}, {} x {}".format(
+        host["implementation"],
+        host["python"],
+        host["system"],
+        host["machine"],
+        host["cpu_count"],
+        host["cpu"] or "unknown CPU",
+    )
+
+
+def comparable(benchmark, baseline, host):
+    """
+    Whether a baseline measured on another host can be compared with this host results
+    :rtype: bool
+    """
+    recorded = baseline.get(HOST_KEY)
+    if not recorded:
+        return False
+    if benchmark.unit == "bytes":
+        return all(recorded.get(field) == host[field] for field in RUNTIME_FIELDS)
+    return recorded == host
+
+
+def load_baseline(path):
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(path, results, host):
+    baseline = load_baseline(path)
+    if baseline.get(HOST_KEY) != host:
+        # results of another host are not kept next to this one
+        baseline = {}
+    baseline.update({name: value for name, value in results.items()})
+    baseline[HOST_KEY] = host
+    with open(path, "w") as fh:
+        json.dump(baseline, fh, indent=2, sort_keys=True)
+        fh.write("\n")
+
+
+def compare(benchmark, value, baseline, threshold=None):
+    """
+    Compare a result with its baseline
+    :returns: Relative change and regression flag. None change when there is no baseline
+    :rtype: tuple
+    """
+    if threshold is None:
+        threshold = benchmark.threshold
+    reference = baseline.get(benchmark.name)
+    if not reference:
+        return None, False
+    change = value / reference - 1
+    return change, change > threshold
+
+
+def over_budget(benchmark, value):
+    return benchmark.budget is not None and value > benchmark.budget
+
+
+def format_value(value, unit):
+    if unit == "bytes":
+        return "{:10.0f} B   ".format(value)
+    if value < 1e-3:
+        return "{:10.2f} us  ".format(value * 1e6)
+    if value < 1:
+        return "{:10.2f} ms  ".format(value * 1e3)
+    return "{:10.2f} s   ".format(value)
@@ -0,0 +1,57 @@
+"""
+Measure the time to import the iotc modules in a fresh interpreter.
+
+    python benchmarks/import_time.py [--runs 20]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+SNIPPET = """
+import sys, time, json
+sys.path.insert(0, {src!r})
+start = time.perf_counter()
+import {module}
+print(json.dumps({{"seconds": time.perf_counter() - start, "sdk_loaded": "azure.iot.device" in sys.modules}}))
+"""
+
+
+def measure(module, runs):
+    samples = []
+    sdk_loaded = False
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, "-c", SNIPPET.format(src=SRC, module=module)]
+        )
+        result = json.loads(output)
+        samples.append(result["seconds"])
+        sdk_loaded = sdk_loaded or result["sdk_loaded"]
+    return {
+        "module": module,
+        "runs": runs,
+        "median_ms": statistics.median(samples) * 1000,
+        "min_ms": min(samples) * 1000,
+        "sdk_loaded": sdk_loaded,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+    for module in ("iotc", "iotc.aio"):
+        result = measure(module, args.runs)
+        print(
+            "{module:<10} median {median_ms:7.1f} ms  min {min_ms:7.1f} ms  sdk loaded: {sdk_loaded}".format(
+                **result
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Run the client benchmarks and compare them with the stored baselines.
+
+    python benchmarks/run.py [--quick] [-k send] [--group micro] [--rounds 3] [--save] [--threshold 0.25]
+
+Exits with status 1 when a benchmark regresses over its threshold or exceeds its budget. Each
+benchmark keeps its best result over rounds, and regressions are run again to be confirmed
+before failing. Timings are only compared with a baseline recorded on the same host, memory
+costs with one recorded on the same Python version and architecture.
+"""
+import argparse
+import os
+import platform
+import sys
+
+import harness
+import suite
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-k", dest="pattern", help="Run benchmarks containing this text")
+    parser.add_argument("--group", action="append", help="Run benchmarks of a group: micro, memory or hub")
+    parser.add_argument("--quick", action="store_true", help="Fewer iterations, for smoke runs")
+    parser.add_argument("--rounds", type=int, default=3, help="Run each benchmark this many times and keep the best result")
+    parser.add_argument("--confirm", type=int, default=2, help="Extra runs of a regressed benchmark before failing")
+    parser.add_argument("--baseline", default=BASELINE, help="Baseline file")
+    parser.add_argument("--save", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--threshold", type=float, help="Override the allowed relative increase of all benchmarks")
+    args = parser.parse_args()
+
+    baseline = harness.load_baseline(args.baseline)
+    host = harness.host_info()
+    results = {}
+    regressions = []
+    over_budget = []
+    print("Python {} on {}".format(platform.python_version(), platform.platform()))
+    if baseline and baseline.get(harness.HOST_KEY) != host:
+        print(
+            "WARNING: baseline recorded with {}, running with {}. Results not comparable "
+            "on this host are reported without comparison, run with --save to record a "
+            "local baseline.".format(
+                harness.format_host(baseline.get(harness.HOST_KEY)), harness.format_host(host)
+            )
+        )
+    try:
+        for benchmark in harness.BENCHMARKS:
+            if args.pattern and args.pattern not in benchmark.name:
+                continue
+            if args.group and benchmark.group not in args.group:
+                continue
+            try:
+                value = min(benchmark.fn(args.quick) for _ in range(args.rounds))
+            except suite.SkipBenchmark as e:
+                print("{:<32} skipped: {}".format(benchmark.name, e))
+                continue
+            reference = baseline if harness.comparable(benchmark, baseline, host) else {}
+            change, regressed = harness.compare(
+                benchmark, value, reference, args.threshold
+            )
+            for _ in range(args.confirm if regressed else 0):
+                value = min(value, benchmark.fn(args.quick))
+                change, regressed = harness.compare(
+                    benchmark, value, reference, args.threshold
+                )
+                if not regressed:
+                    break
+            results[benchmark.name] = value
+            line = "{:<32}{}".format(benchmark.name, harness.format_value(value, benchmark.unit))
+            if change is not None:
+                line += "{:+7.1%}".format(change)
+            if regressed:
+                line += "  REGRESSION (threshold {:.0%})".format(
+                    benchmark.threshold if args.threshold is None else args.threshold
+                )
+                regressions.append(benchmark.name)
+            if harness.over_budget(benchmark, value):
+                line += "  OVER BUDGET ({})".format(
+                    harness.format_value(benchmark.budget, benchmark.unit).strip()
+                )
+                over_budget.append(benchmark.name)
+            print(line)
+    finally:
+        suite.stop_local_hub()
+
+    if args.save:
+        harness.save_baseline(args.baseline, results, host)
+        print("Baseline saved to {}".format(args.baseline))
+    if over_budget:
+        # budgets do not depend on the machine, saving a baseline does not lift them
+        print("{} over budget: {}".format(len(over_budget), ", ".join(over_budget)))
+        return 1
+    if regressions and not args.save:
+        print("{} regression(s): {}".format(len(regressions), ", ".join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,436 @@
+"""
+Benchmarks of the client hot paths.
+
+Micro benchmarks replace the device SDK client with a no-op transport to measure the
+library overhead only. Hub benchmarks run the real device SDK against iotc.emulator.LocalHub.
+"""
+import asyncio
+import gc
+import json
+import os
+import shutil
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from iotc import IoTCClient, IOTCConnectType, IOTCEvents, IOTCLogLevel, ConsoleLogger
+from iotc import aio
+from iotc.models import Command, CredentialsCache, Property
+from iotc.emulator import LocalHub
+
+from harness import benchmark, per_op, quiet
+
+DEVICE_KEY = "ZGV2aWNlX2tleQ=="
+TELEMETRY = {"temperature": 21.5, "humidity": 40, "status": "ok", "location": {"lat": 47.6, "lon": -122.1}}
+PROPERTIES = {"priority": "high"}
+
+
+class SkipBenchmark(Exception):
+    pass
+
+
+class NullDeviceClient(object):
+    connected = True
+
+    def send_message(self, message):
+        pass
+
+    def patch_twin_reported_properties(self, patch):
+        pass
+
+    def send_method_response(self, response):
+        pass
+
+
+class AsyncNullDeviceClient(object):
+    connected = True
+
+    async def send_message(self, message):
+        pass
+
+    async def patch_twin_reported_properties(self, patch):
+        pass
+
+    async def send_method_response(self, response):
+        pass
+
+
+class MethodRequest(object):
+    def __init__(self, request_id, name, payload):
+        self.request_id = request_id
+        self.name = name
+        self.payload = payload
+
+
+def sync_client(device_id="device1"):
+    client = IoTCClient(
+        device_id,
+        "scope_id",
+        IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
+        DEVICE_KEY,
+        logger=ConsoleLogger(IOTCLogLevel.IOTC_LOGGING_DISABLED),
+    )
+    client._device_client = NullDeviceClient()
+    return client
+
+
+def async_client(device_id="device1"):
+    client = aio.IoTCClient(
+        device_id,
+        "scope_id",
+        IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
+        DEVICE_KEY,
+        logger=aio.ConsoleLogger(IOTCLogLevel.IOTC_LOGGING_DISABLED),
+    )
+    client._device_client = AsyncNullDeviceClient()
+    return client
+
+
+def synthetic_twin(size, components=10):
+    """
+    Twin with `size` desired properties split between the default component and components.
+    Half of them are reported with an outdated version.
+    """
+    desired = {"$version": 10}
+    reported = {"$version": 5}
+    per_component = size // 2 // components
+    for index in range(size - per_component * components):
+        name = "prop{}".format(index)
+        desired[name] = index
+        if index % 2:
+            reported[name] = {"value": index, "av": 5, "ac": 200}
+    for component in range(components):
+        name = "component{}".format(component)
+        desired[name] = {"__t": "c"}
+        reported[name] = {"__t": "c"}
+        for index in range(per_component):
+            desired[name]["prop{}".format(index)] = {"value": index}
+            if index % 2:
+                reported[name]["prop{}".format(index)] = {"value": index, "av": 5}
+    return {"desired": desired, "reported": reported}
+
+
+def desired_patch(size):
+    patch = {"$version": 11}
+    for index in range(size):
+        patch["prop{}".format(index)] = index
+    patch["component"] = {"__t": "c", "prop": {"value": 1}}
+    return patch
+
+
+@benchmark()
+def send_telemetry_sync(quick):
+    client = sync_client()
+
+    def run(number):
+        for _ in range(number):
+            client.send_telemetry(TELEMETRY, PROPERTIES)
+
+    return per_op(run, 2000 if quick else 20000)
+
+
+@benchmark()
+def send_telemetry_aio(quick):
+    client = async_client()
+
+    async def send(number):
+        for _ in range(number):
+            await client.send_telemetry(TELEMETRY, PROPERTIES)
+
+    loop = asyncio.new_event_loop()
+    try:
+        return per_op(lambda number: loop.run_until_complete(send(number)), 2000 if quick else 20000)
+    finally:
+        loop.close()
+
+
+@benchmark()
+def prepare_message(quick):
+    client = sync_client()
+    payload = json.dumps(TELEMETRY)
+
+    def run(number):
+        for _ in range(number):
+            client._prepare_message(payload, PROPERTIES)
+
+    return per_op(run, 5000 if quick else 50000)
+
+
+@benchmark()
+def sync_twin_large(quick):
+    client = sync_client()
+    client._twin = synthetic_twin(2000)
+
+    def run(number):
+        with quiet():
+            for _ in range(number):
+                client._sync_twin()
+
+    return per_op(run, 5 if quick else 50)
+
+
+@benchmark()
+def update_properties_large(quick):
+    client = sync_client()
+    patch = desired_patch(1000)
+
+    def run(number):
+        for _ in range(number):
+            client._update_properties(patch, lambda prop: True)
+
+    return per_op(run, 5 if quick else 50)
+
+
+@benchmark()
+def update_properties_large_aio(quick):
+    client = async_client()
+    patch = desired_patch(1000)
+
+    async def on_property(prop):
+        return True
+
+    async def update(number):
+        for _ in range(number):
+            await client._update_properties(patch, on_property)
+
+    loop = asyncio.new_event_loop()
+    try:
+        return per_op(lambda number: loop.run_until_complete(update(number)), 5 if quick else 50)
+    finally:
+        loop.close()
+
+
+@benchmark()
+def command_dispatch(quick):
+    client = sync_client()
+    client.on(IOTCEvents.IOTC_COMMAND, lambda command: None)
+    requests = [
+        MethodRequest(str(index), "component*reboot" if index % 2 else "reboot", {"delay": index})
+        for index in range(100)
+    ]
+
+    def run(number):
+        for index in range(number):
+            client._on_commands(requests[index % 100])
+
+    return per_op(run, 2000 if quick else 20000)
+
+
+@benchmark()
+def command_dispatch_aio(quick):
+    client = async_client()
+
+    async def on_command(command):
+        pass
+
+    client.on(IOTCEvents.IOTC_COMMAND, on_command)
+    requests = [
+        MethodRequest(str(index), "component*reboot" if index % 2 else "reboot", {"delay": index})
+        for index in range(100)
+    ]
+
+    async def dispatch(number):
+        for index in range(number):
+            await client._on_commands(requests[index % 100])
+
+    loop = asyncio.new_event_loop()
+    try:
+        return per_op(lambda number: loop.run_until_complete(dispatch(number)), 2000 if quick else 20000)
+    finally:
+        loop.close()
+
+
+def _allocated_per_client(factory, sync, count):
+    # clients as after connecting: twin fetched and synchronized
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        clients = [factory("device{}".format(index)) for index in range(count)]
+        for client in clients:
+            client._twin = synthetic_twin(20, components=2)
+            sync(client)
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return (after - before) / count
+
+
+@benchmark(unit="bytes", threshold=0.1, group="memory", budget=4096)
+def memory_per_client(quick):
+    return _allocated_per_client(
+        sync_client, lambda client: client._sync_properties(), 100 if quick else 1000
+    )
+
+
+@benchmark(unit="bytes", threshold=0.1, group="memory", budget=4096)
+def memory_per_client_aio(quick):
+    loop = asyncio.new_event_loop()
+    try:
+        return _allocated_per_client(
+            async_client,
+            lambda client: loop.run_until_complete(client._sync_properties()),
+            100 if quick else 1000,
+        )
+    finally:
+        loop.close()
+
+
+def _allocated_per_object(factory, count):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        objects = [factory(index) for index in range(count)]
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del objects
+    return (after - before) / count
+
+
+@benchmark(unit="bytes", threshold=0.1, group="memory")
+def memory_per_property(quick):
+    # values are shared, only the model objects and the list slot are counted
+    value = {"value": 21}
+    return _allocated_per_object(
+        lambda index: Property("temperature", value, "thermostat"), 1000 if quick else 10000
+    )
+
+
+@benchmark(unit="bytes", threshold=0.1, group="memory")
+def memory_per_command(quick):
+    return _allocated_per_object(
+        lambda index: Command("reboot", "{}", "thermostat"), 1000 if quick else 10000
+    )
+
+
+@benchmark(unit="bytes", threshold=0.1, group="memory")
+def memory_per_credentials(quick):
+    return _allocated_per_object(
+        lambda index: CredentialsCache("hub.azure-devices.net", "device", DEVICE_KEY),
+        1000 if quick else 10000,
+    )
+
+
+_hub = None
+
+
+def local_hub():
+    global _hub
+    if _hub is None:
+        if shutil.which("openssl") is None:
+            raise SkipBenchmark("openssl not found")
+        _hub = LocalHub()
+        try:
+            _hub.start_background()
+        except OSError as e:
+            _hub = None
+            raise SkipBenchmark("local hub not available: {}".format(e))
+    return _hub
+
+
+def stop_local_hub():
+    global _hub
+    if _hub is not None:
+        _hub.stop_background()
+        _hub = None
+
+
+def hub_client(hub, device_id):
+    client = IoTCClient(
+        device_id,
+        "scope_id",
+        IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
+        DEVICE_KEY,
+        logger=ConsoleLogger(IOTCLogLevel.IOTC_LOGGING_DISABLED),
+    )
+    client.set_global_endpoint(hub.endpoint)
+    client.set_server_verification_cert(hub.ca_cert)
+    return client
+
+
+@benchmark(unit="s", threshold=0.5, group="hub")
+def connect_latency(quick):
+    hub = local_hub()
+    samples = []
+    for index in range(3 if quick else 10):
+        client = hub_client(hub, "connect{}".format(index))
+        start = time.perf_counter()
+        with quiet():
+            client.connect()
+        samples.append(time.perf_counter() - start)
+        client.disconnect()
+    return min(samples)
+
+
+@benchmark(unit="s", threshold=0.5, group="hub")
+def reconnect_latency(quick):
+    # reconnections reuse the cached hub credentials without provisioning
+    hub = local_hub()
+    client = hub_client(hub, "reconnect")
+    with quiet():
+        client.connect()
+    samples = []
+    for _ in range(3 if quick else 10):
+        client.disconnect()
+        start = time.perf_counter()
+        with quiet():
+            client.connect()
+        samples.append(time.perf_counter() - start)
+    client.disconnect()
+    return min(samples)
+
+
+@benchmark(threshold=0.5, group="hub")
+def hub_send_telemetry_sync(quick):
+    hub = local_hub()
+    client = hub_client(hub, "telemetry")
+    with quiet():
+        client.connect()
+    try:
+
+        def run(number):
+            for _ in range(number):
+                client.send_telemetry(TELEMETRY, PROPERTIES)
+
+        return per_op(run, 50 if quick else 500, repeat=3)
+    finally:
+        client.disconnect()
+
+
+@benchmark(threshold=0.5, group="hub")
+def hub_send_telemetry_aio(quick):
+    hub = local_hub()
+    client = aio.IoTCClient(
+        "telemetry_aio",
+        "scope_id",
+        IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
+        DEVICE_KEY,
+        logger=aio.ConsoleLogger(IOTCLogLevel.IOTC_LOGGING_DISABLED),
+    )
+    client.set_global_endpoint(hub.endpoint)
+    client.set_server_verification_cert(hub.ca_cert)
+    number = 50 if quick else 500
+
+    async def run():
+        with quiet():
+            await client.connect()
+        try:
+            best = None
+            for _ in range(3):
+                start = time.perf_counter()
+                # messages are sent concurrently, the SDK pipelines them on one connection
+                await asyncio.gather(
+                    *(client.send_telemetry(TELEMETRY, PROPERTIES) for _ in range(number))
+                )
+                elapsed = (time.perf_counter() - start) / number
+                best = elapsed if best is None else min(best, elapsed)
+            return best
+        finally:
+            await client.disconnect()
+
+    return asyncio.run(run())
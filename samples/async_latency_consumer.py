@@ -0,0 +1,100 @@
+from iotc.aio import IoTCClient
+from iotc import (
+    IOTCConnectType,
+    IOTCLogLevel,
+)
+from iotc.emulator import LocalHub
+from iotc.latency import LatencyTracker
+import os
+import asyncio
+import configparser
+import json
+import sys
+
+from random import randint
+
+config = configparser.ConfigParser()
+config.read(os.path.join(os.path.dirname(__file__), "samples.ini"))
+
+if config.has_option("DEFAULT", "Local") and config["DEFAULT"].getboolean("Local"):
+    sys.path.insert(0, "src")
+
+
+class EventHubLatencyConsumer:
+    """
+    Track the messages routed by IoT Central data export or the IoT Hub built-in endpoint to an Event Hub
+    """
+
+    def __init__(self, conn_str, eventhub_name, tracker):
+        from azure.eventhub.aio import EventHubConsumerClient
+
+        self._consumer = EventHubConsumerClient.from_connection_string(
+            conn_str, consumer_group="$Default", eventhub_name=eventhub_name)
+        self._tracker = tracker
+
+    async def _on_event(self, partition_context, event):
+        device_id = event.system_properties[b"iothub-connection-device-id"]
+        self._tracker.add(device_id, event.properties or {})
+
+    async def receive(self, duration):
+        async with self._consumer:
+            task = asyncio.ensure_future(self._consumer.receive(
+                on_event=self._on_event, starting_position="@latest"))
+            await asyncio.sleep(duration)
+            task.cancel()
+
+
+device_id = "latency-sample"
+scope_id = "local"
+key = "ZGV2aWNlX2tleQ=="
+
+# consume from an Event Hub with real devices, or from a local hub stand-in
+event_hub = config.has_option("EventHub", "ConsumerConnectionString")
+if event_hub:
+    device_id = config["DEVICE_M3"]["DeviceId"]
+    scope_id = config["DEVICE_M3"]["ScopeId"]
+    key = config["DEVICE_M3"]["DeviceKey"]
+
+
+async def main():
+    tracker = LatencyTracker()
+    hub = None
+    if not event_hub:
+        hub = LocalHub(latency=0.01)
+        hub.start_background()
+
+    client = IoTCClient(
+        device_id,
+        scope_id,
+        IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
+        key,
+    )
+    client.set_log_level(IOTCLogLevel.IOTC_LOGGING_DISABLED)
+    client.set_latency_stamping()
+    if hub is not None:
+        client.set_global_endpoint(hub.endpoint)
+        client.set_server_verification_cert(hub.ca_cert)
+    await client.connect()
+
+    consumer = None
+    if event_hub:
+        consumer = asyncio.ensure_future(EventHubLatencyConsumer(
+            config["EventHub"]["ConsumerConnectionString"],
+            config["EventHub"]["EventHubName"],
+            tracker,
+        ).receive(60))
+
+    for _ in range(50):
+        await client.send_telemetry({"temperature": randint(20, 45)})
+        await asyncio.sleep(0.1)
+    await client.disconnect()
+
+    if consumer is not None:
+        await consumer
+    else:
+        for message in hub.telemetry(device_id):
+            tracker.add_message(message)
+        hub.stop_background()
+    print(json.dumps(tracker.report(), indent=2))
+
+asyncio.run(main())
@@ -31,5 +31,9 @@ setuptools.setup(
       'Programming Language :: Python :: 3.9'
     ],
     include_package_data=True,
-    install_requires=["azure-iot-device"]
+    install_requires=["azure-iot-device"],
+    extras_require={"tracing": ["opentelemetry-api"]},
+    entry_points={
+        "console_scripts": ["iotc-loadgen=iotc.loadgen:main"],
+    },
 )
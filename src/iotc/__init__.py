@@ -1,58 +1,74 @@
-import sys
 import threading
 import signal
 import time
-import pkg_resources
-from azure.iot.device import X509
-from azure.iot.device import IoTHubDeviceClient
-from azure.iot.device import ProvisioningDeviceClient
-from azure.iot.device import Message, MethodResponse
-from datetime import datetime
-from .models import Command, CredentialsCache, Property, Storage, GracefulExit
-
-try:
-    __version__ = pkg_resources.get_distribution("iotc").version
-except:
-    pass
-
-if sys.version_info[0] < 3:
-    import urllib
-
-    quote = urllib.quote_plus
-else:
-    import urllib.parse
-
-    quote = urllib.parse.quote_plus
-
-try:
-    import hmac
-except ImportError:
-    print("ERROR: missing dependency `hmac`")
-    sys.exit()
-
-try:
-    import hashlib
-except ImportError:
-    print("ERROR: missing dependency `hashlib`")
-    sys.exit()
-
-try:
-    import base64
-except ImportError:
-    print("ERROR: missing dependency `base64`")
-    sys.exit()
-
-try:
-    import json
-except ImportError:
-    print("ERROR: missing dependency `json`")
-    sys.exit()
-
-try:
-    import uuid
-except ImportError:
-    print("ERROR: missing dependency `uuid`")
-    sys.exit()
+import importlib
+import json
+import uuid
+from urllib.parse import quote_plus as quote
+from .models import (
+    Command,
+    CredentialsCache,
+    EnqueuedCommandsCache,
+    LoopStall,
+    Property,
+    SlowHandler,
+    Storage,
+    AsyncStorage,
+    GracefulExit,
+    IoTCConnectionError,
+)
+from .backoff import ExponentialBackoff
+from .keys import derive_device_key
+from .metrics import MetricsRegistry
+from . import latency, tracing
+
+# the device SDK is imported on first use to keep `import iotc` fast
+_SDK_IMPORTS = {
+    "X509": ("azure.iot.device", "X509"),
+    "IoTHubDeviceClient": ("azure.iot.device", "IoTHubDeviceClient"),
+    "ProvisioningDeviceClient": ("azure.iot.device", "ProvisioningDeviceClient"),
+    "Message": ("azure.iot.device", "Message"),
+    "MethodResponse": ("azure.iot.device", "MethodResponse"),
+    "iot_exceptions": ("azure.iot.device.exceptions", None),
+}
+
+
+def _lazy_import(module_globals, imports, name):
+    # imported names are stored in the module globals, where tests can also patch them
+    try:
+        return module_globals[name]
+    except KeyError:
+        pass
+    module_name, attribute = imports[name]
+    value = importlib.import_module(module_name)
+    if attribute is not None:
+        value = getattr(value, attribute)
+    module_globals[name] = value
+    return value
+
+
+def _version(module_globals):
+    try:
+        from importlib import metadata
+    except ImportError:
+        raise AttributeError("__version__")
+    try:
+        module_globals["__version__"] = metadata.version("iotc")
+    except metadata.PackageNotFoundError:
+        raise AttributeError("__version__")
+    return module_globals["__version__"]
+
+
+def _sdk(name):
+    return _lazy_import(globals(), _SDK_IMPORTS, name)
+
+
+def __getattr__(name):
+    if name == "__version__":
+        return _version(globals())
+    if name in _SDK_IMPORTS:
+        return _sdk(name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 class IOTCConnectType:
@@ -87,6 +103,21 @@ class IOTCEvents:
     IOTC_COMMAND = (2,)
     IOTC_PROPERTIES = (4,)
     IOTC_ENQUEUED_COMMAND = 8
+    IOTC_CONNECTION_STATE = 16
+    IOTC_READY = 32
+    IOTC_SLOW_HANDLER = 64
+    IOTC_LOOP_STALL = 128
+
+
+_HANDLER_METRICS = {
+    IOTCEvents.IOTC_PROPERTIES: "iotc_property_handler_seconds",
+    IOTCEvents.IOTC_COMMAND: "iotc_command_handler_seconds",
+    IOTCEvents.IOTC_ENQUEUED_COMMAND: "iotc_enqueued_command_handler_seconds",
+}
+
+
+def _handler_name(callback):
+    return getattr(callback, "__qualname__", None) or repr(callback)
 
 
 class ConsoleLogger:
@@ -108,7 +139,41 @@ class ConsoleLogger:
         self._log_level = log_level
 
 
+# console loggers of the clients created without a logger, one per logger class and level
+_SHARED_LOGGERS = {}
+
+
+def _shared_logger(logger_class, log_level):
+    logger = _SHARED_LOGGERS.get((logger_class, log_level))
+    if logger is None:
+        logger = _SHARED_LOGGERS.setdefault(
+            (logger_class, log_level), logger_class(log_level)
+        )
+    return logger
+
+
+_DEFAULT_BACKOFF = ExponentialBackoff()
+
+
 class AbstractClient:
+    # configuration defaults are shared by all the clients. Setters store values per client
+    _model_id = None
+    _content_type = "application%2Fjson"
+    _content_encoding = "utf-8"
+    _global_endpoint = "global.azure-devices-provisioning.net"
+    _server_verification_cert = None
+    _enqueued_cache_size = 128
+    _backoff = _DEFAULT_BACKOFF
+    _credentials_ttl = None
+    _background_twin_sync = False
+    _twin_error = None
+    _handler_profiling = False
+    _slow_handler_threshold = 1.0
+    _blocking_handler_threshold = 0.1
+    _tracer = None
+    _stamp_stream = None
+    _stamp_sequence = None
+
     def __init__(
         self,
         device_id,
@@ -122,23 +187,32 @@ class AbstractClient:
         self._scope_id = scope_id
         self._cred_type = cred_type
         self._key_or_cert = key_or_cert
-        self._model_id = None
         self._events = {}
-        self._prop_thread = None
-        self._cmd_thread = None
-        self._enqueued_cmd_thread = None
-        self._content_type = "application%2Fjson"
-        self._content_encoding = "utf-8"
-        self._global_endpoint = "global.azure-devices-provisioning.net"
         self._storage = storage
         self._terminate = False
         self._connecting = False
         self._max_connection_attempts = max_connection_attempts
         self._connection_attempts_count = 0
+        self._enqueued_cache = None
+        self._connection_state = None
+        self._signals_registered = False
+        self._device_client = None
+        self._reconnects_count = 0
+        self._last_error = None
+        self._credentials = None
+        self._metrics = MetricsRegistry()
 
     def terminated(self):
         return self._terminate
 
+    def connection_state(self):
+        """
+        Get the last known connection state
+        :returns: Connection state or None if the device never connected
+        :rtype: IOTCConnectionState
+        """
+        return self._connection_state
+
     def is_connected(self):
         """
         Check if device is connected to IoTCentral
@@ -148,6 +222,14 @@ class AbstractClient:
         if self._device_client:
             return self._device_client.connected
 
+    def metrics(self):
+        """
+        Get the client metrics. Use MetricsRegistry.aggregate to combine the metrics of many clients
+        :returns: Metrics registry with counters and latency histograms
+        :rtype: MetricsRegistry
+        """
+        return self._metrics
+
     def set_global_endpoint(self, endpoint):
         """
         Set the device provisioning endpoint.
@@ -155,6 +237,18 @@ class AbstractClient:
         """
         self._global_endpoint = endpoint
 
+    def set_server_verification_cert(self, certificate):
+        """
+        Set a trusted root certificate for the provisioning and hub connections, e.g. to target a local hub.
+        :param str certificate: PEM certificate. Default (SDK trusted certificates)
+        """
+        self._server_verification_cert = certificate
+
+    def _sdk_options(self):
+        if self._server_verification_cert is None:
+            return {}
+        return {"server_verification_cert": self._server_verification_cert}
+
     def set_model_id(self, model_id):
         """
         Set the model Id for the device to be associated
@@ -167,7 +261,138 @@ class AbstractClient:
         Set the logging level
         :param IOTCLogLevel: Logging level. Available options are: ALL, API_ONLY, DISABLE
         """
-        self._logger.set_log_level(log_level)
+        if any(self._logger is logger for logger in _SHARED_LOGGERS.values()):
+            # other clients use the same default logger, switch to the one of the new level
+            self._logger = _shared_logger(type(self._logger), log_level)
+        else:
+            self._logger.set_log_level(log_level)
+
+    def set_credentials_ttl(self, ttl):
+        """
+        Set how long cached credentials are trusted before provisioning the device again
+        :param float ttl: Seconds since the last successful connection. None to never expire. Default (None)
+        """
+        self._credentials_ttl = ttl
+
+    def _is_valid_cache(self, credentials):
+        if credentials is None:
+            return False
+        if not isinstance(credentials, CredentialsCache):
+            # custom storage format. let the hub validate it
+            return True
+        if credentials.device_id is not None and credentials.device_id != self._device_id:
+            return False
+        return not credentials.is_expired(self._credentials_ttl)
+
+    def set_background_twin_sync(self, enabled):
+        """
+        Return from connect as soon as the device is connected and fetch the twin in background.
+        Use the IOTC_READY event or wait_until_ready to know when properties are synchronized.
+        Failed twin requests are retried with the backoff policy up to the maximum number of connection attempts.
+        :param bool enabled: Sync the twin in background. Default (False)
+        """
+        self._background_twin_sync = enabled
+
+    def set_handler_profiling(self, enabled=True, threshold=1.0, blocking_threshold=0.1):
+        """
+        Time the properties, commands and enqueued commands handlers.
+        Durations are recorded in the client metrics and slow calls raise the IOTC_SLOW_HANDLER event.
+        :param bool enabled: Time the handlers. Default (True)
+        :param float threshold: Seconds above which a handler call is slow. Default (1.0)
+        :param float blocking_threshold: Seconds above which an async handler blocks the event loop without yielding. Default (0.1)
+        """
+        self._handler_profiling = enabled
+        self._slow_handler_threshold = threshold
+        self._blocking_handler_threshold = blocking_threshold
+
+    def _profile_handler(self, event, callback, duration, blocking_duration=None):
+        self._metrics.observe(_HANDLER_METRICS[event], duration)
+        if duration <= self._slow_handler_threshold and (
+            blocking_duration is None
+            or blocking_duration <= self._blocking_handler_threshold
+        ):
+            return None
+        self._metrics.inc("iotc_slow_handlers_total")
+        return SlowHandler(event, _handler_name(callback), duration, blocking_duration)
+
+    def set_tracing(self, enabled=True, tracer=None):
+        """
+        Trace provisioning, connection, twin, telemetry, properties and commands with OpenTelemetry spans.
+        Telemetry messages carry the W3C traceparent of their span in custom properties.
+        Tracing stays disabled if opentelemetry is not installed and no tracer is given.
+        :param bool enabled: Create spans. Default (True)
+        :param tracer: OpenTelemetry tracer. Default (tracer from the global tracer provider)
+        """
+        self._tracer = tracing.get_tracer(tracer) if enabled else None
+
+    def _span(self, name, attributes=None):
+        if self._tracer is None:
+            return tracing.span(None, name)
+        span_attributes = {"iotc.device_id": self._device_id}
+        if attributes:
+            span_attributes.update(attributes)
+        return tracing.span(self._tracer, name, span_attributes)
+
+    def _inject_trace(self, msg, span):
+        parent = tracing.traceparent(span)
+        if parent is not None and tracing.TRACEPARENT not in msg.custom_properties:
+            msg.custom_properties[tracing.TRACEPARENT] = parent
+
+    def set_latency_stamping(self, enabled=True):
+        """
+        Stamp telemetry messages with a stream Id, a sequence number and their creation time in custom properties.
+        Consumers measure end-to-end latency and detect lost or duplicated messages with iotc.latency.LatencyTracker.
+        Sequence numbers start from 0 in a new stream each time stamping is enabled.
+        :param bool enabled: Stamp messages. Default (True)
+        """
+        if enabled:
+            self._stamp_stream, self._stamp_sequence = latency.new_stream()
+        else:
+            self._stamp_stream = self._stamp_sequence = None
+
+    def set_backoff_policy(self, backoff):
+        """
+        Set the delay policy between failed connection attempts
+        :param ExponentialBackoff backoff: Backoff policy. Default (1s initial delay, 60s cap, full jitter)
+        """
+        self._backoff = backoff
+
+    def _connection_state_from_error(self, error):
+        if isinstance(error, IoTCConnectionError):
+            return IOTCConnectionState.IOTC_CONNECTION_BAD_CREDENTIAL
+        iot_exceptions = _sdk("iot_exceptions")
+        if isinstance(error, iot_exceptions.CredentialError):
+            return IOTCConnectionState.IOTC_CONNECTION_BAD_CREDENTIAL
+        if isinstance(
+            error,
+            (
+                iot_exceptions.ConnectionFailedError,
+                iot_exceptions.NoConnectionError,
+                iot_exceptions.OperationTimeout,
+            ),
+        ):
+            return IOTCConnectionState.IOTC_CONNECTION_NO_NETWORK
+        return IOTCConnectionState.IOTC_CONNECTION_COMMUNICATION_ERROR
+
+    def set_enqueued_commands_cache_size(self, size):
+        """
+        Set how many enqueued command message ids are remembered to drop redeliveries.
+        :param int size: Number of message ids to keep. 0 disables duplicates detection. Default (128)
+        """
+        self._enqueued_cache_size = size
+        self._enqueued_cache = None
+
+    def _enqueued_storage(self):
+        return self._storage
+
+    def _is_duplicate_enqueued(self, message_id):
+        if message_id is None or not self._enqueued_cache_size:
+            return False
+        if self._enqueued_cache is None:
+            self._enqueued_cache = EnqueuedCommandsCache(
+                self._enqueued_cache_size, self._enqueued_storage()
+            )
+        return not self._enqueued_cache.add(message_id)
 
     def set_content_type(self, content_type):
         self._content_type = quote(content_type)
@@ -176,21 +401,38 @@ class AbstractClient:
         self._content_encoding = content_encoding
 
     def _prepare_message(self, payload, properties):
-        msg = Message(payload, uuid.uuid4(), self._content_encoding, self._content_type)
+        msg = _sdk("Message")(
+            payload, uuid.uuid4(), self._content_encoding, self._content_type
+        )
         if bool(properties):
             for prop in properties:
                 msg.custom_properties[prop] = properties[prop]
+        if self._stamp_sequence is not None:
+            latency.stamp(
+                msg.custom_properties, self._stamp_stream, next(self._stamp_sequence)
+            )
         return msg
 
     def on(self, eventname, callback):
         """
         Set a listener for a specific event
-        :param IOTCEvents eventname: Supported events: IOTC_PROPERTIES, IOTC_COMMANDS
+        :param IOTCEvents eventname: Supported events: IOTC_PROPERTIES, IOTC_COMMANDS, IOTC_ENQUEUED_COMMAND, IOTC_CONNECTION_STATE, IOTC_READY, IOTC_SLOW_HANDLER, IOTC_LOOP_STALL (async client)
         :param function callback: Function executed when the specified event occurs
         """
         self._events[eventname] = callback
         return 0
 
+    def _command_result_patch(self, command_name, value, component_name=None):
+        # long-running commands report their result as a property named after the command
+        if component_name is not None:
+            return {
+                "{}".format(component_name): {
+                    "__t": "c",
+                    "{}".format(command_name): {"value": value},
+                }
+            }
+        return {"{}".format(command_name): {"value": value}}
+
     def _sync_twin(self):
         try:
             desired = self._twin["desired"]
@@ -203,7 +445,6 @@ class AbstractClient:
             return
         patch = {}
         for desired_prop in desired:
-            print("Syncing property '{}'".format(desired_prop))
             if desired_prop == "$version":
                 continue
             # is a component
@@ -275,7 +516,7 @@ class IoTCClient(AbstractClient):
             max_connection_attempts,
         )
         if logger is None:
-            self._logger = ConsoleLogger(IOTCLogLevel.IOTC_LOGGING_API_ONLY)
+            self._logger = _shared_logger(ConsoleLogger, IOTCLogLevel.IOTC_LOGGING_API_ONLY)
         else:
             if (
                 hasattr(logger, "info")
@@ -284,11 +525,13 @@ class IoTCClient(AbstractClient):
             ):
                 self._logger = logger
             else:
-                print(
-                    "ERROR: Logger object has unsupported format. It must implement the following functions\n\
-                    info(message);\ndebug(message);\nset_log_level(message);"
+                raise ValueError(
+                    "Logger object has unsupported format. It must implement the following functions: "
+                    "info(message), debug(message), set_log_level(log_level)"
                 )
-                sys.exit()
+        self._ready = threading.Event()
+        # SDK handlers run on a thread pool, connection state changes can be handled concurrently
+        self._connecting_lock = threading.Lock()
 
     def _handle_property_ack(
         self,
@@ -300,10 +543,11 @@ class IoTCClient(AbstractClient):
     ):
         if callback is not None:
             prop = Property(property_name, property_value, component_name)
-            ret = callback(prop)
+            ret = self._call_handler(IOTCEvents.IOTC_PROPERTIES, callback, prop)
         else:
             ret = True
         if ret:
+            self._metrics.inc("iotc_property_acks_total")
             if component_name is not None:
                 self._logger.debug("Acknowledging {}".format(property_name))
                 self.send_property(
@@ -385,6 +629,7 @@ class IoTCClient(AbstractClient):
         except KeyError:
             self._logger.debug("Command callback not found")
             return
+        self._metrics.inc("iotc_commands_received_total")
         command = Command(method_request.name, method_request.payload)
         try:
             command_name_with_components = method_request.name.split("*")
@@ -400,18 +645,29 @@ class IoTCClient(AbstractClient):
         except:
             pass
 
-        def reply_fn():
+        def reply_fn(status=200, payload=None):
+            if payload is None:
+                payload = {"result": True, "data": "Command received"}
             self._device_client.send_method_response(
-                MethodResponse.create_from_method_request(
+                _sdk("MethodResponse").create_from_method_request(
                     method_request,
-                    200,
-                    {"result": True, "data": "Command received"},
+                    status,
+                    payload,
+                )
+            )
+
+        def complete_fn(value):
+            self.send_property(
+                self._command_result_patch(
+                    command.name, value, command.component_name
                 )
             )
 
         command.reply = reply_fn
+        command.complete = complete_fn
         self._logger.debug("Received command {}".format(method_request.name))
-        cmd_cb(command)
+        with self._span("iotc.command.handle", {"iotc.command.name": method_request.name}):
+            self._call_handler(IOTCEvents.IOTC_COMMAND, cmd_cb, command)
 
     def _on_enqueued_commands(self, c2d):
         self._logger.debug("Setup offline commands listener")
@@ -421,6 +677,13 @@ class IoTCClient(AbstractClient):
             self._logger.debug("Command callback not found")
             return
 
+        if self._is_duplicate_enqueued(c2d.message_id):
+            self._logger.debug(
+                "Dropping duplicate offline command {}".format(c2d.message_id)
+            )
+            return
+
+        self._metrics.inc("iotc_enqueued_commands_received_total")
         # Wait for unknown method calls
         c2d_name = c2d.custom_properties["method-name"]
         command = Command(c2d_name, c2d.data)
@@ -439,11 +702,89 @@ class IoTCClient(AbstractClient):
             pass
 
         self._logger.debug("Received offline command {}".format(command.name))
-        c2d_cb(command)
+        with self._span("iotc.enqueued_command.handle", {"iotc.command.name": c2d_name}):
+            self._call_handler(IOTCEvents.IOTC_ENQUEUED_COMMAND, c2d_cb, command)
+
+    def _call_handler(self, event, callback, *args):
+        if not self._handler_profiling:
+            return callback(*args)
+        start = time.perf_counter()
+        try:
+            return callback(*args)
+        finally:
+            slow_handler = self._profile_handler(
+                event, callback, time.perf_counter() - start
+            )
+            if slow_handler is not None:
+                self._on_slow_handler(slow_handler)
+
+    def _on_slow_handler(self, slow_handler):
+        self._logger.info(
+            "WARNING: Handler '{}' took {:.3f}s".format(
+                slow_handler.handler, slow_handler.duration
+            )
+        )
+        try:
+            slow_cb = self._events[IOTCEvents.IOTC_SLOW_HANDLER]
+        except KeyError:
+            return
+        slow_cb(slow_handler)
+
+    def _set_connection_state(self, state):
+        if state == self._connection_state:
+            return
+        self._connection_state = state
+        self._logger.debug("Connection state changed to {}".format(state))
+        try:
+            state_cb = self._events[IOTCEvents.IOTC_CONNECTION_STATE]
+        except KeyError:
+            return
+        state_cb(state)
+
+    def _on_connection_state_change(self):
+        with self._connecting_lock:
+            if self._terminate or self._connecting:
+                return
+            connected = self.is_connected()
+            # only one of the concurrent disconnection events starts a reconnection
+            self._connecting = not connected
+        if connected:
+            self._set_connection_state(IOTCConnectionState.IOTC_CONNECTION_OK)
+            return
+        self._set_connection_state(
+            IOTCConnectionState.IOTC_CONNECTION_COMMUNICATION_ERROR
+        )
+        # SDK handlers run in its own thread pool which can't shut down the client
+        reconnect_thread = threading.Thread(target=self._reconnect)
+        reconnect_thread.daemon = True
+        reconnect_thread.start()
+
+    def _reconnect(self):
+        self._reconnects_count += 1
+        self._metrics.inc("iotc_reconnects_total")
+        self._device_client.shutdown()
+        self._device_client = None
+        try:
+            # try the cached hub first. dps is used only if the hub rejects the device
+            self.connect()
+        except IoTCConnectionError as e:
+            self._logger.info("ERROR: Reconnection failed. {}".format(e))
 
     def _send_message(self, payload, properties):
-        msg = self._prepare_message(payload, properties)
-        self._device_client.send_message(msg)
+        with self._span("iotc.telemetry.send") as span:
+            msg = self._prepare_message(payload, properties)
+            self._inject_trace(msg, span)
+            start = time.perf_counter()
+            try:
+                self._device_client.send_message(msg)
+            except:
+                self._metrics.inc("iotc_send_failures_total")
+                raise
+            elapsed = time.perf_counter() - start
+        self._metrics.observe("iotc_send_latency_seconds", elapsed)
+        self._metrics.inc("iotc_messages_sent_total")
+        # json payloads are ascii, one byte per character
+        self._metrics.inc("iotc_bytes_sent_total", len(payload))
 
     def send_property(self, payload):
         """
@@ -451,7 +792,9 @@ class IoTCClient(AbstractClient):
         :param dict payload: The properties payload. Can contain multiple properties in the form {'<propName>':{'value':'<propValue>'}}
         """
         self._logger.debug("Sending property {}".format(json.dumps(payload)))
-        self._device_client.patch_twin_reported_properties(payload)
+        with self._span("iotc.property.send"):
+            self._device_client.patch_twin_reported_properties(payload)
+        self._metrics.inc("iotc_properties_sent_total")
 
     def send_telemetry(self, payload, properties=None):
         """
@@ -465,191 +808,318 @@ class IoTCClient(AbstractClient):
     def connect(self, force_dps=False):
         """
         Connects the device.
-        :raises exception: If connection fails
+        Failed attempts are retried with exponential backoff up to the maximum number of connection attempts.
+        :param bool force_dps: Skip cached credentials and provision the device
+        :raises IoTCConnectionError: If all connection attempts fail
         """
-        if (
-            self._connection_attempts_count > self._max_connection_attempts
-        ):  # max number of retries. exit
-            self._terminate = True
-            self._connecting = False
-            return
-        self._terminate = False
-        self._connecting = True
+        with self._connecting_lock:
+            self._terminate = False
+            self._connecting = True
+        self._connection_attempts_count = 0
+        self._ready.clear()
+        self._twin_error = None
+        connect_start = time.perf_counter()
+
+        while True:
+            _credentials = None
+            # search for existing credentials in memory or store
+            if force_dps is False:
+                _credentials = self._get_cached_credentials()
+            use_dps = _credentials is None
+            try:
+                # no stored credentials. use dps
+                if use_dps:
+                    _credentials = self._provision()
+                self._connect_hub(_credentials)
+                self._cache_credentials(_credentials)
+                break
+            except Exception as e:
+                self._connection_attempts_count += 1
+                self._metrics.inc("iotc_connect_failures_total")
+                self._last_error = e
+                if use_dps:
+                    self._logger.info(
+                        "ERROR: Failed to get device provisioning information. {}".format(
+                            e
+                        )
+                    )
+                else:
+                    self._logger.info("ERROR: Failed to connect to Hub. {}".format(e))
+                state = self._connection_state_from_error(e)
+                self._set_connection_state(state)
+                # a broken key is not fixed by retrying
+                if (
+                    isinstance(e, IoTCConnectionError)
+                    or self._connection_attempts_count > self._max_connection_attempts
+                ):
+                    with self._connecting_lock:
+                        self._terminate = True
+                        self._connecting = False
+                    self._set_connection_state(
+                        IOTCConnectionState.IOTC_CONNECTION_RETRY_EXPIRED
+                    )
+                    raise IoTCConnectionError(
+                        "Failed to connect after {} attempts".format(
+                            self._connection_attempts_count
+                        )
+                    ) from e
+                # devices losing their cached hub together must not hit dps in lockstep
+                time.sleep(self._backoff.delay(self._connection_attempts_count))
+                # network errors retry the cached hub. other errors, and the last attempt in case the hub is gone, fallback to dps
+                if (
+                    state != IOTCConnectionState.IOTC_CONNECTION_NO_NETWORK
+                    or self._connection_attempts_count >= self._max_connection_attempts
+                ):
+                    force_dps = True
+                    self._credentials = None
 
-        _credentials = None
+        self._metrics.observe(
+            "iotc_connect_latency_seconds", time.perf_counter() - connect_start
+        )
 
-        # search for existing credentials in store
-        if self._storage is not None and force_dps is False:
+        # reconnections run outside the main thread where handlers can't be set
+        if (
+            not self._signals_registered
+            and threading.current_thread() is threading.main_thread()
+        ):
+            signal.signal(signal.SIGINT, self.disconnect)
+            signal.signal(signal.SIGTERM, self.disconnect)
+            self._signals_registered = True
+
+    def _get_cached_credentials(self):
+        if self._credentials is not None and not self._credentials.is_expired(
+            self._credentials_ttl
+        ):
+            return self._credentials
+        if self._storage is not None:
             _credentials = self._storage.retrieve()
-            self._logger.debug("Found cached credentials")
+            if self._is_valid_cache(_credentials):
+                self._logger.debug("Found cached credentials")
+                return _credentials
+        return None
 
-        # no stored credentials. use dps
-        if _credentials is None:
-            if self._cred_type in (
-                IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
-                IOTCConnectType.IOTC_CONNECT_SYMM_KEY,
-            ):
-                if self._cred_type == IOTCConnectType.IOTC_CONNECT_SYMM_KEY:
-                    self._key_or_cert = self._compute_derived_symmetric_key(
-                        self._key_or_cert, self._device_id
-                    )
-                    self._logger.debug("Device key: {}".format(self._key_or_cert))
-
-                self._provisioning_client = (
-                    ProvisioningDeviceClient.create_from_symmetric_key(
-                        self._global_endpoint,
-                        self._device_id,
-                        self._scope_id,
-                        self._key_or_cert,
-                    )
-                )
-            else:
-                self._key_file = self._key_or_cert["key_file"]
-                self._cert_file = self._key_or_cert["cert_file"]
-                try:
-                    self._cert_phrase = self._key_or_cert["cert_phrase"]
-                    x509 = X509(self._cert_file, self._key_file, self._cert_phrase)
-                except:
-                    self._logger.debug(
-                        "No passphrase available for certificate. Trying without it"
-                    )
-                    x509 = X509(self._cert_file, self._key_file)
-                # Certificate provisioning
-                self._provisioning_client = (
-                    ProvisioningDeviceClient.create_from_x509_certificate(
-                        provisioning_host=self._global_endpoint,
-                        registration_id=self._device_id,
-                        id_scope=self._scope_id,
-                        x509=x509,
-                    )
+    def _cache_credentials(self, _credentials):
+        if not isinstance(_credentials, CredentialsCache):
+            return
+        _credentials.mark_verified()
+        self._credentials = _credentials
+        if self._storage is not None:
+            self._storage.persist(_credentials)
+
+    def _provision(self):
+        ProvisioningDeviceClient = _sdk("ProvisioningDeviceClient")
+        if self._cred_type in (
+            IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
+            IOTCConnectType.IOTC_CONNECT_SYMM_KEY,
+        ):
+            device_key = self._key_or_cert
+            if self._cred_type == IOTCConnectType.IOTC_CONNECT_SYMM_KEY:
+                device_key = self._compute_derived_symmetric_key(
+                    self._key_or_cert, self._device_id
                 )
+                self._logger.debug("Device key: {}".format(device_key))
 
-            if self._model_id:
-                self._provisioning_client.provisioning_payload = {
-                    "iotcModelId": self._model_id,
-                    "modelId": self._model_id,
-                }
-            try:
-                registration_result = self._provisioning_client.register()
-                assigned_hub = registration_result.registration_state.assigned_hub
-                self._logger.debug(assigned_hub)
-                _credentials = CredentialsCache(
-                    assigned_hub,
+            self._provisioning_client = (
+                ProvisioningDeviceClient.create_from_symmetric_key(
+                    self._global_endpoint,
                     self._device_id,
-                    device_key=self._key_or_cert
-                    if self._cred_type
-                    in (
-                        IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
-                        IOTCConnectType.IOTC_CONNECT_SYMM_KEY,
-                    )
-                    else None,
-                    certificate=self._key_or_cert
-                    if self._cred_type == IOTCConnectType.IOTC_CONNECT_X509_CERT
-                    else None,
+                    self._scope_id,
+                    device_key,
+                    **self._sdk_options()
                 )
+            )
+        else:
+            self._key_file = self._key_or_cert["key_file"]
+            self._cert_file = self._key_or_cert["cert_file"]
+            X509 = _sdk("X509")
+            try:
+                self._cert_phrase = self._key_or_cert["cert_phrase"]
+                x509 = X509(self._cert_file, self._key_file, self._cert_phrase)
+            except:
                 self._logger.debug(
-                    "IoTHub Connection string: {}".format(
-                        _credentials.connection_string
-                    )
+                    "No passphrase available for certificate. Trying without it"
                 )
-                if self._storage is not None:
-                    self._storage.persist(_credentials)
-
-            except:
-                t, v, tb = sys.exc_info()
-                self._logger.info(
-                    "ERROR: Failed to get device provisioning information"
+                x509 = X509(self._cert_file, self._key_file)
+            # Certificate provisioning
+            self._provisioning_client = (
+                ProvisioningDeviceClient.create_from_x509_certificate(
+                    provisioning_host=self._global_endpoint,
+                    registration_id=self._device_id,
+                    id_scope=self._scope_id,
+                    x509=x509,
+                    **self._sdk_options()
                 )
-                sys.exit(1)
-        # Connect to iothub
-        try:
-            if self._cred_type in (
+            )
+
+        if self._model_id:
+            self._provisioning_client.provisioning_payload = {
+                "iotcModelId": self._model_id,
+                "modelId": self._model_id,
+            }
+        self._metrics.inc("iotc_dps_registrations_total")
+        with self._metrics.histogram("iotc_dps_latency_seconds").time(), self._span(
+            "iotc.dps.register"
+        ):
+            registration_result = self._provisioning_client.register()
+        assigned_hub = registration_result.registration_state.assigned_hub
+        self._logger.debug(assigned_hub)
+        _credentials = CredentialsCache(
+            assigned_hub,
+            self._device_id,
+            device_key=device_key
+            if self._cred_type
+            in (
                 IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
                 IOTCConnectType.IOTC_CONNECT_SYMM_KEY,
-            ):
-                self._device_client = IoTHubDeviceClient.create_from_connection_string(
-                    _credentials.connection_string, product_info=self._model_id
+            )
+            else None,
+            certificate=self._key_or_cert
+            if self._cred_type == IOTCConnectType.IOTC_CONNECT_X509_CERT
+            else None,
+        )
+        self._logger.debug(
+            "IoTHub Connection string: {}".format(_credentials.connection_string)
+        )
+        return _credentials
+
+    def _connect_hub(self, _credentials):
+        IoTHubDeviceClient = _sdk("IoTHubDeviceClient")
+        if self._cred_type in (
+            IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
+            IOTCConnectType.IOTC_CONNECT_SYMM_KEY,
+        ):
+            device_client = IoTHubDeviceClient.create_from_connection_string(
+                _credentials.connection_string,
+                product_info=self._model_id,
+                **self._sdk_options()
+            )
+        else:
+            X509 = _sdk("X509")
+            # the passphrase is not cached, it comes from the client configuration
+            cert_phrase = self._key_or_cert.get("cert_phrase")
+            if cert_phrase is not None:
+                x509 = X509(
+                    _credentials.certificate["cert_file"],
+                    _credentials.certificate["key_file"],
+                    cert_phrase,
                 )
             else:
-                if "cert_phrase" in _credentials.certificate:
-                    x509 = X509(
-                        _credentials.certificate["cert_file"],
-                        _credentials.certificate["key_file"],
-                        _credentials.certificate["cert_phrase"],
-                    )
-                else:
-                    x509 = X509(
-                        _credentials.certificate["cert_file"],
-                        _credentials.certificate["key_file"],
-                    )
-                self._device_client = IoTHubDeviceClient.create_from_x509_certificate(
-                    x509=x509,
-                    hostname=_credentials.hub_name,
-                    device_id=_credentials.device_id,
-                    product_info=self._model_id,
+                x509 = X509(
+                    _credentials.certificate["cert_file"],
+                    _credentials.certificate["key_file"],
                 )
-            self._device_client.connect()
+            device_client = IoTHubDeviceClient.create_from_x509_certificate(
+                x509=x509,
+                hostname=_credentials.hub_name,
+                device_id=_credentials.device_id,
+                product_info=self._model_id,
+                **self._sdk_options()
+            )
+        # listeners are set before connecting to receive commands sent while the device connects
+        self._set_listeners(device_client)
+        self._device_client = device_client
+        try:
+            with self._span("iotc.hub.connect", {"iotc.hub": _credentials.hub_name}):
+                device_client.connect()
             self._logger.debug("Device connected")
+            if not self._background_twin_sync:
+                with self._metrics.histogram(
+                    "iotc_twin_fetch_latency_seconds"
+                ).time(), self._span("iotc.twin.get"):
+                    self._twin = device_client.get_twin()
+        except:
+            self._device_client = None
+            device_client.shutdown()
+            raise
+        with self._connecting_lock:
             self._connecting = False
-            self._twin = self._device_client.get_twin()
-            self._logger.debug("Current twin: {}".format(self._twin))
-            prop_patch = self._sync_twin()
-            self._logger.debug("Properties to patch: {}".format(prop_patch))
-            if prop_patch is not None:
-                self._update_properties(prop_patch, None)
-        except:  # connection to hub failed. hub can be down or connection string expired. fallback to dps
-            t, v, tb = sys.exc_info()
-            self._logger.info("ERROR: Failed to connect to Hub")
-            if (
-                force_dps is True
-            ):  # don't fallback to dps as we already using it for connecting
-                sys.exit(1)
-            self._connection_attempts_count += 1
-            self.connect(True)
+        self._set_connection_state(IOTCConnectionState.IOTC_CONNECTION_OK)
+        if self._background_twin_sync:
+            twin_thread = threading.Thread(
+                target=self._fetch_twin, args=(device_client,)
+            )
+            twin_thread.daemon = True
+            twin_thread.start()
+        else:
+            self._sync_properties()
 
-        # setup listeners
+    def _set_listeners(self, device_client):
+        device_client.on_twin_desired_properties_patch_received = self._on_properties
+        device_client.on_method_request_received = self._on_commands
+        device_client.on_message_received = self._on_enqueued_commands
+        device_client.on_connection_state_change = self._on_connection_state_change
 
-        self._device_client.on_twin_desired_properties_patch_received = (
-            self._on_properties
-        )
-        self._device_client.on_method_request_received = self._on_commands
-        self._device_client.on_message_received = self._on_enqueued_commands
-
-        self._conn_thread = threading.Thread(target=self._on_connection_state)
-        self._conn_thread.daemon = True
-        self._conn_thread.start()
+    def _fetch_twin(self, device_client):
+        attempt = 0
+        while True:
+            try:
+                with self._metrics.histogram(
+                    "iotc_twin_fetch_latency_seconds"
+                ).time(), self._span("iotc.twin.get"):
+                    self._twin = device_client.get_twin()
+                break
+            except Exception as e:
+                attempt += 1
+                self._logger.info("ERROR: Failed to get device twin. {}".format(e))
+                if self._terminate or self._device_client is not device_client:
+                    return
+                if attempt > self._max_connection_attempts:
+                    # wake up wait_until_ready instead of leaving it waiting forever
+                    self._twin_error = e
+                    self._ready.set()
+                    return
+                time.sleep(self._backoff.delay(attempt))
+        self._sync_properties()
+
+    def _sync_properties(self):
+        self._logger.debug("Current twin: {}".format(self._twin))
+        prop_patch = self._sync_twin()
+        # the twin is only needed to compute the startup patch
+        self._twin = None
+        self._logger.debug("Properties to patch: {}".format(prop_patch))
+        if prop_patch is not None:
+            self._update_properties(prop_patch, None)
+        self._ready.set()
+        try:
+            ready_cb = self._events[IOTCEvents.IOTC_READY]
+        except KeyError:
+            return
+        ready_cb()
 
-        signal.signal(signal.SIGINT, self.disconnect)
-        signal.signal(signal.SIGTERM, self.disconnect)
+    def is_ready(self):
+        """
+        Check if the device is connected and its properties synchronized
+        :rtype: bool
+        """
+        return self._ready.is_set() and self._twin_error is None
 
-    def _on_connection_state(self):
-        while not self._terminate:
-            if not self._connecting and not self.is_connected():
-                self._device_client.shutdown()
-                self._device_client = None
-                self._connection_attempts_count = 0
-                self.connect(True)
-            time.sleep(1.0)
+    def wait_until_ready(self, timeout=None):
+        """
+        Wait until the device is connected and its properties synchronized
+        :param float timeout: Maximum seconds to wait. Default (None)
+        :returns: True if the device is ready, False on timeout
+        :rtype: bool
+        :raises IoTCConnectionError: If the twin could not be fetched in background
+        """
+        ready = self._ready.wait(timeout)
+        if ready and self._twin_error is not None:
+            raise IoTCConnectionError(
+                "Failed to synchronize properties"
+            ) from self._twin_error
+        return ready
 
     def disconnect(self, *args):
         self._logger.info("Received shutdown signal")
         self._terminate = True
 
-        self._device_client.shutdown()
+        if self._device_client is not None:
+            self._device_client.shutdown()
         self._logger.info("Disconnecting client...")
         self._logger.info("Client disconnected.")
         self._logger.info("See you!")
 
     def _compute_derived_symmetric_key(self, secret, reg_id):
-        # pylint: disable=no-member
         try:
-            secret = base64.b64decode(secret)
-        except:
-            self._logger.debug("ERROR: broken base64 secret => `" + secret + "`")
-            sys.exit()
-
-        return base64.b64encode(
-            hmac.new(
-                secret, msg=reg_id.encode("utf8"), digestmod=hashlib.sha256
-            ).digest()
-        ).decode("utf-8")
+            return derive_device_key(secret, reg_id)
+        except ValueError as e:
+            raise IoTCConnectionError("Broken base64 group key. {}".format(e)) from e
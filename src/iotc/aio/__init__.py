@@ -1,7 +1,9 @@
-import sys
 import signal
 import asyncio
-import pkg_resources
+import time
+import functools
+import json
+import types
 
 from iotc.models import Property
 from .. import (
@@ -9,51 +11,66 @@ from .. import (
     IOTCLogLevel,
     IOTCEvents,
     IOTCConnectType,
+    IOTCConnectionState,
     Command,
     CredentialsCache,
     Storage,
+    AsyncStorage,
+    EnqueuedCommandsCache,
     GracefulExit,
+    IoTCConnectionError,
+    _lazy_import,
+    _shared_logger,
+    _version,
 )
 from contextlib import suppress
-from azure.iot.device.common.transport_exceptions import ConnectionDroppedError
-from azure.iot.device import X509, MethodResponse, Message
-from azure.iot.device.aio import IoTHubDeviceClient, ProvisioningDeviceClient
-
-try:
-    __version__ = pkg_resources.get_distribution("iotc").version
-except:
-    pass
-
-
-try:
-    import hmac
-except ImportError:
-    print("ERROR: missing dependency `hmac`")
-    sys.exit(3)
-
-try:
-    import hashlib
-except ImportError:
-    print("ERROR: missing dependency `hashlib`")
-    sys.exit(3)
-
-try:
-    import base64
-except ImportError:
-    print("ERROR: missing dependency `base64`")
-    sys.exit(3)
-
-try:
-    import json
-except ImportError:
-    print("ERROR: missing dependency `json`")
-    sys.exit(3)
-
-try:
-    import uuid
-except ImportError:
-    print("ERROR: missing dependency `uuid`")
-    sys.exit(3)
+from .streams import EventStream
+from .monitor import loop_monitor
+from .storage import ExecutorStorage, LoopEnqueuedStorage
+from ..keys import derive_device_key
+
+_SDK_IMPORTS = {
+    "X509": ("azure.iot.device", "X509"),
+    "MethodResponse": ("azure.iot.device", "MethodResponse"),
+    "IoTHubDeviceClient": ("azure.iot.device.aio", "IoTHubDeviceClient"),
+    "ProvisioningDeviceClient": ("azure.iot.device.aio", "ProvisioningDeviceClient"),
+}
+
+
+def _sdk(name):
+    return _lazy_import(globals(), _SDK_IMPORTS, name)
+
+
+def __getattr__(name):
+    if name == "__version__":
+        return _version(globals())
+    if name in _SDK_IMPORTS:
+        return _sdk(name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+@types.coroutine
+def _timed_steps(coro, steps):
+    # runs the coroutine one step at a time. each step runs without yielding to the event loop
+    value, error = None, None
+    while True:
+        start = time.perf_counter()
+        try:
+            if error is None:
+                future = coro.send(value)
+            else:
+                future = coro.throw(error)
+        except StopIteration as e:
+            steps.append(time.perf_counter() - start)
+            return e.value
+        except BaseException:
+            steps.append(time.perf_counter() - start)
+            raise
+        steps.append(time.perf_counter() - start)
+        try:
+            value, error = (yield future), None
+        except BaseException as e:
+            value, error = None, e
 
 
 class ConsoleLogger:
@@ -75,7 +92,22 @@ class ConsoleLogger:
         self._log_level = log_level
 
 
+class _UnlimitedSlots:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+
+# returned by property handlers when the property is acknowledged later
+_QUEUED = object()
+
+
 class IoTCClient(AbstractClient):
+    _loop_monitor_options = None
+    _loop_monitor = None
+
     def __init__(
         self,
         device_id,
@@ -96,7 +128,7 @@ class IoTCClient(AbstractClient):
             max_connection_attempts,
         )
         if logger is None:
-            self._logger = ConsoleLogger(IOTCLogLevel.IOTC_LOGGING_API_ONLY)
+            self._logger = _shared_logger(ConsoleLogger, IOTCLogLevel.IOTC_LOGGING_API_ONLY)
         else:
             if (
                 hasattr(logger, "info")
@@ -105,11 +137,53 @@ class IoTCClient(AbstractClient):
             ):
                 self._logger = logger
             else:
-                print(
-                    "ERROR: Logger object has unsupported format. It must implement the following functions\n\
-                    info(message);\ndebug(message);\nset_log_level(message);"
+                raise ValueError(
+                    "Logger object has unsupported format. It must implement the following functions: "
+                    "info(message), debug(message), set_log_level(log_level)"
                 )
-                sys.exit()
+        self._streams = {}
+        self._loop = None
+        self._reconnect_task = None
+        # shared by clients of the same IoTCFleet to limit concurrent connections
+        self._connect_slots = _UnlimitedSlots()
+        self._storage_adapter = None
+        self._ready = None
+        self._twin_task = None
+
+    def commands(self, maxsize=100):
+        """
+        Get a stream of received commands, to consume with `async for`.
+        While the stream is open, commands are not passed to the IOTC_COMMAND callback.
+        Commands received while the stream is full are answered with a 503 status.
+        :param int maxsize: Maximum number of commands waiting to be consumed. Default (100)
+        :returns: Commands stream
+        :rtype: EventStream
+        """
+        return self._open_stream(IOTCEvents.IOTC_COMMAND, maxsize)
+
+    def property_updates(self, maxsize=100):
+        """
+        Get a stream of received property updates, to consume with `async for`.
+        Properties are acknowledged by calling `await prop.ack()`.
+        While the stream is open, properties are not passed to the IOTC_PROPERTIES callback.
+        Property updates received while the stream is full replace the oldest waiting one.
+        :param int maxsize: Maximum number of properties waiting to be consumed. Default (100)
+        :returns: Properties stream
+        :rtype: EventStream
+        """
+        return self._open_stream(IOTCEvents.IOTC_PROPERTIES, maxsize, drop_oldest=True)
+
+    def _open_stream(self, eventname, maxsize, drop_oldest=False):
+        if eventname in self._streams:
+            self._streams[eventname].close()
+
+        def remove_stream(stream):
+            if self._streams.get(eventname) is stream:
+                del self._streams[eventname]
+
+        stream = EventStream(maxsize, remove_stream, drop_oldest)
+        self._streams[eventname] = stream
+        return stream
 
     def raise_graceful_exit(self, *args):
         async def handle_disconnection():
@@ -132,40 +206,57 @@ class IoTCClient(AbstractClient):
     ):
         if callback is not None:
             prop = Property(property_name, property_value, component_name)
-            ret = await callback(prop)
+            prop.ack = functools.partial(
+                self._ack_property,
+                property_name,
+                property_value,
+                property_version,
+                component_name,
+            )
+            ret = await self._call_handler(IOTCEvents.IOTC_PROPERTIES, callback, prop)
         else:
             ret = True
+        if ret is _QUEUED:
+            # acknowledged by the stream consumer through prop.ack()
+            return
         if ret:
-            if component_name is not None:
-                await self._logger.debug("Acknowledging {}".format(property_name))
-                await self.send_property(
-                    {
-                        "{}".format(component_name): {
-                            "__t": "c",
-                            "{}".format(property_name): {
-                                "value": property_value,
-                                "ac": 200,
-                                "ad": "Completed",
-                                "av": property_version,
-                            },
-                        }
-                    }
-                )
-            else:
-                await self._logger.debug("Acknowledging {}".format(property_name))
-                await self.send_property(
-                    {
+            await self._ack_property(
+                property_name, property_value, property_version, component_name
+            )
+        else:
+            await self._logger.debug(
+                'Property "{}" unsuccessfully processed'.format(property_name)
+            )
+
+    async def _ack_property(
+        self, property_name, property_value, property_version, component_name=None
+    ):
+        await self._logger.debug("Acknowledging {}".format(property_name))
+        self._metrics.inc("iotc_property_acks_total")
+        if component_name is not None:
+            await self.send_property(
+                {
+                    "{}".format(component_name): {
+                        "__t": "c",
                         "{}".format(property_name): {
+                            "value": property_value,
                             "ac": 200,
                             "ad": "Completed",
                             "av": property_version,
-                            "value": property_value,
-                        }
+                        },
                     }
-                )
+                }
+            )
         else:
-            await self._logger.debug(
-                'Property "{}" unsuccessfully processed'.format(property_name)
+            await self.send_property(
+                {
+                    "{}".format(property_name): {
+                        "ac": 200,
+                        "ad": "Completed",
+                        "av": property_version,
+                        "value": property_value,
+                    }
+                }
             )
 
     async def _update_properties(self, patch, prop_cb):
@@ -203,21 +294,41 @@ class IoTCClient(AbstractClient):
 
     async def _on_properties(self, patch):
         await self._logger.debug("Setup properties listener")
-        try:
-            prop_cb = self._events[IOTCEvents.IOTC_PROPERTIES]
-        except KeyError:
-            await self._logger.debug("Properties callback not found")
-            return
+        if IOTCEvents.IOTC_PROPERTIES in self._streams:
+            prop_cb = self._stream_property
+        else:
+            try:
+                prop_cb = self._events[IOTCEvents.IOTC_PROPERTIES]
+            except KeyError:
+                await self._logger.debug("Properties callback not found")
+                return
 
         await self._update_properties(patch, prop_cb)
 
+    async def _stream_property(self, prop):
+        stream = self._streams.get(IOTCEvents.IOTC_PROPERTIES)
+        if stream is None:
+            return False
+        dropped = stream.dropped()
+        if not await stream.put(prop):
+            return False
+        if stream.dropped() > dropped:
+            self._metrics.inc("iotc_stream_events_dropped_total")
+            await self._logger.info(
+                "WARNING: Properties stream full, dropped the oldest property update"
+            )
+        return _QUEUED
+
     async def _on_commands(self, method_request):
         await self._logger.debug("Setup commands listener")
-        try:
-            cmd_cb = self._events[IOTCEvents.IOTC_COMMAND]
-        except KeyError:
-            await self._logger.debug("Command callback not found")
-            return
+        cmd_stream = self._streams.get(IOTCEvents.IOTC_COMMAND)
+        if cmd_stream is None:
+            try:
+                cmd_cb = self._events[IOTCEvents.IOTC_COMMAND]
+            except KeyError:
+                await self._logger.debug("Command callback not found")
+                return
+        self._metrics.inc("iotc_commands_received_total")
         command = Command(method_request.name, method_request.payload)
         try:
             command_name_with_components = method_request.name.split("*")
@@ -233,18 +344,38 @@ class IoTCClient(AbstractClient):
         except:
             pass
 
-        async def reply_fn():
+        async def reply_fn(status=200, payload=None):
+            if payload is None:
+                payload = {"result": True, "data": "Command received"}
             await self._device_client.send_method_response(
-                MethodResponse.create_from_method_request(
+                _sdk("MethodResponse").create_from_method_request(
                     method_request,
-                    200,
-                    {"result": True, "data": "Command received"},
+                    status,
+                    payload,
+                )
+            )
+
+        async def complete_fn(value):
+            await self.send_property(
+                self._command_result_patch(
+                    command.name, value, command.component_name
                 )
             )
 
         command.reply = reply_fn
+        command.complete = complete_fn
         await self._logger.debug("Received command {}".format(method_request.name))
-        await cmd_cb(command)
+        with self._span("iotc.command.handle", {"iotc.command.name": method_request.name}):
+            if cmd_stream is None:
+                await self._call_handler(IOTCEvents.IOTC_COMMAND, cmd_cb, command)
+            elif not await cmd_stream.put(command):
+                self._metrics.inc("iotc_stream_events_dropped_total")
+                await self._logger.info(
+                    "WARNING: Commands stream full, rejected command {}".format(
+                        method_request.name
+                    )
+                )
+                await command.reply(503, {"result": False, "data": "Device busy"})
 
     async def _on_enqueued_commands(self, c2d):
         await self._logger.debug("Setup offline commands listener")
@@ -254,6 +385,13 @@ class IoTCClient(AbstractClient):
             await self._logger.debug("Command callback not found")
             return
 
+        if self._is_duplicate_enqueued(c2d.message_id):
+            await self._logger.debug(
+                "Dropping duplicate offline command {}".format(c2d.message_id)
+            )
+            return
+
+        self._metrics.inc("iotc_enqueued_commands_received_total")
         # Wait for unknown method calls
         c2d_name = c2d.custom_properties["method-name"]
         command = Command(c2d_name, c2d.data)
@@ -272,11 +410,140 @@ class IoTCClient(AbstractClient):
             pass
 
         await self._logger.debug("Received offline command {}".format(command.name))
-        await c2d_cb(command)
+        with self._span("iotc.enqueued_command.handle", {"iotc.command.name": c2d_name}):
+            await self._call_handler(IOTCEvents.IOTC_ENQUEUED_COMMAND, c2d_cb, command)
+
+    async def _call_handler(self, event, callback, *args):
+        if not self._handler_profiling:
+            return await callback(*args)
+        steps = []
+        start = time.perf_counter()
+        try:
+            awaitable = callback(*args)
+            if asyncio.iscoroutine(awaitable):
+                return await _timed_steps(awaitable, steps)
+            return await awaitable
+        finally:
+            slow_handler = self._profile_handler(
+                event,
+                callback,
+                time.perf_counter() - start,
+                max(steps) if steps else None,
+            )
+            if slow_handler is not None:
+                await self._on_slow_handler(slow_handler)
+
+    async def _on_slow_handler(self, slow_handler):
+        if slow_handler.blocking_duration is not None and (
+            slow_handler.blocking_duration > self._blocking_handler_threshold
+        ):
+            await self._logger.info(
+                "WARNING: Handler '{}' blocked the event loop for {:.3f}s".format(
+                    slow_handler.handler, slow_handler.blocking_duration
+                )
+            )
+        else:
+            await self._logger.info(
+                "WARNING: Handler '{}' took {:.3f}s".format(
+                    slow_handler.handler, slow_handler.duration
+                )
+            )
+        try:
+            slow_cb = self._events[IOTCEvents.IOTC_SLOW_HANDLER]
+        except KeyError:
+            return
+        await slow_cb(slow_handler)
+
+    def set_loop_monitor(self, enabled=True, interval=0.1, threshold=0.25):
+        """
+        Measure the event loop scheduling lag while connected and raise the IOTC_LOOP_STALL event when it exceeds the threshold,
+        with a stack snapshot of the blocking code. Clients on the same loop share one monitor, configured by the first client connecting.
+        :param bool enabled: Monitor the loop. Default (True)
+        :param float interval: Seconds between lag measurements. Default (0.1)
+        :param float threshold: Lag in seconds above which the loop is stalled. Default (0.25)
+        """
+        self._loop_monitor_options = (interval, threshold) if enabled else None
+
+    def loop_monitor(self):
+        """
+        Get the monitor of the client event loop, with the iotc_loop_lag_seconds histogram and the iotc_loop_stalls_total counter in its metrics
+        :returns: Loop monitor or None if the client is not monitoring its loop
+        :rtype: LoopMonitor
+        """
+        return self._loop_monitor
+
+    async def _stop_loop_monitor(self):
+        if self._loop_monitor is not None:
+            monitor, self._loop_monitor = self._loop_monitor, None
+            await monitor.unsubscribe(self._on_loop_stall)
+
+    async def _on_loop_stall(self, stall):
+        await self._logger.info(
+            "WARNING: Event loop blocked for {:.3f}s in task '{}'".format(stall.lag, stall.task)
+        )
+        if stall.stack is not None:
+            await self._logger.debug("".join(stall.stack))
+        try:
+            stall_cb = self._events[IOTCEvents.IOTC_LOOP_STALL]
+        except KeyError:
+            return
+        await stall_cb(stall)
+
+    async def _set_connection_state(self, state):
+        if state == self._connection_state:
+            return
+        self._connection_state = state
+        await self._logger.debug("Connection state changed to {}".format(state))
+        try:
+            state_cb = self._events[IOTCEvents.IOTC_CONNECTION_STATE]
+        except KeyError:
+            return
+        await state_cb(state)
+
+    def _on_connection_state_change(self):
+        # SDK handlers run on their own threads. Handle the change on the client loop
+        self._loop.call_soon_threadsafe(self._handle_connection_state_change)
+
+    def _handle_connection_state_change(self):
+        if self._terminate or self._connecting:
+            return
+        if self.is_connected():
+            asyncio.ensure_future(
+                self._set_connection_state(IOTCConnectionState.IOTC_CONNECTION_OK)
+            )
+            return
+        self._connecting = True
+        self._reconnect_task = asyncio.ensure_future(self._reconnect())
+
+    async def _reconnect(self):
+        self._reconnects_count += 1
+        self._metrics.inc("iotc_reconnects_total")
+        await self._set_connection_state(
+            IOTCConnectionState.IOTC_CONNECTION_COMMUNICATION_ERROR
+        )
+        await self._device_client.shutdown()
+        self._device_client = None
+        try:
+            # try the cached hub first. dps is used only if the hub rejects the device
+            await self.connect()
+        except IoTCConnectionError as e:
+            await self._logger.info("ERROR: Reconnection failed. {}".format(e))
 
     async def _send_message(self, payload, properties):
-        msg = self._prepare_message(payload, properties)
-        await self._device_client.send_message(msg)
+        with self._span("iotc.telemetry.send") as span:
+            msg = self._prepare_message(payload, properties)
+            self._inject_trace(msg, span)
+            start = time.perf_counter()
+            try:
+                await self._device_client.send_message(msg)
+            except:
+                self._metrics.inc("iotc_send_failures_total")
+                raise
+            elapsed = time.perf_counter() - start
+        self._metrics.observe("iotc_send_latency_seconds", elapsed)
+        self._metrics.inc("iotc_messages_sent_total")
+        # json payloads are ascii, one byte per character
+        self._metrics.inc("iotc_bytes_sent_total", len(payload))
 
     async def send_property(self, payload):
         """
@@ -284,7 +551,9 @@ class IoTCClient(AbstractClient):
         :param dict payload: The properties payload. Can contain multiple properties in the form {'<propName>':{'value':'<propValue>'}}
         """
         await self._logger.debug("Sending property {}".format(json.dumps(payload)))
-        await self._device_client.patch_twin_reported_properties(payload)
+        with self._span("iotc.property.send"):
+            await self._device_client.patch_twin_reported_properties(payload)
+        self._metrics.inc("iotc_properties_sent_total")
 
     async def send_telemetry(self, payload, properties=None):
         """
@@ -298,193 +567,386 @@ class IoTCClient(AbstractClient):
     async def connect(self, force_dps=False):
         """
         Connects the device.
-        :raises exception: If connection fails
+        Failed attempts are retried with exponential backoff up to the maximum number of connection attempts.
+        :param bool force_dps: Skip cached credentials and provision the device
+        :raises IoTCConnectionError: If all connection attempts fail
         """
-
-        if (
-            self._connection_attempts_count > self._max_connection_attempts
-        ):  # max number of retries. exit
-            self._terminate = True
-            self._connecting = False
-            return
-
         self._terminate = False
         self._connecting = True
-        _credentials = None
-
-        if self._storage is not None and force_dps is False:
-            _credentials = self._storage.retrieve()
-            await self._logger.debug("Found cached credentials")
-
-        if _credentials is None:
-            if self._cred_type in (
-                IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
-                IOTCConnectType.IOTC_CONNECT_SYMM_KEY,
-            ):
-                if self._cred_type == IOTCConnectType.IOTC_CONNECT_SYMM_KEY:
-                    self._key_or_cert = await self._compute_derived_symmetric_key(
-                        self._key_or_cert, self._device_id
-                    )
-
-                await self._logger.debug("Device key: {}".format(self._key_or_cert))
-
-                self._provisioning_client = (
-                    ProvisioningDeviceClient.create_from_symmetric_key(
-                        self._global_endpoint,
-                        self._device_id,
-                        self._scope_id,
-                        self._key_or_cert,
+        self._connection_attempts_count = 0
+        self._loop = asyncio.get_running_loop()
+        self._ready_event().clear()
+        self._twin_error = None
+        await self._load_enqueued_cache()
+        if self._loop_monitor_options is not None and self._loop_monitor is None:
+            self._loop_monitor = loop_monitor(*self._loop_monitor_options)
+            self._loop_monitor.subscribe(self._on_loop_stall)
+        connect_start = time.perf_counter()
+
+        while True:
+            _credentials = None
+            # search for existing credentials in memory or store
+            if force_dps is False:
+                _credentials = await self._get_cached_credentials()
+            use_dps = _credentials is None
+            try:
+                async with self._connect_slots:
+                    if use_dps:
+                        _credentials = await self._provision()
+                    await self._connect_hub(_credentials)
+                await self._cache_credentials(_credentials)
+                break
+            except Exception as e:
+                self._connection_attempts_count += 1
+                self._metrics.inc("iotc_connect_failures_total")
+                self._last_error = e
+                if use_dps:
+                    await self._logger.info(
+                        "ERROR: Failed to get device provisioning information. {}".format(
+                            e
+                        )
                     )
-                )
-            else:
-                self._key_file = self._key_or_cert["key_file"]
-                self._cert_file = self._key_or_cert["cert_file"]
-                try:
-                    self._cert_phrase = self._key_or_cert["cert_phrase"]
-                    x509 = X509(self._cert_file, self._key_file, self._cert_phrase)
-                except:
-                    await self._logger.debug(
-                        "No passphrase available for certificate. Trying without it"
+                else:
+                    await self._logger.info(
+                        "ERROR: Failed to connect to Hub. {}".format(e)
                     )
-                    x509 = X509(self._cert_file, self._key_file)
-                # Certificate provisioning
-                self._provisioning_client = (
-                    ProvisioningDeviceClient.create_from_x509_certificate(
-                        provisioning_host=self._global_endpoint,
-                        registration_id=self._device_id,
-                        id_scope=self._scope_id,
-                        x509=x509,
-                        product_info=self._model_id,
+                state = self._connection_state_from_error(e)
+                await self._set_connection_state(state)
+                # a broken key is not fixed by retrying
+                if (
+                    isinstance(e, IoTCConnectionError)
+                    or self._connection_attempts_count > self._max_connection_attempts
+                ):
+                    self._terminate = True
+                    self._connecting = False
+                    await self._stop_loop_monitor()
+                    await self._set_connection_state(
+                        IOTCConnectionState.IOTC_CONNECTION_RETRY_EXPIRED
                     )
+                    raise IoTCConnectionError(
+                        "Failed to connect after {} attempts".format(
+                            self._connection_attempts_count
+                        )
+                    ) from e
+                # devices losing their cached hub together must not hit dps in lockstep
+                await asyncio.sleep(
+                    self._backoff.delay(self._connection_attempts_count)
                 )
+                # network errors retry the cached hub. other errors, and the last attempt in case the hub is gone, fallback to dps
+                if (
+                    state != IOTCConnectionState.IOTC_CONNECTION_NO_NETWORK
+                    or self._connection_attempts_count >= self._max_connection_attempts
+                ):
+                    force_dps = True
+                    self._credentials = None
+
+        self._metrics.observe(
+            "iotc_connect_latency_seconds", time.perf_counter() - connect_start
+        )
 
-            if self._model_id:
-                await self._logger._log(f"Provisioning with model Id: '{self._model_id}'")
-                self._provisioning_client.provisioning_payload = {
-                    "iotcModelId": self._model_id,
-                    "modelId": self._model_id,
-                }
-            try:
-                registration_result = await self._provisioning_client.register()
-                assigned_hub = registration_result.registration_state.assigned_hub
-                _credentials = CredentialsCache(
-                    assigned_hub,
-                    self._device_id,
-                    device_key=self._key_or_cert
-                    if self._cred_type
-                    in (
-                        IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
-                        IOTCConnectType.IOTC_CONNECT_SYMM_KEY,
-                    )
-                    else None,
-                    certificate=self._key_or_cert
-                    if self._cred_type == IOTCConnectType.IOTC_CONNECT_X509_CERT
-                    else None,
+        if not self._signals_registered:
+            signal.signal(signal.SIGINT, self.raise_graceful_exit)
+            signal.signal(signal.SIGTERM, self.raise_graceful_exit)
+            self._signals_registered = True
+
+    def _async_storage(self):
+        if self._storage is None or isinstance(self._storage, AsyncStorage):
+            return self._storage
+        # synchronous storages run in the default executor
+        if (
+            self._storage_adapter is None
+            or self._storage_adapter.storage is not self._storage
+        ):
+            self._storage_adapter = ExecutorStorage(self._storage)
+        return self._storage_adapter
+
+    def _enqueued_storage(self):
+        # message ids are persisted from the SDK handler thread. async storages are written from the client loop
+        if isinstance(self._storage, ExecutorStorage):
+            return self._storage.storage
+        if isinstance(self._storage, AsyncStorage):
+            if self._loop is None:
+                return None
+            return LoopEnqueuedStorage(self._storage, self._loop)
+        return self._storage
+
+    async def _load_enqueued_cache(self):
+        # the SDK handler thread can't await async storages, ids are read before connecting
+        if (
+            self._enqueued_cache is not None
+            or not self._enqueued_cache_size
+            or not isinstance(self._storage, AsyncStorage)
+            or isinstance(self._storage, ExecutorStorage)
+        ):
+            return
+        try:
+            message_ids = await self._storage.retrieve_enqueued_ids()
+        except Exception as e:
+            await self._logger.debug("Failed to read enqueued command ids. {}".format(e))
+            message_ids = None
+        self._enqueued_cache = EnqueuedCommandsCache(
+            self._enqueued_cache_size,
+            LoopEnqueuedStorage(self._storage, self._loop, message_ids),
+        )
+
+    async def _get_cached_credentials(self):
+        if self._credentials is not None and not self._credentials.is_expired(
+            self._credentials_ttl
+        ):
+            return self._credentials
+        storage = self._async_storage()
+        if storage is not None:
+            _credentials = await storage.retrieve()
+            if self._is_valid_cache(_credentials):
+                await self._logger.debug("Found cached credentials")
+                return _credentials
+        return None
+
+    async def _cache_credentials(self, _credentials):
+        if not isinstance(_credentials, CredentialsCache):
+            return
+        _credentials.mark_verified()
+        self._credentials = _credentials
+        storage = self._async_storage()
+        if storage is not None:
+            await storage.persist(_credentials)
+
+    async def _provision(self):
+        ProvisioningDeviceClient = _sdk("ProvisioningDeviceClient")
+        if self._cred_type in (
+            IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
+            IOTCConnectType.IOTC_CONNECT_SYMM_KEY,
+        ):
+            device_key = self._key_or_cert
+            if self._cred_type == IOTCConnectType.IOTC_CONNECT_SYMM_KEY:
+                device_key = await self._compute_derived_symmetric_key(
+                    self._key_or_cert, self._device_id
                 )
 
-                if self._storage is not None:
-                    self._storage.persist(_credentials)
+            await self._logger.debug("Device key: {}".format(device_key))
 
-            except Exception as e:
-                await self._logger.info(
-                    "ERROR: Failed to get device provisioning information. {}".format(e)
+            self._provisioning_client = (
+                ProvisioningDeviceClient.create_from_symmetric_key(
+                    self._global_endpoint,
+                    self._device_id,
+                    self._scope_id,
+                    device_key,
+                    **self._sdk_options()
                 )
-                sys.exit(1)
-        # Connect to iothub
-        try:
-            if self._cred_type in (
+            )
+        else:
+            self._key_file = self._key_or_cert["key_file"]
+            self._cert_file = self._key_or_cert["cert_file"]
+            X509 = _sdk("X509")
+            try:
+                self._cert_phrase = self._key_or_cert["cert_phrase"]
+                x509 = X509(self._cert_file, self._key_file, self._cert_phrase)
+            except:
+                await self._logger.debug(
+                    "No passphrase available for certificate. Trying without it"
+                )
+                x509 = X509(self._cert_file, self._key_file)
+            # Certificate provisioning
+            self._provisioning_client = (
+                ProvisioningDeviceClient.create_from_x509_certificate(
+                    provisioning_host=self._global_endpoint,
+                    registration_id=self._device_id,
+                    id_scope=self._scope_id,
+                    x509=x509,
+                    product_info=self._model_id,
+                    **self._sdk_options()
+                )
+            )
+
+        if self._model_id:
+            await self._logger._log(f"Provisioning with model Id: '{self._model_id}'")
+            self._provisioning_client.provisioning_payload = {
+                "iotcModelId": self._model_id,
+                "modelId": self._model_id,
+            }
+        self._metrics.inc("iotc_dps_registrations_total")
+        with self._metrics.histogram("iotc_dps_latency_seconds").time(), self._span(
+            "iotc.dps.register"
+        ):
+            registration_result = await self._provisioning_client.register()
+        assigned_hub = registration_result.registration_state.assigned_hub
+        _credentials = CredentialsCache(
+            assigned_hub,
+            self._device_id,
+            device_key=device_key
+            if self._cred_type
+            in (
                 IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
                 IOTCConnectType.IOTC_CONNECT_SYMM_KEY,
-            ):
-                self._device_client = IoTHubDeviceClient.create_from_connection_string(
-                    _credentials.connection_string, product_info=self._model_id
+            )
+            else None,
+            certificate=self._key_or_cert
+            if self._cred_type == IOTCConnectType.IOTC_CONNECT_X509_CERT
+            else None,
+        )
+        return _credentials
+
+    async def _connect_hub(self, _credentials):
+        IoTHubDeviceClient = _sdk("IoTHubDeviceClient")
+        if self._cred_type in (
+            IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
+            IOTCConnectType.IOTC_CONNECT_SYMM_KEY,
+        ):
+            device_client = IoTHubDeviceClient.create_from_connection_string(
+                _credentials.connection_string,
+                product_info=self._model_id,
+                **self._sdk_options()
+            )
+        else:
+            X509 = _sdk("X509")
+            # the passphrase is not cached, it comes from the client configuration
+            cert_phrase = self._key_or_cert.get("cert_phrase")
+            if cert_phrase is not None:
+                x509 = X509(
+                    _credentials.certificate["cert_file"],
+                    _credentials.certificate["key_file"],
+                    cert_phrase,
                 )
             else:
-                if "cert_phrase" in _credentials.certificate:
-                    x509 = X509(
-                        _credentials.certificate["cert_file"],
-                        _credentials.certificate["key_file"],
-                        _credentials.certificate["cert_phrase"],
-                    )
-                else:
-                    x509 = X509(
-                        _credentials.certificate["cert_file"],
-                        _credentials.certificate["key_file"],
-                    )
-                self._device_client = IoTHubDeviceClient.create_from_x509_certificate(
-                    x509=x509,
-                    hostname=_credentials.hub_name,
-                    device_id=_credentials.device_id,
-                    product_info=self._model_id
+                x509 = X509(
+                    _credentials.certificate["cert_file"],
+                    _credentials.certificate["key_file"],
                 )
-            await self._device_client.connect()
+            device_client = IoTHubDeviceClient.create_from_x509_certificate(
+                x509=x509,
+                hostname=_credentials.hub_name,
+                device_id=_credentials.device_id,
+                product_info=self._model_id,
+                **self._sdk_options()
+            )
+        # listeners are set before connecting to receive commands sent while the device connects
+        self._set_listeners(device_client)
+        self._device_client = device_client
+        try:
+            with self._span("iotc.hub.connect", {"iotc.hub": _credentials.hub_name}):
+                await device_client.connect()
             await self._logger.debug(
                 "Device connected to '{}'".format(_credentials.hub_name)
             )
-            self._connecting = False
-            self._twin = await self._device_client.get_twin()
-            await self._logger.debug("Current twin: {}".format(self._twin))
-            twin_patch = self._sync_twin()
-            if twin_patch is not None:
-                await self._update_properties(twin_patch, None)
-        except Exception as e:  # connection to hub failed. hub can be down or connection string expired. fallback to dps
-            await self._logger.info("ERROR: Failed to connect to Hub. {}".format(e))
-            if force_dps is True:
-                sys.exit(1)
-            self._connection_attempts_count += 1
-            await self.connect(True)
-
-        # setup listeners
-        self._device_client.on_twin_desired_properties_patch_received = (
-            self._on_properties
-        )
-        self._device_client.on_method_request_received = self._on_commands
-        self._device_client.on_message_received = self._on_enqueued_commands
+            if not self._background_twin_sync:
+                with self._metrics.histogram(
+                    "iotc_twin_fetch_latency_seconds"
+                ).time(), self._span("iotc.twin.get"):
+                    self._twin = await device_client.get_twin()
+        except:
+            self._device_client = None
+            await device_client.shutdown()
+            raise
+        self._connecting = False
+        await self._set_connection_state(IOTCConnectionState.IOTC_CONNECTION_OK)
+        if self._background_twin_sync:
+            self._twin_task = asyncio.ensure_future(self._fetch_twin(device_client))
+        else:
+            await self._sync_properties()
 
-        if hasattr(self, "_conn_thread") and self._conn_thread is not None:
+    def _set_listeners(self, device_client):
+        device_client.on_twin_desired_properties_patch_received = self._on_properties
+        device_client.on_method_request_received = self._on_commands
+        device_client.on_message_received = self._on_enqueued_commands
+        device_client.on_connection_state_change = self._on_connection_state_change
+
+    async def _fetch_twin(self, device_client):
+        attempt = 0
+        while True:
             try:
-                self._conn_thread.cancel()
-                await self._conn_thread
-            except asyncio.CancelledError:
-                print("Resetting conn_status thread")
-        self._conn_thread = asyncio.create_task(self._on_connection_state())
-
-        signal.signal(signal.SIGINT, self.raise_graceful_exit)
-        signal.signal(signal.SIGTERM, self.raise_graceful_exit)
-
-    async def _on_connection_state(self):
-        while not self._terminate:
-            if not self._connecting and not self.is_connected():
-                await self._device_client.shutdown()
-                self._device_client = None
-                self._connection_attempts_count = 0
-                await self.connect(True)
-            await asyncio.sleep(1.0)
+                with self._metrics.histogram(
+                    "iotc_twin_fetch_latency_seconds"
+                ).time(), self._span("iotc.twin.get"):
+                    self._twin = await device_client.get_twin()
+                break
+            except Exception as e:
+                attempt += 1
+                await self._logger.info(
+                    "ERROR: Failed to get device twin. {}".format(e)
+                )
+                if self._terminate or self._device_client is not device_client:
+                    return
+                if attempt > self._max_connection_attempts:
+                    # wake up wait_until_ready instead of leaving it waiting forever
+                    self._twin_error = e
+                    self._ready_event().set()
+                    return
+                await asyncio.sleep(self._backoff.delay(attempt))
+        await self._sync_properties()
+
+    async def _sync_properties(self):
+        await self._logger.debug("Current twin: {}".format(self._twin))
+        twin_patch = self._sync_twin()
+        # the twin is only needed to compute the startup patch
+        self._twin = None
+        if twin_patch is not None:
+            await self._update_properties(twin_patch, None)
+        self._ready_event().set()
+        try:
+            ready_cb = self._events[IOTCEvents.IOTC_READY]
+        except KeyError:
+            return
+        await ready_cb()
+
+    def _ready_event(self):
+        # created on the loop running the client
+        if self._ready is None:
+            self._ready = asyncio.Event()
+        return self._ready
+
+    def is_ready(self):
+        """
+        Check if the device is connected and its properties synchronized
+        :rtype: bool
+        """
+        return (
+            self._ready is not None
+            and self._ready.is_set()
+            and self._twin_error is None
+        )
+
+    async def wait_until_ready(self, timeout=None):
+        """
+        Wait until the device is connected and its properties synchronized
+        :param float timeout: Maximum seconds to wait. Default (None)
+        :returns: True if the device is ready, False on timeout
+        :rtype: bool
+        :raises IoTCConnectionError: If the twin could not be fetched in background
+        """
+        try:
+            await asyncio.wait_for(self._ready_event().wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        if self._twin_error is not None:
+            raise IoTCConnectionError(
+                "Failed to synchronize properties"
+            ) from self._twin_error
+        return True
 
     async def disconnect(self):
         await self._logger.info("Received shutdown signal")
         self._terminate = True
-        if hasattr(self, "_conn_thread") and self._conn_thread is not None:
-            tasks = asyncio.gather(self._conn_thread)
-        try:
-            await tasks
-        except:
-            pass
-        await self._device_client.shutdown()
+        for stream in list(self._streams.values()):
+            stream.close()
+        for task in (self._reconnect_task, self._twin_task):
+            if task is not None and not task.done():
+                task.cancel()
+                with suppress(asyncio.CancelledError):
+                    await task
+        await self._stop_loop_monitor()
+        if self._device_client is not None:
+            await self._device_client.shutdown()
         await self._logger.info("Disconnecting client...")
         await self._logger.info("Client disconnected.")
         await self._logger.info("See you!")
 
     async def _compute_derived_symmetric_key(self, secret, reg_id):
-        # pylint: disable=no-member
+        # derived keys are cached, reconnections do not compute them again
         try:
-            secret = base64.b64decode(secret)
-        except:
-            await self._logger.debug("ERROR: broken base64 secret => `" + secret + "`")
-            sys.exit(2)
-
-        return base64.b64encode(
-            hmac.new(
-                secret, msg=reg_id.encode("utf8"), digestmod=hashlib.sha256
-            ).digest()
-        ).decode("utf-8")
+            return derive_device_key(secret, reg_id)
+        except ValueError as e:
+            raise IoTCConnectionError("Broken base64 group key. {}".format(e)) from e
+
+
+from .fleet import IoTCFleet
+from .provisioning import provision_many
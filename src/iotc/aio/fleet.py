@@ -0,0 +1,213 @@
+import asyncio
+import signal
+
+from .. import IOTCConnectType, IOTCLogLevel
+from ..keys import derive_device_keys
+from ..metrics import MetricsRegistry
+from . import IoTCClient, ConsoleLogger
+
+
+class IoTCFleet:
+    def __init__(
+        self,
+        logger=None,
+        max_concurrent_connects=50,
+        connect_interval=0.0,
+        backoff=None,
+    ):
+        """
+        Run many devices on the same event loop
+        :param logger: Logger shared by the fleet and the devices it creates. Default (console logger)
+        :param int max_concurrent_connects: Maximum number of devices provisioning or connecting at the same time, including reconnections. Default (50)
+        :param float connect_interval: Delay in seconds between starting the connection of two devices. Default (0)
+        :param ExponentialBackoff backoff: Backoff policy shared by all devices. Default (client default)
+        """
+        if logger is None:
+            logger = ConsoleLogger(IOTCLogLevel.IOTC_LOGGING_API_ONLY)
+        self._logger = logger
+        self._max_concurrent_connects = max_concurrent_connects
+        self._connect_interval = connect_interval
+        self._backoff = backoff
+        self._clients = {}
+        self._connect_slots = None
+        self._stop_event = None
+
+    def __len__(self):
+        return len(self._clients)
+
+    def __iter__(self):
+        return iter(self._clients.values())
+
+    def add_device(
+        self,
+        device_id,
+        scope_id,
+        cred_type,
+        key_or_cert,
+        storage=None,
+        max_connection_attempts=5,
+    ):
+        """
+        Create a device client managed by the fleet
+        :returns: The device client
+        :rtype: IoTCClient
+        """
+        client = IoTCClient(
+            device_id,
+            scope_id,
+            cred_type,
+            key_or_cert,
+            logger=self._logger,
+            storage=storage,
+            max_connection_attempts=max_connection_attempts,
+        )
+        return self.add_client(client)
+
+    def add_client(self, client):
+        """
+        Add an existing device client to the fleet
+        :param IoTCClient client: Device client
+        :returns: The device client
+        :rtype: IoTCClient
+        """
+        # the fleet handles process signals for all the devices
+        client._signals_registered = True
+        if self._backoff is not None:
+            client.set_backoff_policy(self._backoff)
+        if self._connect_slots is not None:
+            client._connect_slots = self._connect_slots
+        self._clients[client._device_id] = client
+        return client
+
+    def get_client(self, device_id):
+        return self._clients.get(device_id)
+
+    async def connect(self):
+        """
+        Connect all the devices. Connections are staggered by the connect interval and limited by the maximum number of concurrent connections.
+        Devices failing to connect are reported in the fleet health.
+        """
+        if self._connect_slots is None:
+            self._connect_slots = asyncio.Semaphore(self._max_concurrent_connects)
+            for client in self._clients.values():
+                client._connect_slots = self._connect_slots
+        await self._derive_keys()
+        tasks = []
+        for client in list(self._clients.values()):
+            tasks.append(asyncio.ensure_future(self._connect_client(client)))
+            if self._connect_interval:
+                await asyncio.sleep(self._connect_interval)
+        await asyncio.gather(*tasks)
+        await self._logger.info(
+            "Fleet connected {}/{} devices".format(
+                self.connected_count(), len(self._clients)
+            )
+        )
+
+    async def _derive_keys(self):
+        # derive the keys of group enrollment devices in bulk off the event loop. clients find them in the keys cache
+        groups = {}
+        for client in self._clients.values():
+            if client._cred_type == IOTCConnectType.IOTC_CONNECT_SYMM_KEY:
+                groups.setdefault(client._key_or_cert, []).append(client._device_id)
+        loop = asyncio.get_running_loop()
+        for group_key, device_ids in groups.items():
+            try:
+                await loop.run_in_executor(
+                    None, derive_device_keys, group_key, device_ids
+                )
+            except ValueError as e:
+                await self._logger.info(
+                    "ERROR: broken base64 group key. {}".format(e)
+                )
+
+    async def _connect_client(self, client):
+        try:
+            await client.connect()
+        except Exception as e:
+            await self._logger.info(
+                "ERROR: Device '{}' failed to connect. {}".format(client._device_id, e)
+            )
+
+    async def disconnect(self):
+        """
+        Disconnect all the devices
+        """
+        clients = [
+            client for client in self._clients.values() if not client.terminated()
+        ]
+        results = await asyncio.gather(
+            *[client.disconnect() for client in clients], return_exceptions=True
+        )
+        for client, result in zip(clients, results):
+            if isinstance(result, Exception):
+                await self._logger.info(
+                    "ERROR: Device '{}' failed to disconnect. {}".format(
+                        client._device_id, result
+                    )
+                )
+
+    def health(self):
+        """
+        Get the health of each device in the fleet
+        :returns: Dictionary by device id with connection state, connection status, number of reconnections and last error
+        :rtype: dict
+        """
+        return {
+            device_id: {
+                "state": client.connection_state(),
+                "connected": bool(client.is_connected()),
+                "reconnects": client._reconnects_count,
+                "last_error": None
+                if client._last_error is None
+                else str(client._last_error),
+            }
+            for device_id, client in self._clients.items()
+        }
+
+    def metrics(self):
+        """
+        Get the metrics of all the devices in the fleet, and of their loop monitors
+        :returns: Metrics registry with values summed across devices
+        :rtype: MetricsRegistry
+        """
+        registries = [client.metrics() for client in self._clients.values()]
+        # clients on the same loop share their loop monitor, counted once
+        monitors = {}
+        for client in self._clients.values():
+            monitor = client.loop_monitor()
+            if monitor is not None:
+                monitors[id(monitor)] = monitor
+        registries.extend(monitor.metrics() for monitor in monitors.values())
+        return MetricsRegistry.aggregate(registries)
+
+    def connected_count(self):
+        """
+        Get the number of connected devices
+        :rtype: int
+        """
+        return sum(1 for client in self._clients.values() if client.is_connected())
+
+    async def run(self):
+        """
+        Connect all the devices and keep them running until the process receives SIGINT/SIGTERM or stop() is called
+        """
+        loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except NotImplementedError:
+                signal.signal(
+                    sig, lambda *args: loop.call_soon_threadsafe(self.stop)
+                )
+        await self.connect()
+        await self._stop_event.wait()
+        await self.disconnect()
+
+    def stop(self):
+        """
+        Stop a running fleet
+        """
+        if self._stop_event is not None:
+            self._stop_event.set()
@@ -0,0 +1,184 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+import weakref
+
+from ..metrics import MetricsRegistry
+from ..models import LoopStall
+
+# metrics recorded by the loop monitors. name => (type, help)
+LOOP_METRICS = {
+    "iotc_loop_lag_seconds": ("histogram", "Event loop scheduling lag"),
+    "iotc_loop_stalls_total": ("counter", "Event loop lags over the threshold"),
+}
+
+# one monitor per event loop, shared by the clients running on it. monitors leave when they stop
+_MONITORS = weakref.WeakKeyDictionary()
+
+
+def loop_monitor(interval=0.1, threshold=0.25):
+    """
+    Get the monitor of the running event loop, creating it if needed.
+    Settings are the ones of the first call for a loop.
+    :param float interval: Seconds between lag measurements. Default (0.1)
+    :param float threshold: Lag in seconds above which the loop is stalled. Default (0.25)
+    :rtype: LoopMonitor
+    """
+    loop = asyncio.get_running_loop()
+    monitor = _MONITORS.get(loop)
+    if monitor is None:
+        monitor = _MONITORS[loop] = LoopMonitor(interval, threshold)
+    return monitor
+
+
+class LoopMonitor:
+    """
+    Measure the scheduling lag of an event loop.
+    A task sleeps for the interval and records how late it wakes up. A watchdog thread takes
+    a stack snapshot of the loop thread while it is blocked, reported with the stall once the loop runs again.
+    """
+
+    def __init__(self, interval=0.1, threshold=0.25):
+        self._interval = interval
+        self._threshold = threshold
+        self._metrics = MetricsRegistry(LOOP_METRICS)
+        self._subscribers = []
+        self._loop = None
+        self._task = None
+        self._watchdog = None
+        self._stopped = None
+        self._loop_thread = None
+        self._beat = 0
+        self._beat_time = None
+        self._snapshot = None
+
+    @property
+    def interval(self):
+        return self._interval
+
+    @property
+    def threshold(self):
+        return self._threshold
+
+    def metrics(self):
+        """
+        Get the lag histogram and the stalls counter
+        :rtype: MetricsRegistry
+        """
+        return self._metrics
+
+    def running(self):
+        return self._task is not None
+
+    def subscribe(self, callback):
+        """
+        Call a coroutine function with a LoopStall for each stall. The monitor starts with its first subscriber.
+        Must be called from the monitored loop.
+        """
+        self._subscribers.append(callback)
+        if self._task is None:
+            self._start()
+
+    async def unsubscribe(self, callback):
+        """
+        Remove a subscriber. The monitor stops with its last subscriber
+        """
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+        if not self._subscribers:
+            await self.stop()
+
+    def _start(self):
+        # the loop owns the monitor through _MONITORS, a strong reference back would keep both alive
+        self._loop = weakref.ref(asyncio.get_running_loop())
+        self._loop_thread = threading.get_ident()
+        self._beat_time = time.monotonic()
+        self._stopped = threading.Event()
+        self._task = asyncio.ensure_future(self._measure())
+        self._watchdog = threading.Thread(
+            target=self._watch, args=(self._stopped,), name="iotc-loop-watchdog"
+        )
+        self._watchdog.daemon = True
+        self._watchdog.start()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        self._stopped.set()
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    def _forget(self, loop):
+        if _MONITORS.get(loop) is self:
+            del _MONITORS[loop]
+
+    async def _measure(self):
+        loop = asyncio.get_running_loop()
+        stopped = self._stopped
+        try:
+            while True:
+                beat = self._beat
+                start = loop.time()
+                await asyncio.sleep(self._interval)
+                lag = max(loop.time() - start - self._interval, 0.0)
+                # a new beat starts before reporting, so callbacks are not mistaken for the blocking code
+                self._beat += 1
+                self._beat_time = time.monotonic()
+                self._metrics.observe("iotc_loop_lag_seconds", lag)
+                if lag > self._threshold:
+                    await self._report(lag, beat)
+        finally:
+            # stopped, or cancelled by the loop shutting down with subscribers left
+            stopped.set()
+            if self._task is asyncio.current_task():
+                self._task = None
+            self._forget(loop)
+
+    async def _report(self, lag, beat):
+        self._metrics.inc("iotc_loop_stalls_total")
+        snapshot, self._snapshot = self._snapshot, None
+        if snapshot is not None and snapshot[0] == beat:
+            task, stack = snapshot[1:]
+        else:
+            # stalls shorter than the watchdog period can end before a snapshot is taken
+            task, stack = None, None
+        stall = LoopStall(lag, task, stack)
+        for callback in list(self._subscribers):
+            try:
+                await callback(stall)
+            except Exception:
+                pass
+
+    def _watch(self, stopped):
+        # runs on its own thread, the loop cannot look at itself while it is blocked
+        period = min(self._interval, self._threshold / 2)
+        while not stopped.wait(period):
+            beat = self._beat
+            blocked = time.monotonic() - self._beat_time - self._interval
+            if blocked <= self._threshold:
+                continue
+            if self._snapshot is not None and self._snapshot[0] == beat:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            self._snapshot = (beat, self._blocking_task(), traceback.format_stack(frame))
+            del frame
+
+    def _blocking_task(self):
+        loop = self._loop()
+        if loop is None:
+            return None
+        try:
+            task = asyncio.current_task(loop)
+        except RuntimeError:
+            return None
+        if task is None:
+            return None
+        return task.get_name() if hasattr(task, "get_name") else repr(task)
@@ -0,0 +1,113 @@
+import asyncio
+import time
+
+from .. import IOTCConnectType, IOTCLogLevel
+from ..keys import derive_device_keys
+from ..models import AsyncStorage, ProvisioningResult
+from . import IoTCClient, ConsoleLogger
+from .storage import ExecutorStorage
+
+
+def _device_keys(devices):
+    # decode every group key once and derive the keys of all its devices
+    groups = {}
+    for device in devices:
+        if device.get("cred_type") == IOTCConnectType.IOTC_CONNECT_SYMM_KEY:
+            groups.setdefault(device["key_or_cert"], []).append(device["device_id"])
+    keys = {}
+    for group_key, device_ids in groups.items():
+        keys.update(derive_device_keys(group_key, device_ids))
+    return keys
+
+
+async def provision_many(
+    devices,
+    concurrency=10,
+    storage=None,
+    storage_factory=None,
+    cache=None,
+    model_id=None,
+    global_endpoint=None,
+    logger=None,
+):
+    """
+    Register many devices with the provisioning service in parallel
+    :param list devices: Device definitions. Dictionaries with device_id, scope_id, cred_type and key_or_cert
+    :param int concurrency: Maximum number of registrations in progress. Default (10)
+    :param storage: Storage or AsyncStorage receiving the credentials of every provisioned device. Default (None)
+    :param storage_factory: Function returning the Storage or AsyncStorage of a device from its Id, e.g. SQLiteStorage.device. Default (None)
+    :param dict cache: Results of a previous run by device Id. Devices already provisioned are skipped and new results are added. Default (None)
+    :param str model_id: Model Id to associate to the devices. Default (None)
+    :param str global_endpoint: Custom device provisioning endpoint. Default (None)
+    :param logger: Logger for the registrations. Default (console logger)
+    :returns: Provisioning results by device Id
+    :rtype: dict
+    """
+    results = cache if cache is not None else {}
+    if storage is not None and not isinstance(storage, AsyncStorage):
+        storage = ExecutorStorage(storage)
+
+    def device_storage(device_id):
+        if storage_factory is None:
+            return storage
+        result = storage_factory(device_id)
+        if result is not None and not isinstance(result, AsyncStorage):
+            result = ExecutorStorage(result)
+        return result
+
+    if logger is None:
+        logger = ConsoleLogger(IOTCLogLevel.IOTC_LOGGING_API_ONLY)
+    pending = [
+        device
+        for device in devices
+        if device["device_id"] not in results
+        or not results[device["device_id"]].succeeded
+    ]
+    try:
+        device_keys = await asyncio.get_running_loop().run_in_executor(
+            None, _device_keys, pending
+        )
+    except ValueError as e:
+        await logger.info("ERROR: broken base64 group key. {}".format(e))
+        raise
+    queue = iter(pending)
+
+    async def worker():
+        for device in queue:
+            device_id = device["device_id"]
+            if device_id in device_keys:
+                cred_type = IOTCConnectType.IOTC_CONNECT_DEVICE_KEY
+                key_or_cert = device_keys[device_id]
+            else:
+                cred_type = device["cred_type"]
+                key_or_cert = device["key_or_cert"]
+            client = IoTCClient(
+                device_id,
+                device["scope_id"],
+                cred_type,
+                key_or_cert,
+                logger=logger,
+            )
+            if model_id is not None:
+                client.set_model_id(model_id)
+            if global_endpoint is not None:
+                client.set_global_endpoint(global_endpoint)
+            start = time.perf_counter()
+            try:
+                credentials = await client._provision()
+                target = device_storage(device_id)
+                if target is not None:
+                    await target.persist(credentials)
+                results[device_id] = ProvisioningResult(
+                    device_id, credentials, time.perf_counter() - start
+                )
+            except Exception as e:
+                await logger.info(
+                    "ERROR: Failed to provision device '{}'. {}".format(device_id, e)
+                )
+                results[device_id] = ProvisioningResult(
+                    device_id, duration=time.perf_counter() - start, error=e
+                )
+
+    await asyncio.gather(*[worker() for _ in range(max(concurrency, 1))])
+    return results
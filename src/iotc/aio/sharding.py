@@ -0,0 +1,227 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+
+from .. import IOTCConnectionState
+from ..metrics import MetricsRegistry
+from .fleet import IoTCFleet
+
+
+def shard_devices(devices, shards):
+    """
+    Split devices in shards of similar size
+    :param list devices: Device definitions
+    :param int shards: Number of shards
+    :returns: List of device lists
+    :rtype: list
+    """
+    return [devices[index::shards] for index in range(shards) if devices[index::shards]]
+
+
+def _fleet_stats(worker, fleet):
+    health = fleet.health()
+    return {
+        "worker": worker,
+        "pid": os.getpid(),
+        "timestamp": time.time(),
+        "devices": len(health),
+        "connected": sum(1 for device in health.values() if device["connected"]),
+        "failed": sum(
+            1
+            for device in health.values()
+            if device["state"] == IOTCConnectionState.IOTC_CONNECTION_RETRY_EXPIRED
+        ),
+        "reconnects": sum(device["reconnects"] for device in health.values()),
+        "metrics": fleet.metrics().snapshot(),
+    }
+
+
+def _wait_for_stop(stop_event, exiting, period=0.5):
+    # a process-shared event can't be waited together with a local one, check the worker exit periodically
+    while not exiting.is_set():
+        if stop_event.wait(period):
+            return
+
+
+async def _run_worker(
+    worker, devices, setup, fleet_options, stop_event, stats_queue, report_interval
+):
+    fleet = IoTCFleet(**fleet_options)
+    loop = asyncio.get_running_loop()
+    exiting = threading.Event()
+    stopped = None
+    connecting = None
+    try:
+        for device in devices:
+            client = fleet.add_device(**device)
+            if setup is not None:
+                await setup(client)
+        # wait for the shutdown request from the launcher in an executor thread
+        stopped = loop.run_in_executor(None, _wait_for_stop, stop_event, exiting)
+        connecting = asyncio.ensure_future(fleet.connect())
+        while True:
+            done, _ = await asyncio.wait(
+                [stopped, connecting] if not connecting.done() else [stopped],
+                timeout=report_interval,
+            )
+            stats_queue.put(_fleet_stats(worker, fleet))
+            if stopped in done:
+                break
+    finally:
+        # a waiting executor thread would block the event loop shutdown
+        exiting.set()
+        if connecting is not None:
+            if not connecting.done():
+                connecting.cancel()
+            (result,) = await asyncio.gather(connecting, return_exceptions=True)
+            if isinstance(result, Exception):
+                await fleet._logger.info(
+                    "ERROR: Worker {} failed to connect its devices. {}".format(
+                        worker, result
+                    )
+                )
+        await fleet.disconnect()
+        if stopped is not None:
+            await stopped
+        stats_queue.put(_fleet_stats(worker, fleet))
+
+
+def _worker_main(
+    worker, devices, setup, fleet_options, stop_event, stats_queue, report_interval
+):
+    # the launcher coordinates shutdown of all workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(
+        _run_worker(
+            worker,
+            devices,
+            setup,
+            fleet_options,
+            stop_event,
+            stats_queue,
+            report_interval,
+        )
+    )
+
+
+class FleetLauncher:
+    def __init__(
+        self,
+        devices,
+        processes=None,
+        setup=None,
+        fleet_options=None,
+        report_interval=5.0,
+        start_method="spawn",
+    ):
+        """
+        Shard devices across worker processes, each running an IoTCFleet on its own event loop
+        :param list devices: Device definitions. Dictionaries with IoTCFleet.add_device arguments (device_id, scope_id, cred_type, key_or_cert, ...)
+        :param int processes: Number of worker processes. Default (number of CPUs)
+        :param setup: Module-level coroutine function called with each client before connecting, e.g. to register listeners. Default (None)
+        :param dict fleet_options: IoTCFleet arguments for each worker. Default (None)
+        :param float report_interval: Seconds between stats reports from workers. Default (5.0)
+        :param str start_method: Multiprocessing start method. Default ('spawn')
+        """
+        self._shards = shard_devices(list(devices), processes or os.cpu_count() or 1)
+        self._setup = setup
+        self._fleet_options = fleet_options or {}
+        self._report_interval = report_interval
+        self._context = multiprocessing.get_context(start_method)
+        self._stop_event = self._context.Event()
+        self._stats_queue = self._context.Queue()
+        self._processes = []
+        self._workers_stats = {}
+
+    def start(self):
+        """
+        Start the worker processes
+        """
+        for worker, devices in enumerate(self._shards):
+            process = self._context.Process(
+                target=_worker_main,
+                args=(
+                    worker,
+                    devices,
+                    self._setup,
+                    self._fleet_options,
+                    self._stop_event,
+                    self._stats_queue,
+                    self._report_interval,
+                ),
+                daemon=True,
+            )
+            process.start()
+            self._processes.append(process)
+
+    def _drain_stats(self):
+        while True:
+            try:
+                stats = self._stats_queue.get_nowait()
+            except queue.Empty:
+                return
+            self._workers_stats[stats["worker"]] = stats
+
+    def stats(self):
+        """
+        Get stats aggregated across workers, as last reported by each of them
+        :returns: Dictionary with total devices, connected, failed and reconnects counts plus stats by worker
+        :rtype: dict
+        """
+        self._drain_stats()
+        workers = dict(self._workers_stats)
+        totals = {
+            key: sum(stats[key] for stats in workers.values())
+            for key in ("devices", "connected", "failed", "reconnects")
+        }
+        totals["workers"] = workers
+        totals["alive"] = sum(1 for process in self._processes if process.is_alive())
+        return totals
+
+    def metrics(self):
+        """
+        Get the metrics of all the devices across workers, as last reported by each of them
+        :returns: Metrics registry with values summed across workers
+        :rtype: MetricsRegistry
+        """
+        self._drain_stats()
+        return MetricsRegistry.merge(
+            [stats["metrics"] for stats in self._workers_stats.values()]
+        )
+
+    def stop(self, timeout=30.0):
+        """
+        Ask all the workers to disconnect their devices and wait for them to exit
+        :param float timeout: Seconds to wait for each worker before terminating it. Default (30.0)
+        """
+        self._stop_event.set()
+        deadline = time.monotonic() + timeout
+        for process in self._processes:
+            # keep consuming reports so workers can flush the queue and exit
+            while process.is_alive() and time.monotonic() < deadline:
+                self._drain_stats()
+                process.join(0.1)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self._drain_stats()
+
+    def run(self):
+        """
+        Start the workers and block until SIGINT/SIGTERM, then stop them
+        """
+        stopping = []
+
+        def request_stop(*args):
+            stopping.append(True)
+
+        signal.signal(signal.SIGINT, request_stop)
+        signal.signal(signal.SIGTERM, request_stop)
+        self.start()
+        while not stopping and any(process.is_alive() for process in self._processes):
+            time.sleep(min(self._report_interval, 1.0))
+        self.stop()
@@ -0,0 +1,77 @@
+import asyncio
+import functools
+
+from ..models import AsyncStorage
+
+
+class ExecutorStorage(AsyncStorage):
+    def __init__(self, storage, executor=None):
+        """
+        Run a synchronous storage in an executor so disk or database access does not block the event loop
+        :param Storage storage: Synchronous storage
+        :param executor: Executor running the storage calls. Default (event loop default executor)
+        """
+        self._storage = storage
+        self._executor = executor
+
+    @property
+    def storage(self):
+        return self._storage
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args))
+
+    async def persist(self, credentials):
+        return await self._run(self._storage.persist, credentials)
+
+    async def retrieve(self):
+        return await self._run(self._storage.retrieve)
+
+    async def persist_enqueued_ids(self, message_ids):
+        if hasattr(self._storage, "persist_enqueued_ids"):
+            return await self._run(self._storage.persist_enqueued_ids, message_ids)
+
+    async def retrieve_enqueued_ids(self):
+        if hasattr(self._storage, "retrieve_enqueued_ids"):
+            return await self._run(self._storage.retrieve_enqueued_ids)
+        return None
+
+
+class LoopEnqueuedStorage(object):
+    def __init__(self, storage, loop, message_ids=None):
+        """
+        Persist enqueued command ids to an async storage from any thread, e.g. the one running SDK handlers.
+        Writes run on the given loop one at a time, and only the latest ids are written when writes pile up.
+        :param AsyncStorage storage: Async storage
+        :param loop: Event loop running the writes
+        :param list message_ids: Ids already read from the storage. Default (None)
+        """
+        self._storage = storage
+        self._loop = loop
+        self._message_ids = message_ids
+        self._pending = None
+        self._task = None
+
+    def retrieve_enqueued_ids(self):
+        return self._message_ids
+
+    def persist_enqueued_ids(self, message_ids):
+        self._loop.call_soon_threadsafe(self._schedule, list(message_ids))
+
+    def _schedule(self, message_ids):
+        self._pending = message_ids
+        if self._task is None:
+            self._task = self._loop.create_task(self._write())
+
+    async def _write(self):
+        try:
+            while self._pending is not None:
+                message_ids, self._pending = self._pending, None
+                try:
+                    await self._storage.persist_enqueued_ids(message_ids)
+                except Exception:
+                    # duplicates detection keeps working in memory
+                    pass
+        finally:
+            self._task = None
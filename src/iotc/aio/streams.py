@@ -0,0 +1,92 @@
+import asyncio
+
+_CLOSED = object()
+
+
+class EventStream:
+    """
+    Bounded stream of client events to consume with `async for`.
+    Events never wait for room: when the stream is full, new events are rejected, or replace the oldest
+    waiting event with drop_oldest. Discarded events are counted by dropped().
+    """
+
+    def __init__(self, maxsize=100, on_close=None, drop_oldest=False):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize)
+        self._on_close = on_close
+        self._drop_oldest = drop_oldest
+        self._dropped = 0
+        self._closed = False
+
+    @property
+    def maxsize(self):
+        return self._queue.maxsize
+
+    def qsize(self):
+        """
+        Number of events waiting to be consumed
+        :rtype: int
+        """
+        return self._queue.qsize()
+
+    def dropped(self):
+        """
+        Number of events rejected or replaced because the stream was full
+        :rtype: int
+        """
+        return self._dropped
+
+    def closed(self):
+        return self._closed
+
+    def _offer(self, item):
+        if self._closed:
+            return False
+        if self._queue.full():
+            self._dropped += 1
+            if not self._drop_oldest:
+                return False
+            self._queue.get_nowait()
+        self._queue.put_nowait(item)
+        return True
+
+    async def _offer_async(self, item):
+        return self._offer(item)
+
+    async def put(self, item):
+        """
+        Add an event without waiting for room in the stream
+        :returns: True if the event was queued, False if the stream is closed or full
+        :rtype: bool
+        """
+        if asyncio.get_running_loop() is self._loop:
+            return self._offer(item)
+        # SDK handlers run on their own loop and are never awaited by the SDK. Hand the event over to the
+        # consumer loop, which answers right away instead of piling up waiting puts on the handler loop
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(self._offer_async(item), self._loop)
+        )
+
+    def close(self):
+        """
+        Stop the stream. Pending events are discarded and iteration ends.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._on_close is not None:
+            self._on_close(self)
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._queue.put_nowait(_CLOSED)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._closed and self._queue.empty():
+            raise StopAsyncIteration
+        item = await self._queue.get()
+        if item is _CLOSED:
+            raise StopAsyncIteration
+        return item
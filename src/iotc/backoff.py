@@ -0,0 +1,32 @@
+import random
+
+
+class ExponentialBackoff(object):
+    def __init__(self, initial_delay=1.0, max_delay=60.0, multiplier=2.0, jitter=True):
+        """
+        Delay policy between connection attempts
+        :param float initial_delay: Delay in seconds after the first failed attempt. Default (1.0)
+        :param float max_delay: Maximum delay in seconds. Default (60.0)
+        :param float multiplier: Delay growth factor between attempts. Default (2.0)
+        :param bool jitter: Pick a random delay between 0 and the computed one (full jitter) so devices don't retry in lockstep. Default (True)
+        """
+        self._initial_delay = initial_delay
+        self._max_delay = max_delay
+        self._multiplier = multiplier
+        self._jitter = jitter
+
+    def delay(self, attempt):
+        """
+        Get the delay before the next connection attempt
+        :param int attempt: Number of failed attempts so far, starting from 1
+        :returns: Delay in seconds
+        :rtype: float
+        """
+        try:
+            delay = self._initial_delay * self._multiplier ** max(attempt - 1, 0)
+        except OverflowError:
+            delay = self._max_delay
+        delay = min(delay, self._max_delay)
+        if self._jitter:
+            return random.uniform(0, delay)
+        return delay
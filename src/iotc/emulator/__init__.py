@@ -0,0 +1 @@
+from .hub import LocalHub, TelemetryMessage, generate_certificate
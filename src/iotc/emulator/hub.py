@@ -0,0 +1,589 @@
+import asyncio
+import json
+import os
+import random
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from urllib.parse import quote, unquote
+
+from . import mqtt
+
+
+class TelemetryMessage(object):
+    def __init__(self, device_id, payload, properties, received_at):
+        self.device_id = device_id
+        self.payload = payload
+        self.properties = properties
+        self.received_at = received_at
+
+    def json(self):
+        return json.loads(self.payload)
+
+
+class _Device(object):
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.desired = {"$version": 1}
+        self.reported = {"$version": 1}
+        self.telemetry = []
+        self.session = None
+        self.tokens = None
+        self.tokens_updated = None
+
+
+class _TokenBucket(object):
+    def __init__(self, rate):
+        self._rate = rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+
+    def delay(self):
+        # seconds to wait before the next operation is allowed
+        now = time.monotonic()
+        self._tokens = min(self._rate, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return 0
+        return -self._tokens / self._rate
+
+
+def _properties_from_topic(properties):
+    result = {}
+    for entry in properties.split("&"):
+        if not entry:
+            continue
+        key, _, value = entry.partition("=")
+        result[unquote(key)] = unquote(value)
+    return result
+
+
+def _merge_patch(target, patch):
+    for key, value in patch.items():
+        if key == "$version":
+            continue
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge_patch(target[key], value)
+        else:
+            target[key] = value
+
+
+def generate_certificate(directory, hostname="localhost"):
+    """
+    Generate a self-signed certificate for the local hub with the openssl command line
+    :param str directory: Directory receiving cert.pem and key.pem
+    :param str hostname: Host name in the certificate. Default ('localhost')
+    :returns: Certificate and key file paths
+    :rtype: tuple
+    """
+    if shutil.which("openssl") is None:
+        raise RuntimeError(
+            "openssl command not found. Pass certfile and keyfile to LocalHub"
+        )
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.check_call(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN={}".format(hostname),
+            "-addext",
+            "subjectAltName=DNS:{},IP:127.0.0.1".format(hostname),
+            "-addext",
+            "basicConstraints=critical,CA:TRUE",
+            "-addext",
+            "keyUsage=critical,digitalSignature,keyCertSign",
+            "-keyout",
+            keyfile,
+            "-out",
+            certfile,
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return certfile, keyfile
+
+
+class LocalHub(object):
+    def __init__(
+        self,
+        host="localhost",
+        port=8883,
+        latency=0.0,
+        drop_rate=0.0,
+        max_messages_per_second=None,
+        max_registrations_per_second=None,
+        certfile=None,
+        keyfile=None,
+        seed=None,
+    ):
+        """
+        Local stand-in for IoT Hub and the device provisioning service. An MQTT 3.1.1 broker over TLS
+        emulating provisioning, telemetry, twin, direct methods and cloud-to-device topics.
+        Devices are registered on first provisioning and assigned to this hub.
+        :param str host: Host name for devices to connect, used as provisioning endpoint and assigned hub. Default ('localhost')
+        :param int port: TCP port. The device SDK always connects to 8883. Default (8883)
+        :param float latency: Seconds before answering each request. Default (0)
+        :param float drop_rate: Probability to drop the connection when a message is received. Default (0)
+        :param float max_messages_per_second: Telemetry rate per device above which acknowledgements are delayed. Default (unlimited)
+        :param float max_registrations_per_second: Provisioning rate above which registrations are rejected with 429. Default (unlimited)
+        :param str certfile: Server certificate. Default (self-signed certificate generated with openssl)
+        :param str keyfile: Server certificate key. Default (generated with the certificate)
+        :param int seed: Random seed for reproducible drops. Default (None)
+        """
+        self._host = host
+        self._port = port
+        self._latency = latency
+        self._drop_rate = drop_rate
+        self._max_messages_per_second = max_messages_per_second
+        self._registrations_bucket = (
+            _TokenBucket(max_registrations_per_second)
+            if max_registrations_per_second
+            else None
+        )
+        self._certfile = certfile
+        self._keyfile = keyfile
+        self._random = random.Random(seed)
+        self._devices = {}
+        self._pending_methods = {}
+        self._tasks = set()
+        self._server = None
+        self._tmpdir = None
+        self._loop = None
+        self._thread = None
+        self.stats = {
+            "connections": 0,
+            "registrations": 0,
+            "messages": 0,
+            "dropped": 0,
+            "throttled": 0,
+        }
+
+    @property
+    def endpoint(self):
+        """
+        Host name to pass to the client `set_global_endpoint`
+        :rtype: str
+        """
+        return self._host
+
+    @property
+    def ca_cert(self):
+        """
+        Certificate to pass to the client `set_server_verification_cert`
+        :rtype: str
+        """
+        with open(self._certfile) as fh:
+            return fh.read()
+
+    def set_faults(self, latency=None, drop_rate=None, max_messages_per_second=None):
+        """
+        Change injected faults while running
+        :param float latency: Seconds before answering each request
+        :param float drop_rate: Probability to drop the connection when a message is received
+        :param float max_messages_per_second: Telemetry rate per device above which acknowledgements are delayed. 0 for unlimited
+        """
+        if latency is not None:
+            self._latency = latency
+        if drop_rate is not None:
+            self._drop_rate = drop_rate
+        if max_messages_per_second is not None:
+            self._max_messages_per_second = max_messages_per_second or None
+            for device in self._devices.values():
+                device.tokens = None
+
+    async def start(self):
+        if self._certfile is None:
+            self._tmpdir = tempfile.mkdtemp(prefix="iotc-hub-")
+            self._certfile, self._keyfile = generate_certificate(
+                self._tmpdir, self._host
+            )
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self._certfile, self._keyfile)
+        self._loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(
+            self._handle_connection, self._host, self._port, ssl=context
+        )
+
+    async def stop(self):
+        for device in self._devices.values():
+            if device.session is not None:
+                device.session.close()
+        if self._server is not None:
+            self._server.close()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._server is not None:
+            await self._server.wait_closed()
+            self._server = None
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+            self._certfile = self._keyfile = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.stop()
+
+    def start_background(self):
+        """
+        Run the hub on its own event loop in a background thread, e.g. for synchronous clients
+        """
+        started = threading.Event()
+        errors = []
+
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                loop.run_until_complete(self.start())
+            except Exception as e:
+                errors.append(e)
+                started.set()
+                return
+            started.set()
+            loop.run_forever()
+            loop.run_until_complete(self.stop())
+            loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        if errors:
+            raise errors[0]
+
+    def stop_background(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._thread = None
+
+    def submit(self, coro):
+        """
+        Schedule a hub coroutine from another thread or event loop when the hub runs in background
+        :returns: Future of the coroutine result. Use asyncio.wrap_future to await it from another loop
+        :rtype: concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def run_coroutine(self, coro):
+        """
+        Run a hub coroutine from another thread when the hub runs in background
+        """
+        return self.submit(coro).result()
+
+    def _device(self, device_id):
+        device = self._devices.get(device_id)
+        if device is None:
+            device = self._devices[device_id] = _Device(device_id)
+        return device
+
+    def devices(self):
+        """
+        Get the Ids of registered devices
+        :rtype: list
+        """
+        return list(self._devices)
+
+    def connected_devices(self):
+        """
+        Get the Ids of devices connected to the hub
+        :rtype: list
+        """
+        return [
+            device_id
+            for device_id, device in self._devices.items()
+            if device.session is not None and not device.session.closed()
+        ]
+
+    def telemetry(self, device_id):
+        """
+        Get telemetry messages received from a device
+        :rtype: list
+        """
+        return self._device(device_id).telemetry
+
+    def reported_properties(self, device_id):
+        """
+        Get the reported properties of a device
+        :rtype: dict
+        """
+        return self._device(device_id).reported
+
+    async def update_desired_properties(self, device_id, patch):
+        """
+        Update desired properties and send the patch to the device if connected
+        :param str device_id: Device Id
+        :param dict patch: Desired properties patch
+        """
+        device = self._device(device_id)
+        _merge_patch(device.desired, patch)
+        device.desired["$version"] += 1
+        patch = dict(patch, **{"$version": device.desired["$version"]})
+        if device.session is not None:
+            device.session.publish(
+                "$iothub/twin/PATCH/properties/desired/?$version={}".format(
+                    device.desired["$version"]
+                ),
+                json.dumps(patch),
+                qos=0,
+            )
+
+    async def invoke_method(self, device_id, method_name, payload=None, timeout=30):
+        """
+        Invoke a direct method on a connected device
+        :returns: Response status and payload
+        :rtype: tuple
+        :raises LookupError: If the device is not connected or not listening to methods
+        """
+        device = self._device(device_id)
+        request_id = uuid.uuid4().hex
+        response = self._loop.create_future()
+        self._pending_methods[request_id] = response
+        try:
+            if device.session is None or not device.session.publish(
+                "$iothub/methods/POST/{}/?$rid={}".format(method_name, request_id),
+                json.dumps(payload),
+                qos=0,
+            ):
+                raise LookupError(
+                    "Device '{}' is not listening to methods".format(device_id)
+                )
+            return await asyncio.wait_for(response, timeout)
+        finally:
+            self._pending_methods.pop(request_id, None)
+
+    async def send_c2d(self, device_id, payload, properties=None, message_id=None):
+        """
+        Send a cloud-to-device message to a connected device
+        :raises LookupError: If the device is not connected or not listening to messages
+        """
+        device = self._device(device_id)
+        properties = dict(properties or {})
+        properties["$.mid"] = message_id or str(uuid.uuid4())
+        topic = "devices/{}/messages/devicebound/{}".format(
+            device_id,
+            "&".join(
+                "{}={}".format(quote(key, safe=""), quote(str(value), safe=""))
+                for key, value in properties.items()
+            ),
+        )
+        if isinstance(payload, (dict, list)):
+            payload = json.dumps(payload)
+        if device.session is None or not device.session.publish(topic, payload):
+            raise LookupError(
+                "Device '{}' is not listening to messages".format(device_id)
+            )
+
+    async def disconnect_device(self, device_id):
+        """
+        Drop the connection of a device
+        """
+        device = self._device(device_id)
+        if device.session is not None:
+            device.session.close()
+
+    async def disconnect_all(self):
+        """
+        Drop the connection of all devices
+        """
+        for device_id in self.connected_devices():
+            await self.disconnect_device(device_id)
+
+    async def _handle_connection(self, reader, writer):
+        self._track(asyncio.current_task())
+        session = None
+        try:
+            packet_type, _, body = await mqtt.read_packet(reader)
+            if packet_type != mqtt.CONNECT:
+                return
+            connect = mqtt.parse_connect(body)
+            session = mqtt.Session(reader, writer, connect)
+            self.stats["connections"] += 1
+            is_provisioning = "/registrations/" in (connect.username or "")
+            if not is_provisioning:
+                device = self._device(connect.client_id)
+                if device.session is not None:
+                    # a new connection replaces the previous one as in IoT Hub
+                    device.session.close()
+                device.session = session
+            await self._delay()
+            session.send(mqtt.connack(mqtt.CONNACK_ACCEPTED))
+            while True:
+                packet_type, flags, body = await mqtt.read_packet(reader)
+                if packet_type == mqtt.PUBLISH:
+                    message = mqtt.parse_publish(flags, body)
+                    if self._should_drop():
+                        self.stats["dropped"] += 1
+                        return
+                    if is_provisioning:
+                        self._spawn(self._handle_provisioning(session, message))
+                    else:
+                        self._spawn(self._handle_hub(session, message))
+                elif packet_type == mqtt.SUBSCRIBE:
+                    packet_id, topics = mqtt.parse_subscribe(body)
+                    session.subscriptions.extend(topic for topic, _ in topics)
+                    session.send(
+                        mqtt.suback(packet_id, [min(qos, 1) for _, qos in topics])
+                    )
+                elif packet_type == mqtt.UNSUBSCRIBE:
+                    packet_id, topics = mqtt.parse_unsubscribe(body)
+                    session.subscriptions = [
+                        topic for topic in session.subscriptions if topic not in topics
+                    ]
+                    session.send(mqtt.unsuback(packet_id))
+                elif packet_type == mqtt.PINGREQ:
+                    session.send(mqtt.pingresp())
+                elif packet_type == mqtt.DISCONNECT:
+                    return
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+            pass
+        except mqtt.MQTTProtocolError:
+            pass
+        finally:
+            if session is not None:
+                session.close()
+                device = self._devices.get(session.client_id)
+                if device is not None and device.session is session:
+                    device.session = None
+            elif not writer.is_closing():
+                writer.close()
+
+    def _spawn(self, coro):
+        # answers are sent concurrently, latency does not block the connection
+        self._track(asyncio.ensure_future(coro))
+
+    def _track(self, task):
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _should_drop(self):
+        return self._drop_rate and self._random.random() < self._drop_rate
+
+    async def _delay(self, extra=0.0):
+        delay = self._latency + extra
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _handle_provisioning(self, session, message):
+        path, _, query = message.topic.partition("?")
+        properties = _properties_from_topic(query)
+        request_id = properties.get("$rid")
+        if self._registrations_bucket is not None and self._registrations_bucket.delay():
+            self.stats["throttled"] += 1
+            await self._delay()
+            session.send(
+                mqtt.publish(
+                    "$dps/registrations/res/429/?$rid={}&retry-after=1".format(
+                        request_id
+                    ),
+                    json.dumps({"errorCode": 429001, "message": "Throttled"}),
+                )
+            )
+            return
+        registration_id = session.client_id
+        self._device(registration_id)
+        self.stats["registrations"] += 1
+        now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        response = {
+            "operationId": properties.get("operationId") or uuid.uuid4().hex,
+            "status": "assigned",
+            "registrationState": {
+                "registrationId": registration_id,
+                "createdDateTimeUtc": now,
+                "assignedHub": self._host,
+                "deviceId": registration_id,
+                "status": "assigned",
+                "substatus": "initialAssignment",
+                "lastUpdatedDateTimeUtc": now,
+                "etag": uuid.uuid4().hex,
+            },
+        }
+        await self._delay()
+        session.send(
+            mqtt.publish(
+                "$dps/registrations/res/200/?$rid={}".format(request_id),
+                json.dumps(response),
+            )
+        )
+
+    async def _handle_hub(self, session, message):
+        device = self._device(session.client_id)
+        topic = message.topic
+        if topic.startswith("devices/"):
+            await self._handle_telemetry(session, device, message)
+        elif topic.startswith("$iothub/twin/"):
+            await self._handle_twin(session, device, message)
+        elif topic.startswith("$iothub/methods/res/"):
+            path, _, query = topic.partition("?")
+            status = int(path.split("/")[3])
+            response = self._pending_methods.get(
+                _properties_from_topic(query).get("$rid")
+            )
+            if response is not None and not response.done():
+                payload = json.loads(message.payload) if message.payload else None
+                response.set_result((status, payload))
+        if message.qos and not topic.startswith("devices/"):
+            session.send(mqtt.puback(message.packet_id))
+
+    async def _handle_telemetry(self, session, device, message):
+        _, _, properties = message.topic.partition("/messages/events/")
+        device.telemetry.append(
+            TelemetryMessage(
+                device.device_id,
+                message.payload,
+                _properties_from_topic(properties),
+                time.time(),
+            )
+        )
+        self.stats["messages"] += 1
+        throttle = 0
+        if self._max_messages_per_second:
+            if device.tokens is None:
+                device.tokens = _TokenBucket(self._max_messages_per_second)
+            throttle = device.tokens.delay()
+            if throttle:
+                self.stats["throttled"] += 1
+        await self._delay(throttle)
+        if message.qos:
+            session.send(mqtt.puback(message.packet_id))
+
+    async def _handle_twin(self, session, device, message):
+        path, _, query = message.topic.partition("?")
+        request_id = _properties_from_topic(query).get("$rid")
+        await self._delay()
+        if path == "$iothub/twin/GET/":
+            session.send(
+                mqtt.publish(
+                    "$iothub/twin/res/200/?$rid={}".format(request_id),
+                    json.dumps({"desired": device.desired, "reported": device.reported}),
+                )
+            )
+        elif path == "$iothub/twin/PATCH/properties/reported/":
+            _merge_patch(device.reported, json.loads(message.payload))
+            device.reported["$version"] += 1
+            session.send(
+                mqtt.publish(
+                    "$iothub/twin/res/204/?$rid={}&$version={}".format(
+                        request_id, device.reported["$version"]
+                    ),
+                    b"",
+                )
+            )
@@ -0,0 +1,245 @@
+import asyncio
+import struct
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+CONNACK_ACCEPTED = 0
+CONNACK_NOT_AUTHORIZED = 5
+
+
+class MQTTProtocolError(Exception):
+    pass
+
+
+class Connect(object):
+    def __init__(self, client_id, username, password, keepalive):
+        self.client_id = client_id
+        self.username = username
+        self.password = password
+        self.keepalive = keepalive
+
+
+class Publish(object):
+    def __init__(self, topic, payload, qos=0, packet_id=None):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.packet_id = packet_id
+
+
+def _encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+
+def _encode_string(value):
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return struct.pack("!H", len(value)) + value
+
+
+def _packet(packet_type, flags, body):
+    return bytes([(packet_type << 4) | flags]) + _encode_length(len(body)) + body
+
+
+async def read_packet(reader):
+    """
+    Read a control packet
+    :returns: Packet type, flags and body
+    :rtype: tuple
+    """
+    header = await reader.readexactly(1)
+    multiplier = 1
+    length = 0
+    for _ in range(4):
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+    else:
+        raise MQTTProtocolError("Malformed remaining length")
+    body = await reader.readexactly(length) if length else b""
+    return header[0] >> 4, header[0] & 0x0F, body
+
+
+class _Body(object):
+    def __init__(self, data):
+        self._data = data
+        self._offset = 0
+
+    def remaining(self):
+        return len(self._data) - self._offset
+
+    def read(self, size):
+        value = self._data[self._offset : self._offset + size]
+        if len(value) < size:
+            raise MQTTProtocolError("Truncated packet")
+        self._offset += size
+        return value
+
+    def read_uint16(self):
+        return struct.unpack("!H", self.read(2))[0]
+
+    def read_bytes(self):
+        return self.read(self.read_uint16())
+
+    def read_string(self):
+        return self.read_bytes().decode("utf-8")
+
+    def rest(self):
+        value = self._data[self._offset :]
+        self._offset = len(self._data)
+        return value
+
+
+def parse_connect(body):
+    body = _Body(body)
+    protocol = body.read_string()
+    level = body.read(1)[0]
+    if protocol != "MQTT" or level != 4:
+        raise MQTTProtocolError("Only MQTT 3.1.1 is supported")
+    flags = body.read(1)[0]
+    keepalive = body.read_uint16()
+    client_id = body.read_string()
+    if flags & 0x04:
+        # will topic and message are not used by the device SDK
+        body.read_string()
+        body.read_bytes()
+    username = body.read_string() if flags & 0x80 else None
+    password = body.read_bytes().decode("utf-8") if flags & 0x40 else None
+    return Connect(client_id, username, password, keepalive)
+
+
+def parse_publish(flags, body):
+    qos = (flags >> 1) & 0x03
+    body = _Body(body)
+    topic = body.read_string()
+    packet_id = body.read_uint16() if qos else None
+    return Publish(topic, body.rest(), qos, packet_id)
+
+
+def parse_subscribe(body):
+    body = _Body(body)
+    packet_id = body.read_uint16()
+    topics = []
+    while body.remaining():
+        topics.append((body.read_string(), body.read(1)[0]))
+    return packet_id, topics
+
+
+def parse_unsubscribe(body):
+    body = _Body(body)
+    packet_id = body.read_uint16()
+    topics = []
+    while body.remaining():
+        topics.append(body.read_string())
+    return packet_id, topics
+
+
+def parse_packet_id(body):
+    return _Body(body).read_uint16()
+
+
+def connack(return_code):
+    return _packet(CONNACK, 0, bytes([0, return_code]))
+
+
+def publish(topic, payload, qos=0, packet_id=None):
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    body = _encode_string(topic)
+    if qos:
+        body += struct.pack("!H", packet_id)
+    return _packet(PUBLISH, qos << 1, body + payload)
+
+
+def puback(packet_id):
+    return _packet(PUBACK, 0, struct.pack("!H", packet_id))
+
+
+def suback(packet_id, granted_qos):
+    return _packet(SUBACK, 0, struct.pack("!H", packet_id) + bytes(granted_qos))
+
+
+def unsuback(packet_id):
+    return _packet(UNSUBACK, 0, struct.pack("!H", packet_id))
+
+
+def pingresp():
+    return _packet(PINGRESP, 0, b"")
+
+
+def topic_matches(topic_filter, topic):
+    """
+    Check if a topic matches a subscription filter with + and # wildcards
+    :rtype: bool
+    """
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[index]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class Session(object):
+    def __init__(self, reader, writer, connect):
+        self.reader = reader
+        self.writer = writer
+        self.client_id = connect.client_id
+        self.username = connect.username
+        self.subscriptions = []
+        self._packet_id = 0
+        self._closed = asyncio.Event()
+
+    def is_subscribed(self, topic):
+        return any(topic_matches(topic_filter, topic) for topic_filter in self.subscriptions)
+
+    def next_packet_id(self):
+        self._packet_id = self._packet_id % 65535 + 1
+        return self._packet_id
+
+    def send(self, packet):
+        if not self.writer.is_closing():
+            self.writer.write(packet)
+
+    def publish(self, topic, payload, qos=1):
+        """
+        Publish a message to the client if it subscribed to the topic
+        :returns: False if the client is not subscribed
+        :rtype: bool
+        """
+        if not self.is_subscribed(topic):
+            return False
+        self.send(publish(topic, payload, qos, self.next_packet_id() if qos else None))
+        return True
+
+    def close(self):
+        if not self.writer.is_closing():
+            self.writer.close()
+        self._closed.set()
+
+    def closed(self):
+        return self._closed.is_set()
@@ -0,0 +1,89 @@
+import base64
+import functools
+import hashlib
+import hmac
+import threading
+from collections import OrderedDict
+
+_CACHE_SIZE = 65536
+_cache_lock = threading.Lock()
+_device_keys = OrderedDict()
+
+
+@functools.lru_cache(maxsize=128)
+def _decode(group_key):
+    return base64.b64decode(group_key)
+
+
+def _derive(secret, device_id):
+    return base64.b64encode(
+        hmac.new(secret, msg=device_id.encode("utf8"), digestmod=hashlib.sha256).digest()
+    ).decode("utf-8")
+
+
+def _cache_get(group_key, device_id):
+    with _cache_lock:
+        device_key = _device_keys.get((group_key, device_id))
+        if device_key is not None:
+            _device_keys.move_to_end((group_key, device_id))
+        return device_key
+
+
+def _cache_set(group_key, keys):
+    with _cache_lock:
+        for device_id, device_key in keys.items():
+            _device_keys[(group_key, device_id)] = device_key
+            _device_keys.move_to_end((group_key, device_id))
+        while len(_device_keys) > _CACHE_SIZE:
+            _device_keys.popitem(last=False)
+
+
+def clear_cache():
+    """
+    Forget all the derived keys and decoded group keys
+    """
+    with _cache_lock:
+        _device_keys.clear()
+    _decode.cache_clear()
+
+
+def derive_device_key(group_key, device_id):
+    """
+    Compute the device key from a group enrollment key. Keys are cached by group key and device Id.
+    :param str group_key: Base64 group enrollment key
+    :param str device_id: Device Id
+    :returns: Base64 device key
+    :rtype: str
+    :raises ValueError: If the group key is not valid base64
+    """
+    device_key = _cache_get(group_key, device_id)
+    if device_key is None:
+        device_key = _derive(_decode(group_key), device_id)
+        _cache_set(group_key, {device_id: device_key})
+    return device_key
+
+
+def derive_device_keys(group_key, device_ids):
+    """
+    Compute the device keys of many devices from a group enrollment key, decoding the group key once.
+    Derived keys are added to the cache. CPU bound, can run in an executor for large fleets.
+    :param str group_key: Base64 group enrollment key
+    :param list device_ids: Device Ids
+    :returns: Base64 device keys by device Id
+    :rtype: dict
+    :raises ValueError: If the group key is not valid base64
+    """
+    keys = {}
+    missing = []
+    for device_id in device_ids:
+        device_key = _cache_get(group_key, device_id)
+        if device_key is None:
+            missing.append(device_id)
+        else:
+            keys[device_id] = device_key
+    if missing:
+        secret = _decode(group_key)
+        derived = {device_id: _derive(secret, device_id) for device_id in missing}
+        _cache_set(group_key, derived)
+        keys.update(derived)
+    return keys
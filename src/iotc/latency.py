@@ -0,0 +1,176 @@
+import itertools
+import math
+import time
+import uuid
+
+SEQUENCE = "iotc-seq"
+TIMESTAMP = "iotc-ts"
+STREAM = "iotc-stream"
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    """
+    Compute percentiles with the nearest-rank method
+    :param list samples: Values
+    :param tuple points: Percentiles to compute. Default ((50, 90, 99))
+    :returns: Values by percentile, None for all of them if there are no samples
+    :rtype: dict
+    """
+    ordered = sorted(samples)
+    result = {}
+    for point in points:
+        if not ordered:
+            result[point] = None
+            continue
+        rank = max(int(math.ceil(point / 100.0 * len(ordered))), 1)
+        result[point] = ordered[rank - 1]
+    return result
+
+
+def summarize(samples):
+    """
+    Summarize latency samples
+    :returns: count, p50, p90, p99 and max. Values are None if there are no samples
+    :rtype: dict
+    """
+    summary = {"count": len(samples)}
+    for point, value in percentiles(samples).items():
+        summary["p{}".format(point)] = value
+    summary["max"] = max(samples) if samples else None
+    return summary
+
+
+def new_stream():
+    """
+    Start a new stream of stamped messages
+    :returns: Stream Id and sequence numbers generator starting at 0
+    :rtype: tuple
+    """
+    return uuid.uuid4().hex[:8], itertools.count()
+
+
+def stamp(properties, stream, sequence, timestamp=None):
+    """
+    Stamp message properties with a stream Id, a sequence number and the creation time
+    :param dict properties: Message custom properties
+    :param str stream: Stream Id
+    :param int sequence: Sequence number in the stream
+    :param float timestamp: Creation time in seconds since the epoch. Default (now)
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    properties[STREAM] = stream
+    properties[SEQUENCE] = str(sequence)
+    properties[TIMESTAMP] = "{:.3f}".format(timestamp * 1000)
+
+
+def _decode(value):
+    # event hubs consumers receive application properties as bytes
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value
+
+
+class _Stream(object):
+    __slots__ = ("highest", "missing")
+
+    def __init__(self):
+        self.highest = -1
+        self.missing = set()
+
+
+class LatencyTracker(object):
+    def __init__(self):
+        """
+        Measure end-to-end latency of stamped telemetry and detect lost, duplicated and reordered messages.
+        Devices stamp messages with set_latency_stamping. Latency relies on device and consumer clocks being synchronized.
+        """
+        self.reset()
+
+    def reset(self):
+        """
+        Forget all received messages and latency samples
+        """
+        self._streams = {}
+        self._latencies = []
+        self._messages = 0
+        self._unstamped = 0
+        self._gaps = 0
+        self._duplicates = 0
+        self._reordered = 0
+
+    def add(self, device_id, properties, received_at=None):
+        """
+        Track a received message
+        :param str device_id: Id of the device which sent the message
+        :param dict properties: Message application properties
+        :param float received_at: Receive time in seconds since the epoch. Default (now)
+        :returns: Latency in seconds, or None if the message is not stamped or is a duplicate
+        :rtype: float
+        """
+        if received_at is None:
+            received_at = time.time()
+        self._messages += 1
+        properties = {_decode(key): _decode(value) for key, value in properties.items()}
+        try:
+            key = (_decode(device_id), properties[STREAM])
+            sequence = int(properties[SEQUENCE])
+            timestamp = float(properties[TIMESTAMP]) / 1000
+        except (KeyError, ValueError):
+            self._unstamped += 1
+            return None
+        stream = self._streams.get(key)
+        if stream is None:
+            stream = self._streams[key] = _Stream()
+        if sequence > stream.highest:
+            if sequence > stream.highest + 1:
+                self._gaps += 1
+                stream.missing.update(range(stream.highest + 1, sequence))
+            stream.highest = sequence
+        elif sequence in stream.missing:
+            stream.missing.discard(sequence)
+            self._reordered += 1
+        else:
+            self._duplicates += 1
+            return None
+        latency = received_at - timestamp
+        self._latencies.append(latency)
+        return latency
+
+    def add_message(self, message):
+        """
+        Track a message received by a local hub
+        :param TelemetryMessage message: Message from LocalHub.telemetry
+        :returns: Latency in seconds, or None if the message is not stamped or is a duplicate
+        :rtype: float
+        """
+        return self.add(message.device_id, message.properties, message.received_at)
+
+    def missing(self):
+        """
+        Get the sequence numbers not received yet
+        :returns: Sorted missing sequence numbers by (device Id, stream Id)
+        :rtype: dict
+        """
+        return {
+            key: sorted(stream.missing)
+            for key, stream in self._streams.items()
+            if stream.missing
+        }
+
+    def report(self):
+        """
+        Summarize the tracked messages
+        :returns: Message counts, latency percentiles in seconds and delivery anomalies. Gaps are jumps in sequence numbers, and missing counts the messages still not received
+        :rtype: dict
+        """
+        return {
+            "messages": self._messages,
+            "devices": len(set(device_id for device_id, _ in self._streams)),
+            "unstamped": self._unstamped,
+            "latency": summarize(self._latencies),
+            "gaps": self._gaps,
+            "missing": sum(len(stream.missing) for stream in self._streams.values()),
+            "duplicates": self._duplicates,
+            "reordered": self._reordered,
+        }
@@ -0,0 +1,342 @@
+import argparse
+import asyncio
+import base64
+import functools
+import json
+import os
+import random
+import sys
+import time
+
+from . import IOTCConnectType, IOTCEvents, IOTCLogLevel
+from .latency import summarize
+
+
+def make_payload(size, sequence=0):
+    """
+    Build a telemetry payload whose JSON encoding is about `size` bytes
+    :rtype: dict
+    """
+    payload = {"seq": sequence, "data": ""}
+    padding = size - len(json.dumps(payload))
+    if padding > 0:
+        payload["data"] = "x" * padding
+    return payload
+
+
+class LoadGenerator:
+    def __init__(
+        self,
+        fleet,
+        telemetry_rate=1.0,
+        payload_size=256,
+        property_rate=0.0,
+        command_rate=0.0,
+        desired_rate=0.0,
+        duration=60.0,
+        hub=None,
+        seed=None,
+    ):
+        """
+        Drive the devices of a fleet with telemetry, property updates and commands and measure them
+        :param IoTCFleet fleet: Fleet of devices to drive
+        :param float telemetry_rate: Telemetry messages per second per device. Default (1.0)
+        :param int payload_size: Approximate telemetry payload size in bytes. Default (256)
+        :param float property_rate: Reported property updates per second per device. Default (0)
+        :param float command_rate: Direct method invocations per second per device. Requires a local hub. Default (0)
+        :param float desired_rate: Desired property updates per second per device. Requires a local hub. Default (0)
+        :param float duration: Seconds to run after the devices are connected. Default (60.0)
+        :param LocalHub hub: Local hub the devices are connected to, running in background. Default (None)
+        :param int seed: Random seed for the devices start offsets. Default (None)
+        """
+        if command_rate and hub is None:
+            raise ValueError("Commands can only be invoked through a local hub")
+        if desired_rate and hub is None:
+            raise ValueError("Desired properties can only be updated through a local hub")
+        self._fleet = fleet
+        self._telemetry_rate = telemetry_rate
+        self._payload_size = payload_size
+        self._property_rate = property_rate
+        self._command_rate = command_rate
+        self._desired_rate = desired_rate
+        self._duration = duration
+        self._hub = hub
+        self._random = random.Random(seed)
+        self._latencies = {"telemetry": [], "property": [], "command": [], "desired": []}
+        self._failures = {"telemetry": 0, "property": 0, "command": 0, "desired": 0}
+        # desired updates waiting for their device, by device id and sequence
+        self._desired = {}
+        self._payload_bytes = 0
+        self._deadline = None
+
+    async def run(self):
+        """
+        Connect the fleet, run the load for the configured duration and disconnect
+        :returns: Report with achieved throughput and latency percentiles in seconds
+        :rtype: dict
+        """
+        for client in self._fleet:
+            client.on(IOTCEvents.IOTC_COMMAND, self._on_command)
+            if self._desired_rate:
+                client.on(
+                    IOTCEvents.IOTC_PROPERTIES,
+                    functools.partial(self._on_properties, client._device_id),
+                )
+        start = time.perf_counter()
+        await self._fleet.connect()
+        connect_time = time.perf_counter() - start
+        clients = [client for client in self._fleet if client.is_connected()]
+        self._deadline = time.monotonic() + self._duration
+        tasks = []
+        for client in clients:
+            if self._telemetry_rate:
+                tasks.append(self._loop(client, self._telemetry_rate, self._send_telemetry))
+            if self._property_rate:
+                tasks.append(self._loop(client, self._property_rate, self._send_property))
+            if self._command_rate:
+                tasks.append(self._loop(client, self._command_rate, self._invoke_command))
+            if self._desired_rate:
+                tasks.append(self._loop(client, self._desired_rate, self._update_desired))
+        start = time.perf_counter()
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            elapsed = time.perf_counter() - start
+            await self._fleet.disconnect()
+        return self._report(len(clients), connect_time, elapsed)
+
+    async def _on_command(self, command):
+        await command.reply()
+
+    async def _on_properties(self, device_id, prop):
+        if prop.name == "loadgenDesired":
+            delivered = self._desired.get((device_id, prop.value))
+            if delivered is not None:
+                # handlers may run on the device SDK loop
+                delivered.get_loop().call_soon_threadsafe(_resolve, delivered)
+        return True
+
+    async def _loop(self, client, rate, operation):
+        # fixed schedule, late operations are sent right away instead of drifting
+        interval = 1.0 / rate
+        next_time = time.monotonic() + self._random.uniform(0, interval)
+        sequence = 0
+        while next_time < self._deadline:
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await operation(client, sequence)
+            sequence += 1
+            next_time += interval
+
+    async def _measure(self, kind, coro):
+        start = time.perf_counter()
+        try:
+            await coro
+        except Exception:
+            self._failures[kind] += 1
+            return False
+        self._latencies[kind].append(time.perf_counter() - start)
+        return True
+
+    async def _send_telemetry(self, client, sequence):
+        payload = make_payload(self._payload_size, sequence)
+        if await self._measure("telemetry", client.send_telemetry(payload)):
+            # encoded json bodies only, without MQTT headers and message properties
+            self._payload_bytes += len(json.dumps(payload).encode("utf-8"))
+
+    async def _send_property(self, client, sequence):
+        await self._measure("property", client.send_property({"loadgenCounter": sequence}))
+
+    async def _invoke_command(self, client, sequence):
+        invocation = self._hub.submit(
+            self._hub.invoke_method(client._device_id, "loadgen", {"seq": sequence}, timeout=30)
+        )
+        await self._measure("command", asyncio.wrap_future(invocation))
+
+    async def _update_desired(self, client, sequence):
+        device_id = client._device_id
+        delivered = asyncio.get_running_loop().create_future()
+        self._desired[(device_id, sequence)] = delivered
+
+        async def update():
+            await asyncio.wrap_future(
+                self._hub.submit(
+                    self._hub.update_desired_properties(device_id, {"loadgenDesired": sequence})
+                )
+            )
+            await asyncio.wait_for(delivered, 30)
+
+        try:
+            # from the hub update until the device handler receives it
+            await self._measure("desired", update())
+        finally:
+            del self._desired[(device_id, sequence)]
+
+    def _report(self, connected, connect_time, elapsed):
+        metrics = self._fleet.metrics().snapshot()["counters"]
+        messages = len(self._latencies["telemetry"])
+        return {
+            "devices": len(self._fleet),
+            "connected": connected,
+            "connect_seconds": connect_time,
+            "duration_seconds": elapsed,
+            "messages": messages,
+            "messages_per_second": messages / elapsed if elapsed else 0.0,
+            "payload_bytes_per_second": self._payload_bytes / elapsed if elapsed else 0.0,
+            "reconnects": metrics.get("iotc_reconnects_total", 0),
+            "connect_failures": metrics.get("iotc_connect_failures_total", 0),
+            "failures": dict(self._failures),
+            "latency": {kind: summarize(samples) for kind, samples in self._latencies.items()},
+        }
+
+
+def format_report(report):
+    """
+    Format a load generator report as text
+    :rtype: str
+    """
+    lines = [
+        "Devices connected: {}/{} in {:.2f}s".format(
+            report["connected"], report["devices"], report["connect_seconds"]
+        ),
+        "Duration: {:.2f}s".format(report["duration_seconds"]),
+        "Telemetry: {} messages, {:.1f} msg/s, {:.1f} payload KB/s".format(
+            report["messages"],
+            report["messages_per_second"],
+            report["payload_bytes_per_second"] / 1024,
+        ),
+        "Reconnects: {}, connection failures: {}".format(
+            report["reconnects"], report["connect_failures"]
+        ),
+        "{:<10}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}".format(
+            "latency", "count", "p50 ms", "p90 ms", "p99 ms", "max ms", "failed"
+        ),
+    ]
+    for kind, summary in report["latency"].items():
+        if not summary["count"] and not report["failures"][kind]:
+            continue
+        values = [
+            "{:.2f}".format(summary[key] * 1000) if summary[key] is not None else "-"
+            for key in ("p50", "p90", "p99", "max")
+        ]
+        lines.append(
+            "{:<10}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}".format(
+                kind, summary["count"], *values, report["failures"][kind]
+            )
+        )
+    return "\n".join(lines)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog="iotc-loadgen",
+        description="Simulate a fleet of IoT Central devices and measure throughput and latency",
+    )
+    parser.add_argument("-n", "--devices", type=int, default=10, help="Number of simulated devices. Default (10)")
+    parser.add_argument("--prefix", default="loadgen-", help="Device Id prefix. Default ('loadgen-')")
+    parser.add_argument("--rate", type=float, default=1.0, help="Telemetry messages per second per device. Default (1)")
+    parser.add_argument("--payload-size", type=int, default=256, help="Telemetry payload size in bytes. Default (256)")
+    parser.add_argument("--property-rate", type=float, default=0.0, help="Reported property updates per second per device. Default (0)")
+    parser.add_argument("--command-rate", type=float, default=0.0, help="Direct method invocations per second per device, with --local only. Default (0)")
+    parser.add_argument("--desired-rate", type=float, default=0.0, help="Desired property updates per second per device, with --local only. Default (0)")
+    parser.add_argument("--duration", type=float, default=60.0, help="Seconds to run after connecting. Default (60)")
+    parser.add_argument("--max-concurrent-connects", type=int, default=50, help="Devices connecting at the same time. Default (50)")
+    parser.add_argument("--connect-interval", type=float, default=0.0, help="Seconds between device connections. Default (0)")
+    parser.add_argument("--scope-id", help="IoT Central application scope Id")
+    parser.add_argument("--group-key", help="Group enrollment key. Device keys are derived from it")
+    parser.add_argument("--endpoint", help="Device provisioning endpoint")
+    parser.add_argument("--model-id", help="Model Id for the devices")
+    parser.add_argument("--local", action="store_true", help="Run against a local hub instead of IoT Central")
+    parser.add_argument("--hub-latency", type=float, default=0.0, help="Local hub latency in seconds. Default (0)")
+    parser.add_argument("--hub-drop-rate", type=float, default=0.0, help="Local hub connection drop probability per message. Default (0)")
+    parser.add_argument("--hub-max-messages-per-second", type=float, help="Local hub telemetry rate per device above which acknowledgements are delayed")
+    parser.add_argument("--seed", type=int, help="Random seed")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log client messages")
+    return parser
+
+
+async def _run(args):
+    from .aio import ConsoleLogger, IoTCFleet
+
+    hub = None
+    scope_id = args.scope_id
+    group_key = args.group_key
+    if args.local:
+        from .emulator import LocalHub
+
+        hub = LocalHub(
+            latency=args.hub_latency,
+            drop_rate=args.hub_drop_rate,
+            max_messages_per_second=args.hub_max_messages_per_second,
+            seed=args.seed,
+        )
+        hub.start_background()
+        scope_id = scope_id or "loadgen"
+        group_key = group_key or base64.b64encode(os.urandom(32)).decode("utf-8")
+    try:
+        fleet = IoTCFleet(
+            logger=ConsoleLogger(
+                IOTCLogLevel.IOTC_LOGGING_API_ONLY
+                if args.verbose
+                else IOTCLogLevel.IOTC_LOGGING_DISABLED
+            ),
+            max_concurrent_connects=args.max_concurrent_connects,
+            connect_interval=args.connect_interval,
+        )
+        for index in range(args.devices):
+            client = fleet.add_device(
+                "{}{}".format(args.prefix, index),
+                scope_id,
+                IOTCConnectType.IOTC_CONNECT_SYMM_KEY,
+                group_key,
+            )
+            if args.model_id:
+                client.set_model_id(args.model_id)
+            if hub is not None:
+                client.set_global_endpoint(hub.endpoint)
+                client.set_server_verification_cert(hub.ca_cert)
+            elif args.endpoint:
+                client.set_global_endpoint(args.endpoint)
+        generator = LoadGenerator(
+            fleet,
+            telemetry_rate=args.rate,
+            payload_size=args.payload_size,
+            property_rate=args.property_rate,
+            command_rate=args.command_rate,
+            desired_rate=args.desired_rate,
+            duration=args.duration,
+            hub=hub,
+            seed=args.seed,
+        )
+        return await generator.run()
+    finally:
+        if hub is not None:
+            hub.stop_background()
+
+
+def main(argv=None):
+    parser = _parser()
+    args = parser.parse_args(argv)
+    if not args.local and not (args.scope_id and args.group_key):
+        parser.error("--scope-id and --group-key are required without --local")
+    if args.command_rate and not args.local:
+        parser.error("--command-rate requires --local")
+    if args.desired_rate and not args.local:
+        parser.error("--desired-rate requires --local")
+    report = asyncio.run(_run(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_report(report))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,264 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+# metrics recorded by the device clients. name => (type, help)
+CLIENT_METRICS = {
+    "iotc_messages_sent_total": ("counter", "Telemetry messages sent"),
+    "iotc_bytes_sent_total": ("counter", "Telemetry payload bytes sent"),
+    "iotc_send_failures_total": ("counter", "Telemetry messages failed to send"),
+    "iotc_properties_sent_total": ("counter", "Reported properties patches sent"),
+    "iotc_property_acks_total": ("counter", "Desired properties acknowledged"),
+    "iotc_commands_received_total": ("counter", "Commands received"),
+    "iotc_enqueued_commands_received_total": (
+        "counter",
+        "Enqueued commands received",
+    ),
+    "iotc_connect_failures_total": ("counter", "Failed connection attempts"),
+    "iotc_reconnects_total": ("counter", "Reconnections after a disconnection"),
+    "iotc_dps_registrations_total": ("counter", "Provisioning service registrations"),
+    "iotc_send_latency_seconds": ("histogram", "Telemetry send latency"),
+    "iotc_connect_latency_seconds": ("histogram", "Time to connect, retries included"),
+    "iotc_dps_latency_seconds": ("histogram", "Provisioning service registration latency"),
+    "iotc_twin_fetch_latency_seconds": ("histogram", "Device twin fetch latency"),
+    "iotc_property_handler_seconds": ("histogram", "Properties handler duration"),
+    "iotc_command_handler_seconds": ("histogram", "Commands handler duration"),
+    "iotc_enqueued_command_handler_seconds": (
+        "histogram",
+        "Enqueued commands handler duration",
+    ),
+    "iotc_stream_events_dropped_total": (
+        "counter",
+        "Commands and properties rejected or dropped because their stream was full",
+    ),
+    "iotc_slow_handlers_total": (
+        "counter",
+        "Handler calls over the slow or blocking threshold",
+    ),
+}
+
+
+class Counter(object):
+    __slots__ = ("name", "help", "_value", "_lock")
+
+    def __init__(self, name, help="", lock=None):
+        self.name = name
+        self.help = help
+        self._value = 0
+        self._lock = lock if lock is not None else threading.Lock()
+
+    @property
+    def value(self):
+        return self._value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+
+class Histogram(object):
+    __slots__ = ("name", "help", "_buckets", "_counts", "_sum", "_lock")
+
+    def __init__(self, name, help="", buckets=DEFAULT_BUCKETS, lock=None):
+        self.name = name
+        self.help = help
+        # the default buckets are shared and counts are allocated on the first observation
+        self._buckets = buckets if buckets is DEFAULT_BUCKETS else tuple(sorted(buckets))
+        self._counts = None
+        self._sum = 0.0
+        self._lock = lock if lock is not None else threading.Lock()
+
+    @property
+    def buckets(self):
+        return self._buckets
+
+    @property
+    def count(self):
+        return sum(self._counts) if self._counts is not None else 0
+
+    def _add(self, index, count, value):
+        # callers hold the lock
+        if self._counts is None:
+            self._counts = [0] * (len(self._buckets) + 1)
+        self._counts[index] += count
+        self._sum += value
+
+    @property
+    def sum(self):
+        return self._sum
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._add(index, 1, value)
+
+    @contextmanager
+    def time(self):
+        """
+        Observe the duration of a block of code
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def cumulative_counts(self):
+        """
+        Observations less than or equal to each bucket upper bound, +Inf included
+        :rtype: list
+        """
+        if self._counts is None:
+            return [0] * (len(self._buckets) + 1)
+        counts = []
+        total = 0
+        for count in self._counts:
+            total += count
+            counts.append(total)
+        return counts
+
+
+class MetricsRegistry(object):
+    def __init__(self, definitions=CLIENT_METRICS):
+        """
+        Counters and latency histograms, exportable as Prometheus text or a dictionary snapshot
+        :param dict definitions: Metrics to create upfront by name, with their type and help. Default (client metrics)
+        """
+        self._metrics = {}
+        # one lock for all the metrics of the registry
+        self._lock = threading.Lock()
+        for name, (kind, help) in (definitions or {}).items():
+            if kind == "counter":
+                self.counter(name, help)
+            else:
+                self.histogram(name, help)
+
+    def counter(self, name, help=""):
+        """
+        Get or create a counter
+        :rtype: Counter
+        """
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics.setdefault(name, Counter(name, help, self._lock))
+        return metric
+
+    def histogram(self, name, help="", buckets=DEFAULT_BUCKETS):
+        """
+        Get or create a histogram
+        :rtype: Histogram
+        """
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics.setdefault(
+                name, Histogram(name, help, buckets, self._lock)
+            )
+        return metric
+
+    def inc(self, name, amount=1):
+        self._metrics[name].inc(amount)
+
+    def observe(self, name, value):
+        self._metrics[name].observe(value)
+
+    def snapshot(self):
+        """
+        Get the current value of all the metrics
+        :returns: Dictionary with counters values and histograms buckets, sum and count by name
+        :rtype: dict
+        """
+        counters = {}
+        histograms = {}
+        for name, metric in self._metrics.items():
+            if isinstance(metric, Counter):
+                counters[name] = metric.value
+            else:
+                histograms[name] = {
+                    "buckets": list(metric.buckets),
+                    "counts": metric.cumulative_counts(),
+                    "sum": metric.sum,
+                    "count": metric.count,
+                }
+        return {
+            "counters": counters,
+            "histograms": histograms,
+            "help": {name: metric.help for name, metric in self._metrics.items()},
+        }
+
+    @classmethod
+    def merge(cls, snapshots):
+        """
+        Sum snapshots of many registries, e.g. from all the clients of a fleet
+        :param list snapshots: Registry snapshots
+        :returns: Registry with the aggregated values
+        :rtype: MetricsRegistry
+        """
+        registry = cls(definitions=None)
+        for snapshot in snapshots:
+            helps = snapshot.get("help", {})
+            for name, value in snapshot["counters"].items():
+                registry.counter(name, helps.get(name, "")).inc(value)
+            for name, data in snapshot["histograms"].items():
+                histogram = registry.histogram(
+                    name, helps.get(name, ""), data["buckets"]
+                )
+                with histogram._lock:
+                    previous = 0
+                    for index, count in enumerate(data["counts"]):
+                        histogram._add(index, count - previous, 0.0)
+                        previous = count
+                    histogram._sum += data["sum"]
+        return registry
+
+    @classmethod
+    def aggregate(cls, registries):
+        """
+        Sum many registries
+        :param list registries: Registries
+        :returns: Registry with the aggregated values
+        :rtype: MetricsRegistry
+        """
+        return cls.merge([registry.snapshot() for registry in registries])
+
+    def to_prometheus(self):
+        """
+        Export the metrics in the Prometheus text exposition format
+        :rtype: str
+        """
+        lines = []
+        for name in sorted(self._metrics):
+            metric = self._metrics[name]
+            if metric.help:
+                lines.append("# HELP {} {}".format(name, metric.help))
+            if isinstance(metric, Counter):
+                lines.append("# TYPE {} counter".format(name))
+                lines.append("{} {}".format(name, metric.value))
+                continue
+            lines.append("# TYPE {} histogram".format(name))
+            counts = metric.cumulative_counts()
+            for bound, count in zip(metric.buckets, counts):
+                lines.append(
+                    '{}_bucket{{le="{}"}} {}'.format(name, bound, count)
+                )
+            lines.append('{}_bucket{{le="+Inf"}} {}'.format(name, counts[-1]))
+            lines.append("{}_sum {}".format(name, metric.sum))
+            lines.append("{}_count {}".format(name, counts[-1]))
+        return "\n".join(lines) + "\n"
+
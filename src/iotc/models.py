@@ -1,16 +1,41 @@
 import abc
+import time
+from collections import OrderedDict
 
 
 class GracefulExit(SystemExit):
     code = 1
 
 
+class IoTCConnectionError(Exception):
+    pass
+
+
 class CredentialsCache(object):
-    def __init__(self, hub_name, device_id, device_key=None, certificate=None):
+    __slots__ = (
+        "_hub_name",
+        "_device_id",
+        "_device_key",
+        "_certificate",
+        "_created_at",
+        "_last_verified",
+    )
+
+    def __init__(
+        self,
+        hub_name,
+        device_id,
+        device_key=None,
+        certificate=None,
+        created_at=None,
+        last_verified=None,
+    ):
         self._hub_name = hub_name
         self._device_id = device_id
         self._device_key = device_key
         self._certificate = certificate
+        self._created_at = created_at if created_at is not None else time.time()
+        self._last_verified = last_verified
 
     @property
     def hub_name(self):
@@ -28,6 +53,14 @@ class CredentialsCache(object):
     def certificate(self):
         return self._certificate
 
+    @property
+    def created_at(self):
+        return self._created_at
+
+    @property
+    def last_verified(self):
+        return self._last_verified
+
     @property
     def connection_string(self):
         if self._hub_name is None or self._device_id is None:
@@ -41,17 +74,136 @@ class CredentialsCache(object):
                 self._hub_name, self._device_id
             )
 
+    def mark_verified(self, timestamp=None):
+        """
+        Record a successful connection to the assigned hub
+        :param float timestamp: Verification time. Default (now)
+        """
+        self._last_verified = timestamp if timestamp is not None else time.time()
+
+    def is_expired(self, ttl, now=None):
+        """
+        Check if the hub assignment is too old to be trusted without asking the provisioning service
+        :param float ttl: Seconds since the last successful connection (or the registration) after which credentials expire. None to never expire
+        :rtype: bool
+        """
+        if ttl is None:
+            return False
+        if now is None:
+            now = time.time()
+        return now - max(self._created_at or 0, self._last_verified or 0) > ttl
+
     def todict(self):
         return {
             "device_id": self.device_id,
             "hub_name": self.hub_name,
             "connection_string": self.connection_string,
             "device_key": self.device_key,
+            # only file paths are stored, not the passphrase
+            "certificate": {
+                key: value
+                for key, value in self.certificate.items()
+                if key != "cert_phrase"
+            }
+            if self.certificate is not None
+            else None,
+            "created_at": self.created_at,
+            "last_verified": self.last_verified,
         }
 
     @classmethod
     def from_dict(classref, data: dict):
-        return CredentialsCache(data["hub_name"], data["device_id"], data["device_key"])
+        return CredentialsCache(
+            data["hub_name"],
+            data["device_id"],
+            data.get("device_key"),
+            certificate=data.get("certificate"),
+            # entries stored by previous versions have no timestamps. They expire as soon as a ttl is set
+            created_at=data.get("created_at", 0),
+            last_verified=data.get("last_verified"),
+        )
+
+
+class ProvisioningResult(object):
+    def __init__(self, device_id, credentials=None, duration=None, error=None):
+        self._device_id = device_id
+        self._credentials = credentials
+        self._duration = duration
+        self._error = error
+
+    @property
+    def device_id(self):
+        return self._device_id
+
+    @property
+    def credentials(self):
+        return self._credentials
+
+    @property
+    def duration(self):
+        return self._duration
+
+    @property
+    def error(self):
+        return self._error
+
+    @property
+    def succeeded(self):
+        return self._error is None and self._credentials is not None
+
+
+class SlowHandler(object):
+    def __init__(self, event, handler, duration, blocking_duration=None):
+        self._event = event
+        self._handler = handler
+        self._duration = duration
+        self._blocking_duration = blocking_duration
+
+    @property
+    def event(self):
+        return self._event
+
+    @property
+    def handler(self):
+        return self._handler
+
+    @property
+    def duration(self):
+        return self._duration
+
+    @property
+    def blocking_duration(self):
+        # longest run without yielding to the event loop. None for synchronous handlers
+        return self._blocking_duration
+
+    def __repr__(self):
+        return "SlowHandler(event={}, handler={}, duration={:.3f}, blocking_duration={})".format(
+            self._event, self._handler, self._duration, self._blocking_duration
+        )
+
+
+class LoopStall(object):
+    def __init__(self, lag, task=None, stack=None):
+        self._lag = lag
+        self._task = task
+        self._stack = stack
+
+    @property
+    def lag(self):
+        return self._lag
+
+    @property
+    def task(self):
+        # name of the task running while the loop was blocked. None if no snapshot was taken
+        return self._task
+
+    @property
+    def stack(self):
+        # formatted stack frames of the blocking code. None if no snapshot was taken
+        return self._stack
+
+    def __repr__(self):
+        return "LoopStall(lag={:.3f}, task={})".format(self._lag, self._task)
 
 
 class Storage(object):
@@ -65,16 +217,81 @@ class Storage(object):
     def retrieve(self):
         pass
 
+    def persist_enqueued_ids(self, message_ids):
+        pass
+
+    def retrieve_enqueued_ids(self):
+        return None
+
+
+class AsyncStorage(object):
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    async def persist(self, credentials):
+        pass
+
+    @abc.abstractmethod
+    async def retrieve(self):
+        pass
+
+    async def persist_enqueued_ids(self, message_ids):
+        pass
+
+    async def retrieve_enqueued_ids(self):
+        return None
+
+
+class EnqueuedCommandsCache(object):
+    def __init__(self, max_size=128, storage=None):
+        self._max_size = max_size
+        self._storage = storage
+        self._ids = OrderedDict()
+        if self._storage is not None and hasattr(
+            self._storage, "retrieve_enqueued_ids"
+        ):
+            for message_id in self._storage.retrieve_enqueued_ids() or []:
+                self._ids[message_id] = True
+            self._trim()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, message_id):
+        return message_id in self._ids
+
+    def _trim(self):
+        while len(self._ids) > self._max_size:
+            self._ids.popitem(last=False)
+
+    def add(self, message_id):
+        """
+        Record a message id
+        :returns: False if the id was already recorded, True otherwise
+        :rtype: bool
+        """
+        if message_id in self._ids:
+            self._ids.move_to_end(message_id)
+            return False
+        self._ids[message_id] = True
+        self._trim()
+        if self._storage is not None and hasattr(
+            self._storage, "persist_enqueued_ids"
+        ):
+            self._storage.persist_enqueued_ids(list(self._ids))
+        return True
+
 
 class Command(object):
+    # one instance per received command. reply and complete are assigned by the clients
+    __slots__ = ("_command_name", "_command_value", "_component_name", "reply", "complete")
+
     def __init__(self, command_name, command_value, component_name=None):
         self._command_name = command_name
         self._command_value = command_value
-        if component_name is not None:
-            self._component_name = component_name
-        else:
-            self._component_name = None
+        self._component_name = component_name
         self.reply = None
+        self.complete = None
 
     @property
     def name(self):
@@ -97,13 +314,14 @@ class Command(object):
 
 
 class Property(object):
+    # one instance per property of each desired patch. ack is assigned by the async client
+    __slots__ = ("_property_name", "_property_value", "_component_name", "ack")
+
     def __init__(self, property_name, property_value, component_name=None):
         self._property_name = property_name
         self._property_value = property_value
-        if component_name is not None:
-            self._component_name = component_name
-        else:
-            self._component_name = None
+        self._component_name = component_name
+        self.ack = None
 
     @property
     def name(self):
@@ -0,0 +1,201 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import math
+import sys
+import threading
+import time
+from urllib.parse import quote_plus
+
+API_VERSION = "2019-03-30"
+DEFAULT_TTL = 21600
+
+
+class SasToken(object):
+    def __init__(self, resource_uri, signature, expiry, policy_name=None):
+        self._resource_uri = resource_uri
+        self._signature = signature
+        self._expiry = expiry
+        self._policy_name = policy_name
+
+    @property
+    def resource_uri(self):
+        return self._resource_uri
+
+    @property
+    def expiry(self):
+        return self._expiry
+
+    def expires_in(self, now=None):
+        """
+        Seconds before the token expires
+        :rtype: float
+        """
+        if now is None:
+            now = time.time()
+        return self._expiry - now
+
+    def __str__(self):
+        token = "SharedAccessSignature sr={}&sig={}&se={}".format(
+            quote_plus(self._resource_uri), quote_plus(self._signature), self._expiry
+        )
+        if self._policy_name is not None:
+            token += "&skn={}".format(self._policy_name)
+        return token
+
+
+def _sign(key, payload):
+    try:
+        secret = base64.b64decode(key)
+    except ValueError:
+        raise ValueError("broken base64 key")
+    return base64.b64encode(
+        hmac.new(secret, msg=payload.encode("utf8"), digestmod=hashlib.sha256).digest()
+    ).decode("utf-8")
+
+
+def generate_sas_token(resource_uri, key, ttl=DEFAULT_TTL, policy_name=None, now=None):
+    """
+    Generate a shared access signature token
+    :param str resource_uri: Signed resource, e.g. '{hub}/devices/{device_id}'
+    :param str key: Base64 signing key
+    :param int ttl: Token lifetime in seconds. Default (21600)
+    :param str policy_name: Shared access policy name. Default (None)
+    :returns: The token. Use str() to get its value
+    :rtype: SasToken
+    :raises ValueError: If the key is not valid base64
+    """
+    if now is None:
+        now = time.time()
+    expiry = math.floor(now + ttl)
+    signature = _sign(key, "{}\n{}".format(quote_plus(resource_uri), expiry))
+    return SasToken(resource_uri, signature, expiry, policy_name)
+
+
+def generate_sas_credentials(hub_name, device_id, device_key, ttl=DEFAULT_TTL):
+    """
+    Generate MQTT credentials for a device connecting to IoT Hub
+    :param str hub_name: Assigned hub host name
+    :param str device_id: Device Id
+    :param str device_key: Base64 device key
+    :param int ttl: Token lifetime in seconds. Default (21600)
+    :returns: Username and password
+    :rtype: tuple
+    """
+    token = generate_sas_token(
+        "{}/devices/{}".format(hub_name, device_id), device_key, ttl
+    )
+    username = "{}/{}/?api-version={}".format(hub_name, device_id, API_VERSION)
+    return username, str(token)
+
+
+class SasTokenProvider(object):
+    def __init__(self, resource_uri, key, ttl=DEFAULT_TTL, renew_before=None):
+        """
+        Cache a SAS token and renew it before it expires
+        :param str resource_uri: Signed resource, e.g. '{hub}/devices/{device_id}'
+        :param str key: Base64 signing key
+        :param int ttl: Token lifetime in seconds. Default (21600)
+        :param float renew_before: Seconds before expiry when the token is renewed. Default (10% of ttl)
+        """
+        self._resource_uri = resource_uri
+        self._key = key
+        self._ttl = ttl
+        # renewals never happen more often than every half ttl
+        self._renew_before = min(
+            ttl * 0.1 if renew_before is None else renew_before, ttl / 2
+        )
+        self._token = None
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def get_token(self):
+        """
+        Get the cached token, renewing it if it is close to expiry
+        :rtype: SasToken
+        """
+        with self._lock:
+            if self._token is None or self._needs_renewal():
+                self._token = generate_sas_token(self._resource_uri, self._key, self._ttl)
+            return self._token
+
+    def _needs_renewal(self):
+        return self._token.expires_in() <= self._renew_before
+
+    def renew(self):
+        """
+        Generate a new token
+        :rtype: SasToken
+        """
+        with self._lock:
+            self._token = generate_sas_token(self._resource_uri, self._key, self._ttl)
+            return self._token
+
+    def seconds_until_renewal(self):
+        """
+        Seconds before the cached token should be renewed
+        :rtype: float
+        """
+        return max(self.get_token().expires_in() - self._renew_before, 0)
+
+    def start(self, callback, logger=None):
+        """
+        Renew the token in a background thread before it expires
+        :param function callback: Function called with each renewed token, e.g. to update the connection credentials
+        :param logger: Logger for callback errors. Default (console logger)
+        """
+        if logger is None:
+            from iotc import ConsoleLogger, IOTCLogLevel, _shared_logger
+
+            logger = _shared_logger(ConsoleLogger, IOTCLogLevel.IOTC_LOGGING_API_ONLY)
+        self.stop()
+
+        def run():
+            try:
+                callback(self.renew())
+            except Exception as e:
+                # a failing callback must not stop the renewals
+                logger.info("ERROR: SAS token renewal callback failed. {}".format(e))
+            with self._lock:
+                if self._timer is not timer:
+                    return
+            self.start(callback, logger)
+
+        timer = threading.Timer(self.seconds_until_renewal(), run)
+        timer.daemon = True
+        with self._lock:
+            self._timer = timer
+        timer.start()
+
+    def stop(self):
+        """
+        Stop background renewals
+        """
+        with self._lock:
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+
+    async def run(self, callback):
+        """
+        Renew the token before it expires until cancelled
+        :param callback: Coroutine function called with each renewed token
+        """
+        while True:
+            await asyncio.sleep(self.seconds_until_renewal())
+            await callback(self.renew())
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print("Usage: python -m iotc.sas <hub_name> <device_id> <device_key> [ttl]")
+        sys.exit(2)
+    username, password = generate_sas_credentials(
+        sys.argv[1],
+        sys.argv[2],
+        sys.argv[3],
+        int(sys.argv[4]) if len(sys.argv) > 4 else DEFAULT_TTL,
+    )
+    print("Username: {}".format(username))
+    print("Password: {}".format(password))
@@ -0,0 +1,225 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import weakref
+
+from .models import CredentialsCache, Storage
+
+
+class FileStorage(Storage):
+    def __init__(self, path):
+        """
+        Store the credentials of a single device in a JSON file. Files are replaced atomically so a crash never leaves a partial write.
+        :param str path: File path
+        """
+        self._path = path
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self._path, "r") as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, data):
+        directory = os.path.dirname(os.path.abspath(self._path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".iotc-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as fh:
+                json.dump(data, fh)
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp_path, self._path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        _fsync_directory(directory)
+
+    def _update(self, key, value):
+        with self._lock:
+            data = self._read()
+            data[key] = value
+            self._write(data)
+
+    def persist(self, credentials):
+        self._update("credentials", credentials.todict())
+
+    def retrieve(self):
+        with self._lock:
+            data = self._read().get("credentials")
+        if not data:
+            return None
+        return CredentialsCache.from_dict(data)
+
+    def persist_enqueued_ids(self, message_ids):
+        self._update("enqueued_ids", list(message_ids))
+
+    def retrieve_enqueued_ids(self):
+        with self._lock:
+            return self._read().get("enqueued_ids")
+
+
+def _fsync_directory(directory):
+    # the rename is only durable once the directory entry is on disk
+    if os.name != "posix":
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _commit(connection, pending):
+    rows = [
+        (
+            device_id,
+            json.dumps(values["credentials"]) if "credentials" in values else None,
+            json.dumps(values["enqueued_ids"]) if "enqueued_ids" in values else None,
+        )
+        for device_id, values in pending.items()
+    ]
+    with connection:
+        connection.executemany(
+            "INSERT INTO devices (device_id, credentials, enqueued_ids) VALUES (?, ?, ?) "
+            "ON CONFLICT(device_id) DO UPDATE SET "
+            "credentials = COALESCE(excluded.credentials, credentials), "
+            "enqueued_ids = COALESCE(excluded.enqueued_ids, enqueued_ids)",
+            rows,
+        )
+    pending.clear()
+
+
+def _close_database(connection, lock, pending):
+    # runs on close, when the storage is collected or at interpreter exit. must not reference the storage
+    with lock:
+        if pending:
+            _commit(connection, pending)
+        connection.close()
+
+
+class SQLiteStorage(object):
+    def __init__(self, path, batch_size=100, flush_interval=1.0):
+        """
+        Store the credentials of many devices in a SQLite database indexed by device Id.
+        The database runs in WAL mode and writes are committed in batches, after a delay and at interpreter exit.
+        :param str path: Database file path
+        :param int batch_size: Number of pending writes, across all devices, triggering a commit. Default (100)
+        :param float flush_interval: Seconds after the first pending write before committing it. None to commit only full batches. Default (1.0)
+        """
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pending_writes = 0
+        self._timer = None
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS devices ("
+                "device_id TEXT PRIMARY KEY, credentials TEXT, enqueued_ids TEXT)"
+            )
+            self._connection.commit()
+        self._finalizer = weakref.finalize(
+            self, _close_database, self._connection, self._lock, self._pending
+        )
+
+    def device(self, device_id):
+        """
+        Get the storage of a single device, to be passed to its client
+        :param str device_id: Device Id
+        :returns: Device storage
+        :rtype: Storage
+        """
+        return DeviceStorage(self, device_id)
+
+    def _get(self, device_id, column):
+        with self._lock:
+            pending = self._pending.get(device_id, {})
+            if column in pending:
+                return pending[column]
+            row = self._connection.execute(
+                "SELECT {} FROM devices WHERE device_id = ?".format(column),
+                (device_id,),
+            ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+    def _set(self, device_id, column, value):
+        with self._lock:
+            if not self._finalizer.alive:
+                raise ValueError("Write to a closed SQLiteStorage")
+            self._pending.setdefault(device_id, {})[column] = value
+            self._pending_writes += 1
+            if self._pending_writes >= self._batch_size:
+                self._flush()
+            elif self._timer is None and self._flush_interval is not None:
+                self._timer = threading.Timer(self._flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush(self):
+        _commit(self._connection, self._pending)
+        self._pending_writes = 0
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def flush(self):
+        """
+        Commit pending writes
+        """
+        with self._lock:
+            if self._pending and self._finalizer.alive:
+                self._flush()
+
+    def close(self):
+        """
+        Commit pending writes and close the database. Storages not closed are closed when collected or at interpreter exit.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        self._finalizer()
+
+    def device_ids(self):
+        """
+        Get the Ids of the stored devices
+        :rtype: list
+        """
+        self.flush()
+        with self._lock:
+            return [
+                row[0]
+                for row in self._connection.execute(
+                    "SELECT device_id FROM devices ORDER BY device_id"
+                )
+            ]
+
+
+class DeviceStorage(Storage):
+    def __init__(self, database, device_id):
+        self._database = database
+        self._device_id = device_id
+
+    def persist(self, credentials):
+        self._database._set(self._device_id, "credentials", credentials.todict())
+
+    def retrieve(self):
+        data = self._database._get(self._device_id, "credentials")
+        if data is None:
+            return None
+        return CredentialsCache.from_dict(data)
+
+    def persist_enqueued_ids(self, message_ids):
+        self._database._set(self._device_id, "enqueued_ids", list(message_ids))
+
+    def retrieve_enqueued_ids(self):
+        return self._database._get(self._device_id, "enqueued_ids")
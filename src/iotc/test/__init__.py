@@ -1,6 +1,57 @@
+import contextlib
+import itertools
+
+
 class dummy_storage:
     def retrieve(self):
         return {}
 
     def persist(self, credentials):
         return None
+
+
+class fake_span_context:
+    trace_flags = 1
+    is_valid = True
+
+    def __init__(self, trace_id, span_id):
+        self.trace_id = trace_id
+        self.span_id = span_id
+
+
+class fake_span:
+    def __init__(self, name, attributes, context):
+        self.name = name
+        self.attributes = attributes
+        self._context = context
+
+    def get_span_context(self):
+        return self._context
+
+
+class fake_tracer:
+    # records spans like an opentelemetry tracer with an in-memory exporter, without the sdk
+    def __init__(self):
+        self._ids = itertools.count(1)
+        self._current = []
+        self._finished = []
+
+    @contextlib.contextmanager
+    def start_as_current_span(self, name, attributes=None):
+        span_id = next(self._ids)
+        # child spans belong to the trace of the current span
+        trace_id = (
+            self._current[-1].get_span_context().trace_id
+            if self._current
+            else span_id << 64
+        )
+        span = fake_span(name, dict(attributes or {}), fake_span_context(trace_id, span_id))
+        self._current.append(span)
+        try:
+            yield span
+        finally:
+            self._current.pop()
+            self._finished.append(span)
+
+    def get_finished_spans(self):
+        return list(self._finished)
@@ -11,9 +11,13 @@ config.read(os.path.join(os.path.dirname(__file__), "../tests.ini"))
 if config["TESTS"].getboolean("Local"):
     sys.path.insert(0, "src")
 
-from iotc import IOTCConnectType, IOTCLogLevel, IOTCEvents
+from iotc import IOTCConnectType, IOTCConnectionState, IOTCLogLevel, IOTCEvents
 from iotc.aio import IoTCClient
-from iotc.test import dummy_storage
+from iotc.backoff import ExponentialBackoff
+from iotc.models import AsyncStorage, CredentialsCache, IoTCConnectionError
+from iotc.aio.storage import ExecutorStorage
+from iotc.test import dummy_storage, fake_tracer
+from azure.iot.device.exceptions import ConnectionFailedError
 
 
 @pytest.fixture()
@@ -54,15 +58,342 @@ async def test_connect_succeeds(iotc_client):
 @pytest.mark.asyncio
 async def test_dps_connect_failed(iotc_client):
     iotc_client._provisioning_client.register.return_value = None
-    with pytest.raises(SystemExit):
+    iotc_client.set_backoff_policy(ExponentialBackoff(0))
+    with pytest.raises(IoTCConnectionError):
         await iotc_client.connect()
+    assert (
+        iotc_client.connection_state()
+        == IOTCConnectionState.IOTC_CONNECTION_RETRY_EXPIRED
+    )
+    assert iotc_client._provisioning_client.register.call_count == 6
 
 
 @pytest.mark.asyncio
 async def test_connect_force_dps(mocker, iotc_client):
     iotc_client._storage = dummy_storage()
-    spy = mocker.spy(iotc_client, "connect")
+    spy = mocker.spy(iotc_client, "_provision")
+    sleep = mocker.patch("asyncio.sleep")
+    iotc_client.set_backoff_policy(ExponentialBackoff(1, jitter=False))
     await iotc_client.connect()
     await iotc_client.disconnect()
-    assert spy.call_count == 2
-    assert iotc_client.connect.mock_calls == [mocker.call(), mocker.call(True)]
+    assert spy.call_count == 1
+    # the fallback to dps waits like any other retry
+    sleep.assert_awaited_once_with(1)
+
+
+@pytest.mark.asyncio
+async def test_connect_backoff(mocker, iotc_client):
+    iotc_client._provisioning_client.register.side_effect = [
+        Exception("DPS unavailable"),
+        Exception("DPS unavailable"),
+        mocker.DEFAULT,
+    ]
+    sleep = mocker.patch("asyncio.sleep")
+    iotc_client.set_backoff_policy(ExponentialBackoff(1, jitter=False))
+    await iotc_client.connect()
+    assert sleep.mock_calls == [mocker.call(1), mocker.call(2)]
+    assert iotc_client.connection_state() == IOTCConnectionState.IOTC_CONNECTION_OK
+
+
+@pytest.mark.asyncio
+async def test_connection_state_change_reconnects(mocker, iotc_client):
+    state_stub = mocker.AsyncMock()
+    iotc_client.on(IOTCEvents.IOTC_CONNECTION_STATE, state_stub)
+    await iotc_client.connect()
+    assert iotc_client.connection_state() == IOTCConnectionState.IOTC_CONNECTION_OK
+    reconnect_spy = mocker.spy(iotc_client, "connect")
+    provision_spy = mocker.spy(iotc_client, "_provision")
+    iotc_client._device_client.connected = False
+    iotc_client._device_client.on_connection_state_change()
+    await asyncio.sleep(0)
+    await iotc_client._reconnect_task
+    reconnect_spy.assert_called_once_with()
+    # the device reconnects to the cached hub without provisioning again
+    provision_spy.assert_not_called()
+    assert state_stub.mock_calls == [
+        mocker.call(IOTCConnectionState.IOTC_CONNECTION_OK),
+        mocker.call(IOTCConnectionState.IOTC_CONNECTION_COMMUNICATION_ERROR),
+        mocker.call(IOTCConnectionState.IOTC_CONNECTION_OK),
+    ]
+
+
+class memory_storage:
+    def __init__(self, credentials=None):
+        self.credentials = credentials
+
+    def retrieve(self):
+        return self.credentials
+
+    def persist(self, credentials):
+        self.credentials = credentials
+
+
+@pytest.mark.asyncio
+async def test_connect_cached_credentials(mocker, iotc_client):
+    storage = memory_storage(CredentialsCache("hub_name", "device_id", "device_key"))
+    iotc_client._storage = storage
+    spy = mocker.spy(iotc_client, "_provision")
+    await iotc_client.connect()
+    spy.assert_not_called()
+    assert storage.credentials.last_verified is not None
+
+
+@pytest.mark.asyncio
+async def test_connect_expired_credentials(mocker, iotc_client):
+    storage = memory_storage(
+        CredentialsCache(
+            "hub_name", "device_id", "device_key", created_at=time.time() - 3600
+        )
+    )
+    iotc_client._storage = storage
+    iotc_client.set_credentials_ttl(60)
+    spy = mocker.spy(iotc_client, "_provision")
+    await iotc_client.connect()
+    assert spy.call_count == 1
+    assert storage.credentials.created_at > time.time() - 60
+
+
+@pytest.mark.asyncio
+async def test_connect_network_error_keeps_cached_hub(mocker, iotc_client):
+    storage = memory_storage(CredentialsCache("hub_name", "device_id", "device_key"))
+    iotc_client._storage = storage
+    iotc_client._device_client.connect.side_effect = [
+        ConnectionFailedError("unreachable"),
+        mocker.DEFAULT,
+    ]
+    mocker.patch("asyncio.sleep")
+    spy = mocker.spy(iotc_client, "_provision")
+    await iotc_client.connect()
+    spy.assert_not_called()
+    assert iotc_client._device_client.connect.await_count == 2
+
+
+class async_memory_storage(AsyncStorage):
+    def __init__(self, credentials=None):
+        self.credentials = credentials
+
+    async def retrieve(self):
+        return self.credentials
+
+    async def persist(self, credentials):
+        self.credentials = credentials
+
+
+class async_enqueued_storage(async_memory_storage):
+    def __init__(self, message_ids=None):
+        super().__init__(CredentialsCache("hub_name", "device_id", "device_key"))
+        self.message_ids = message_ids
+
+    async def persist_enqueued_ids(self, message_ids):
+        await asyncio.sleep(0)
+        self.message_ids = message_ids
+
+    async def retrieve_enqueued_ids(self):
+        return self.message_ids
+
+
+@pytest.mark.asyncio
+async def test_async_storage_enqueued_ids(iotc_client):
+    storage = async_enqueued_storage(["msg1"])
+    iotc_client._storage = storage
+    await iotc_client.connect()
+    loop = asyncio.get_running_loop()
+    # the SDK runs handlers on its own thread
+    duplicates = [
+        await loop.run_in_executor(None, iotc_client._is_duplicate_enqueued, message_id)
+        for message_id in ("msg1", "msg2")
+    ]
+    assert duplicates == [True, False]
+    for _ in range(5):
+        await asyncio.sleep(0)
+    assert storage.message_ids == ["msg1", "msg2"]
+
+
+@pytest.mark.asyncio
+async def test_connect_async_storage(mocker, iotc_client):
+    storage = async_memory_storage(
+        CredentialsCache("hub_name", "device_id", "device_key")
+    )
+    iotc_client._storage = storage
+    spy = mocker.spy(iotc_client, "_provision")
+    await iotc_client.connect()
+    spy.assert_not_called()
+    assert storage.credentials.last_verified is not None
+
+
+@pytest.mark.asyncio
+async def test_sync_storage_runs_in_executor(mocker, iotc_client):
+    storage = memory_storage()
+    iotc_client._storage = storage
+    run_in_executor = mocker.spy(asyncio.get_running_loop(), "run_in_executor")
+    await iotc_client.connect()
+    assert isinstance(iotc_client._async_storage(), ExecutorStorage)
+    assert run_in_executor.call_count == 2
+    assert storage.credentials.device_id == "device_id"
+
+
+@pytest.mark.asyncio
+async def test_listeners_set_before_connect(mocker, iotc_client):
+    DeviceClient = sys.modules["iotc.aio"].IoTHubDeviceClient
+    device_client = DeviceClient.create_from_connection_string.return_value
+    listeners = []
+
+    async def connect():
+        listeners.append(device_client.on_method_request_received)
+
+    device_client.connect.side_effect = connect
+    await iotc_client.connect()
+    assert listeners == [iotc_client._on_commands]
+    assert iotc_client.is_ready()
+
+
+@pytest.mark.asyncio
+async def test_background_twin_sync(mocker, iotc_client):
+    DeviceClient = sys.modules["iotc.aio"].IoTHubDeviceClient
+    device_client = DeviceClient.create_from_connection_string.return_value
+    release_twin = asyncio.Event()
+
+    async def get_twin():
+        await release_twin.wait()
+        return {"desired": {"$version": 1}, "reported": {}}
+
+    device_client.get_twin.side_effect = get_twin
+    ready_stub = mocker.AsyncMock()
+    iotc_client.on(IOTCEvents.IOTC_READY, ready_stub)
+    iotc_client.set_background_twin_sync(True)
+    await iotc_client.connect()
+    assert iotc_client.connection_state() == IOTCConnectionState.IOTC_CONNECTION_OK
+    assert not iotc_client.is_ready()
+    assert not await iotc_client.wait_until_ready(0.01)
+    release_twin.set()
+    assert await iotc_client.wait_until_ready(5)
+    ready_stub.assert_awaited_once_with()
+
+
+@pytest.mark.asyncio
+async def test_background_twin_sync_retries(mocker, iotc_client):
+    DeviceClient = sys.modules["iotc.aio"].IoTHubDeviceClient
+    device_client = DeviceClient.create_from_connection_string.return_value
+    device_client.get_twin.side_effect = [
+        Exception("twin unavailable"),
+        {"desired": {"$version": 1}, "reported": {}},
+    ]
+    sleep = mocker.patch("asyncio.sleep")
+    iotc_client.set_backoff_policy(ExponentialBackoff(1, jitter=False))
+    iotc_client.set_background_twin_sync(True)
+    await iotc_client.connect()
+    assert await iotc_client.wait_until_ready(5)
+    sleep.assert_awaited_once_with(1)
+
+
+@pytest.mark.asyncio
+async def test_background_twin_sync_failed(mocker, iotc_client):
+    DeviceClient = sys.modules["iotc.aio"].IoTHubDeviceClient
+    device_client = DeviceClient.create_from_connection_string.return_value
+    device_client.get_twin.side_effect = Exception("twin unavailable")
+    iotc_client.set_backoff_policy(ExponentialBackoff(0))
+    iotc_client.set_background_twin_sync(True)
+    await iotc_client.connect()
+    with pytest.raises(IoTCConnectionError):
+        await iotc_client.wait_until_ready(5)
+    assert not iotc_client.is_ready()
+    assert device_client.get_twin.await_count == 6
+
+
+@pytest.mark.asyncio
+async def test_twin_released_after_sync(mocker, iotc_client):
+    DeviceClient = sys.modules["iotc.aio"].IoTHubDeviceClient
+    device_client = DeviceClient.create_from_connection_string.return_value
+    device_client.get_twin.return_value = {
+        "desired": {"$version": 2, "prop1": {"value": 1}},
+        "reported": {},
+    }
+    await iotc_client.connect()
+    device_client.patch_twin_reported_properties.assert_awaited()
+    assert iotc_client._twin is None
+
+
+@pytest.mark.asyncio
+async def test_metrics(mocker, iotc_client):
+    await iotc_client.connect()
+    await iotc_client.send_telemetry({"temperature": 21})
+    iotc_client._device_client.send_message.side_effect = Exception("Send failed")
+    with pytest.raises(Exception):
+        await iotc_client.send_telemetry({"temperature": 21})
+    metrics = iotc_client.metrics().snapshot()
+    assert metrics["counters"]["iotc_messages_sent_total"] == 1
+    assert metrics["counters"]["iotc_bytes_sent_total"] == len('{"temperature": 21}')
+    assert metrics["counters"]["iotc_send_failures_total"] == 1
+    assert metrics["counters"]["iotc_dps_registrations_total"] == 1
+    assert metrics["histograms"]["iotc_send_latency_seconds"]["count"] == 1
+    assert metrics["histograms"]["iotc_dps_latency_seconds"]["count"] == 1
+    assert metrics["histograms"]["iotc_twin_fetch_latency_seconds"]["count"] == 1
+
+
+@pytest.mark.asyncio
+async def test_handler_profiling(mocker, iotc_client):
+    async def blocking_command(command):
+        time.sleep(0.05)
+
+    async def waiting_command(command):
+        await asyncio.sleep(0.05)
+
+    slow_stub = mocker.AsyncMock()
+    iotc_client.on(IOTCEvents.IOTC_SLOW_HANDLER, slow_stub)
+    iotc_client.set_handler_profiling(threshold=1.0, blocking_threshold=0.01)
+    await iotc_client.connect()
+    method_request = mocker.MagicMock()
+    method_request.name = "reboot"
+
+    iotc_client.on(IOTCEvents.IOTC_COMMAND, waiting_command)
+    await iotc_client._on_commands(method_request)
+    slow_stub.assert_not_awaited()
+
+    iotc_client.on(IOTCEvents.IOTC_COMMAND, blocking_command)
+    await iotc_client._on_commands(method_request)
+    slow_stub.assert_awaited_once()
+    slow_handler = slow_stub.call_args[0][0]
+    assert slow_handler.handler.endswith("blocking_command")
+    assert slow_handler.blocking_duration >= 0.05
+    metrics = iotc_client.metrics().snapshot()
+    assert metrics["histograms"]["iotc_command_handler_seconds"]["count"] == 2
+    assert metrics["counters"]["iotc_slow_handlers_total"] == 1
+
+
+@pytest.mark.asyncio
+async def test_handler_profiling_errors(mocker, iotc_client):
+    async def failing_command(command):
+        await asyncio.sleep(0)
+        raise ValueError("handler failed")
+
+    iotc_client.set_handler_profiling()
+    iotc_client.on(IOTCEvents.IOTC_COMMAND, failing_command)
+    await iotc_client.connect()
+    method_request = mocker.MagicMock()
+    method_request.name = "reboot"
+    with pytest.raises(ValueError):
+        await iotc_client._on_commands(method_request)
+    metrics = iotc_client.metrics().snapshot()
+    assert metrics["histograms"]["iotc_command_handler_seconds"]["count"] == 1
+
+
+@pytest.mark.asyncio
+async def test_tracing(mocker, iotc_client):
+    tracer = fake_tracer()
+    iotc_client.set_tracing(tracer=tracer)
+    await iotc_client.connect()
+    await iotc_client.send_telemetry({"temperature": 21})
+    await iotc_client.send_property({"firmware": "1.0"})
+    spans = {span.name: span for span in tracer.get_finished_spans()}
+    assert {
+        "iotc.dps.register",
+        "iotc.hub.connect",
+        "iotc.twin.get",
+        "iotc.telemetry.send",
+        "iotc.property.send",
+    } <= set(spans)
+    context = spans["iotc.telemetry.send"].get_span_context()
+    message = iotc_client._device_client.send_message.call_args[0][0]
+    assert message.custom_properties["traceparent"] == "00-{:032x}-{:016x}-{:02x}".format(
+        context.trace_id, context.span_id, int(context.trace_flags)
+    )
@@ -0,0 +1,236 @@
+import pytest
+import asyncio
+import configparser
+import os
+import shutil
+import socket
+import sys
+import time
+
+config = configparser.ConfigParser()
+config.read(os.path.join(os.path.dirname(__file__), "../tests.ini"))
+
+if config["TESTS"].getboolean("Local"):
+    sys.path.insert(0, "src")
+
+from iotc import IOTCConnectType, IOTCLogLevel, IOTCEvents
+from iotc.aio import IoTCClient, IoTCFleet, ConsoleLogger
+from iotc.emulator import LocalHub
+from iotc.emulator import mqtt
+from iotc.latency import LatencyTracker
+from iotc.loadgen import LoadGenerator
+
+DEVICE_KEY = "ZGV2aWNlX2tleQ=="
+
+
+def port_available(port):
+    with socket.socket() as sock:
+        # the hub server reuses addresses in TIME_WAIT as well
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind(("localhost", port))
+        except OSError:
+            return False
+    return True
+
+
+requires_hub = pytest.mark.skipif(
+    shutil.which("openssl") is None or not port_available(8883),
+    reason="openssl missing or port 8883 in use",
+)
+
+
+@pytest.fixture()
+def hub():
+    # the device SDK blocks its thread while enabling features, the hub runs on its own loop
+    hub = LocalHub()
+    hub.start_background()
+    yield hub
+    hub.stop_background()
+
+
+async def on_hub(hub, coro):
+    return await asyncio.wrap_future(hub.submit(coro))
+
+
+async def connect(hub, device_id="device1", **events):
+    client = IoTCClient(
+        device_id,
+        "scope_id",
+        IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
+        DEVICE_KEY,
+        logger=ConsoleLogger(IOTCLogLevel.IOTC_LOGGING_DISABLED),
+    )
+    client.set_global_endpoint(hub.endpoint)
+    client.set_server_verification_cert(hub.ca_cert)
+    for event, callback in events.items():
+        client.on(getattr(IOTCEvents, event), callback)
+    await asyncio.wait_for(client.connect(), 30)
+    return client
+
+
+def test_topic_matches():
+    assert mqtt.topic_matches("$iothub/methods/POST/#", "$iothub/methods/POST/reboot/?$rid=1")
+    assert mqtt.topic_matches("devices/+/messages/events/", "devices/d1/messages/events/")
+    assert not mqtt.topic_matches("devices/+/messages/events/", "devices/d1/messages/")
+    assert not mqtt.topic_matches("$iothub/twin/res/#", "$iothub/twin/PATCH/properties/desired/")
+
+
+@pytest.mark.asyncio
+async def test_read_packet():
+    reader = asyncio.StreamReader()
+    reader.feed_data(mqtt.publish("topic", "x" * 200, qos=1, packet_id=7))
+    packet_type, flags, body = await mqtt.read_packet(reader)
+    message = mqtt.parse_publish(flags, body)
+    assert packet_type == mqtt.PUBLISH
+    assert (message.topic, message.qos, message.packet_id) == ("topic", 1, 7)
+    assert message.payload == b"x" * 200
+
+
+@requires_hub
+@pytest.mark.asyncio
+async def test_telemetry_and_properties(hub):
+    client = await connect(hub)
+    try:
+        assert hub.devices() == ["device1"]
+        assert hub.connected_devices() == ["device1"]
+        await client.send_telemetry({"temperature": 21}, {"priority": "high"})
+        await client.send_property({"firmware": "1.0"})
+        message = hub.telemetry("device1")[0]
+        assert message.json() == {"temperature": 21}
+        assert message.properties["priority"] == "high"
+        assert hub.reported_properties("device1")["firmware"] == "1.0"
+    finally:
+        await client.disconnect()
+
+
+@requires_hub
+@pytest.mark.asyncio
+async def test_commands(hub):
+    commands = []
+
+    async def on_command(command):
+        commands.append(command.value)
+        await command.reply()
+
+    async def on_enqueued(command):
+        commands.append(command.name)
+
+    client = await connect(
+        hub, IOTC_COMMAND=on_command, IOTC_ENQUEUED_COMMAND=on_enqueued
+    )
+    try:
+        status, _ = await on_hub(
+            hub, hub.invoke_method("device1", "reboot", {"delay": 5}, timeout=10)
+        )
+        assert status == 200
+        await on_hub(
+            hub, hub.send_c2d("device1", "{}", {"method-name": "update"})
+        )
+        for _ in range(50):
+            if len(commands) == 2:
+                break
+            await asyncio.sleep(0.1)
+        assert commands == [{"delay": 5}, "update"]
+    finally:
+        await client.disconnect()
+
+
+@requires_hub
+@pytest.mark.asyncio
+async def test_desired_properties(hub):
+    async def on_properties(prop):
+        return True
+
+    client = await connect(hub, IOTC_PROPERTIES=on_properties)
+    try:
+        await on_hub(hub, hub.update_desired_properties("device1", {"rate": 5}))
+        for _ in range(50):
+            if "rate" in hub.reported_properties("device1"):
+                break
+            await asyncio.sleep(0.1)
+        assert hub.reported_properties("device1")["rate"]["value"] == 5
+        assert hub.reported_properties("device1")["rate"]["ac"] == 200
+    finally:
+        await client.disconnect()
+
+
+@requires_hub
+@pytest.mark.asyncio
+async def test_latency_and_throttling(hub):
+    client = await connect(hub)
+    try:
+        hub.set_faults(latency=0.3)
+        start = time.monotonic()
+        await client.send_telemetry({"temperature": 21})
+        assert time.monotonic() - start >= 0.3
+        hub.set_faults(latency=0, max_messages_per_second=2)
+        for _ in range(4):
+            await client.send_telemetry({"temperature": 21})
+        assert hub.stats["throttled"] > 0
+    finally:
+        await client.disconnect()
+
+
+@requires_hub
+@pytest.mark.asyncio
+async def test_latency_stamping(hub):
+    client = await connect(hub)
+    try:
+        client.set_latency_stamping()
+        for index in range(5):
+            await client.send_telemetry({"temperature": index})
+        tracker = LatencyTracker()
+        for message in hub.telemetry("device1"):
+            tracker.add_message(message)
+        report = tracker.report()
+        assert report["latency"]["count"] == 5
+        assert 0 <= report["latency"]["p50"] < 1
+        assert (report["gaps"], report["duplicates"], report["reordered"]) == (0, 0, 0)
+    finally:
+        await client.disconnect()
+
+
+@requires_hub
+@pytest.mark.asyncio
+async def test_drop_recovery(hub):
+    client = await connect(hub)
+    try:
+        hub.set_faults(drop_rate=1)
+        # the device SDK cancels messages in flight when the connection drops
+        with pytest.raises(Exception):
+            await client.send_telemetry({"temperature": 21})
+        hub.set_faults(drop_rate=0)
+        assert hub.stats["dropped"] >= 1
+        # the SDK and the client both reconnect, sends fail until the client connection settles
+        for _ in range(100):
+            try:
+                await client.send_telemetry({"temperature": 22})
+                break
+            except Exception:
+                await asyncio.sleep(0.1)
+        assert hub.telemetry("device1")[-1].json() == {"temperature": 22}
+    finally:
+        await client.disconnect()
+
+
+@requires_hub
+@pytest.mark.asyncio
+async def test_loadgen_desired_properties(hub):
+    fleet = IoTCFleet(logger=ConsoleLogger(IOTCLogLevel.IOTC_LOGGING_DISABLED))
+    for index in range(2):
+        client = fleet.add_device(
+            "device{}".format(index),
+            "scope_id",
+            IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
+            DEVICE_KEY,
+        )
+        client.set_global_endpoint(hub.endpoint)
+        client.set_server_verification_cert(hub.ca_cert)
+    report = await LoadGenerator(
+        fleet, telemetry_rate=0, desired_rate=5, duration=1, hub=hub, seed=1
+    ).run()
+    assert report["connected"] == 2
+    assert report["failures"]["desired"] == 0
+    assert report["latency"]["desired"]["count"] >= 8
+    assert hub.reported_properties("device0")["loadgenDesired"]["ac"] == 200
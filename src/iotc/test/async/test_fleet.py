@@ -0,0 +1,150 @@
+import pytest
+import asyncio
+import configparser
+import os
+import sys
+
+config = configparser.ConfigParser()
+config.read(os.path.join(os.path.dirname(__file__), "../tests.ini"))
+
+if config["TESTS"].getboolean("Local"):
+    sys.path.insert(0, "src")
+
+from iotc import IOTCConnectType, IOTCConnectionState, IOTCLogLevel
+from iotc.aio import IoTCFleet, ConsoleLogger
+from iotc.backoff import ExponentialBackoff
+
+
+@pytest.fixture()
+def sdk(mocker):
+    ProvisioningClient = mocker.patch("iotc.aio.ProvisioningDeviceClient")
+    DeviceClient = mocker.patch("iotc.aio.IoTHubDeviceClient")
+    ProvisioningClient.create_from_symmetric_key.return_value = mocker.AsyncMock()
+    DeviceClient.create_from_connection_string.side_effect = (
+        lambda *args, **kwargs: mocker.AsyncMock()
+    )
+    return ProvisioningClient
+
+
+def create_fleet(size, **kwargs):
+    fleet = IoTCFleet(
+        logger=ConsoleLogger(IOTCLogLevel.IOTC_LOGGING_DISABLED),
+        backoff=ExponentialBackoff(0),
+        **kwargs
+    )
+    for index in range(size):
+        fleet.add_device(
+            "device{}".format(index),
+            "scope_id",
+            IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
+            "device_key_base64",
+            max_connection_attempts=1,
+        )
+    return fleet
+
+
+@pytest.mark.asyncio
+async def test_fleet_connect(mocker, sdk):
+    fleet = create_fleet(3)
+    await fleet.connect()
+    assert len(fleet) == 3
+    assert fleet.connected_count() == 3
+    assert fleet.health()["device1"] == {
+        "state": IOTCConnectionState.IOTC_CONNECTION_OK,
+        "connected": True,
+        "reconnects": 0,
+        "last_error": None,
+    }
+    await fleet.disconnect()
+    assert all(client.terminated() for client in fleet)
+
+
+@pytest.mark.asyncio
+async def test_fleet_reports_failed_device(mocker, sdk):
+    fleet = create_fleet(2)
+    failing = fleet.get_client("device1")
+    mocker.patch.object(failing, "_provision", side_effect=Exception("DPS error"))
+    await fleet.connect()
+    health = fleet.health()
+    assert health["device0"]["state"] == IOTCConnectionState.IOTC_CONNECTION_OK
+    assert health["device1"]["state"] == IOTCConnectionState.IOTC_CONNECTION_RETRY_EXPIRED
+    assert health["device1"]["last_error"] == "DPS error"
+    await fleet.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_fleet_limits_concurrent_connects(mocker, sdk):
+    fleet = create_fleet(6, max_concurrent_connects=2)
+    connecting = 0
+    peak = 0
+
+    async def register():
+        nonlocal connecting, peak
+        connecting += 1
+        peak = max(peak, connecting)
+        await asyncio.sleep(0.01)
+        connecting -= 1
+        return mocker.MagicMock()
+
+    sdk.create_from_symmetric_key.return_value.register.side_effect = register
+    await fleet.connect()
+    assert fleet.connected_count() == 6
+    assert peak == 2
+    await fleet.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_fleet_derives_group_keys(mocker, sdk):
+    keys = sys.modules["iotc.keys"]
+    keys.clear_cache()
+    fleet = IoTCFleet(logger=ConsoleLogger(IOTCLogLevel.IOTC_LOGGING_DISABLED))
+    for index in range(3):
+        fleet.add_device(
+            "device{}".format(index),
+            "scope_id",
+            IOTCConnectType.IOTC_CONNECT_SYMM_KEY,
+            "r0mxLzPr9gg5DfsaxVhOwKK2+8jEHNclmCeb9iACAyb2A7yHPDrB2/+PTmwnTAetvI6oQkwarWHxYbkIVLybEg==",
+        )
+    await fleet.connect()
+    assert fleet.connected_count() == 3
+    # the group key is decoded once and clients use the keys derived in bulk
+    assert keys._decode.cache_info().misses == 1
+    assert len(keys._device_keys) == 3
+    await fleet.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_fleet_broken_group_key(mocker, sdk):
+    fleet = IoTCFleet(logger=ConsoleLogger(IOTCLogLevel.IOTC_LOGGING_DISABLED))
+    fleet.add_device(
+        "device0",
+        "scope_id",
+        IOTCConnectType.IOTC_CONNECT_SYMM_KEY,
+        "r0mxLzPr9gg5DfsaxVhOwKK2+8jEHNclmCeb9iACAyb2A7yHPDrB2/+PTmwnTAetvI6oQkwarWHxYbkIVLybEg==",
+    )
+    broken = fleet.add_device(
+        "device1", "scope_id", IOTCConnectType.IOTC_CONNECT_SYMM_KEY, "abc"
+    )
+    provision_spy = mocker.spy(broken, "_provision")
+    # the broken device fails without taking the fleet down
+    await fleet.connect()
+    health = fleet.health()
+    assert health["device0"]["state"] == IOTCConnectionState.IOTC_CONNECTION_OK
+    assert health["device1"]["state"] == IOTCConnectionState.IOTC_CONNECTION_RETRY_EXPIRED
+    assert "Broken base64 group key" in health["device1"]["last_error"]
+    # retrying can't fix the key
+    assert provision_spy.call_count == 1
+    await fleet.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_fleet_metrics(mocker, sdk):
+    fleet = create_fleet(3)
+    await fleet.connect()
+    for client in fleet:
+        await client.send_telemetry({"temperature": 21})
+    metrics = fleet.metrics().snapshot()
+    assert metrics["counters"]["iotc_messages_sent_total"] == 3
+    assert metrics["counters"]["iotc_dps_registrations_total"] == 3
+    assert metrics["histograms"]["iotc_connect_latency_seconds"]["count"] == 3
+    await fleet.disconnect()
@@ -148,3 +148,115 @@ async def test_on_enqueued_command_triggered_with_component(mocker, iotc_client)
     await iotc_client._device_client.on_message_received(COMPONENT_ENQUEUED)
     cmd_stub.assert_called_with(
         Command("command_name", "sample_data", "component"))
+
+
+@pytest.mark.asyncio
+async def test_on_command_reply_with_status_and_payload(mocker, iotc_client):
+    async def on_command(command):
+        await command.reply(202, {"progress": 0})
+
+    iotc_client.on(IOTCEvents.IOTC_COMMAND, on_command)
+    await iotc_client.connect()
+    await iotc_client._device_client.on_method_request_received(DEFAULT_COMMAND)
+    response = iotc_client._device_client.send_method_response.call_args[0][0]
+    assert response.request_id == DEFAULT_COMMAND.request_id
+    assert response.status == 202
+    assert response.payload == {"progress": 0}
+
+
+@pytest.mark.asyncio
+async def test_on_command_complete_reports_property(mocker, iotc_client):
+    async def on_command(command):
+        await command.reply(202)
+        await command.complete("done")
+
+    iotc_client.on(IOTCEvents.IOTC_COMMAND, on_command)
+    await iotc_client.connect()
+    await iotc_client._device_client.on_method_request_received(DEFAULT_COMMAND)
+    iotc_client._device_client.patch_twin_reported_properties.assert_called_with(
+        {"cmd1": {"value": "done"}}
+    )
+
+
+@pytest.mark.asyncio
+async def test_on_enqueued_command_duplicate_dropped(mocker, iotc_client):
+    cmd_stub = mocker.AsyncMock()
+    iotc_client.on(IOTCEvents.IOTC_ENQUEUED_COMMAND, cmd_stub)
+    await iotc_client.connect()
+    enqueued = Message("sample_data", message_id="msg1")
+    enqueued.custom_properties = {"method-name": "command_name"}
+    await iotc_client._device_client.on_message_received(enqueued)
+    await iotc_client._device_client.on_message_received(enqueued)
+    assert cmd_stub.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_commands_stream(mocker, iotc_client):
+    cmd_stub = mocker.AsyncMock()
+    iotc_client.on(IOTCEvents.IOTC_COMMAND, cmd_stub)
+    await iotc_client.connect()
+    commands = iotc_client.commands()
+    await iotc_client._device_client.on_method_request_received(DEFAULT_COMMAND)
+    assert commands.qsize() == 1
+    async for command in commands:
+        assert command == Command("cmd1", "sample", None)
+        break
+    cmd_stub.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_commands_stream_full(mocker, iotc_client):
+    await iotc_client.connect()
+    commands = iotc_client.commands(maxsize=1)
+    await iotc_client._device_client.on_method_request_received(DEFAULT_COMMAND)
+    # the SDK never awaits handlers, so a full stream answers instead of waiting
+    await iotc_client._device_client.on_method_request_received(COMPONENT_COMMAND)
+    assert commands.qsize() == commands.maxsize
+    assert commands.dropped() == 1
+    response = iotc_client._device_client.send_method_response.call_args[0][0]
+    assert response.status == 503
+    metrics = iotc_client.metrics().snapshot()
+    assert metrics["counters"]["iotc_stream_events_dropped_total"] == 1
+    assert (await commands.__anext__()) == Command("cmd1", "sample", None)
+
+
+@pytest.mark.asyncio
+async def test_property_updates_stream_full(mocker, iotc_client):
+    await iotc_client.connect()
+    properties = iotc_client.property_updates(maxsize=1)
+    debug = mocker.spy(iotc_client._logger, "debug")
+    await iotc_client._device_client.on_twin_desired_properties_patch_received(
+        {"prop1": "old", "$version": 1}
+    )
+    await iotc_client._device_client.on_twin_desired_properties_patch_received(
+        {"prop1": "new", "$version": 2}
+    )
+    # the oldest update is replaced by the newest one
+    assert properties.qsize() == 1
+    assert properties.dropped() == 1
+    assert (await properties.__anext__()) == Property("prop1", "new")
+    metrics = iotc_client.metrics().snapshot()
+    assert metrics["counters"]["iotc_stream_events_dropped_total"] == 1
+    # queued properties are acknowledged by the consumer, not reported as failed
+    assert not any("unsuccessfully" in str(call) for call in debug.call_args_list)
+
+
+@pytest.mark.asyncio
+async def test_property_updates_stream(mocker, iotc_client):
+    await iotc_client.connect()
+    properties = iotc_client.property_updates()
+    await iotc_client._device_client.on_twin_desired_properties_patch_received(COMPONENT_PROP)
+    iotc_client._device_client.patch_twin_reported_properties.assert_not_called()
+    prop = await properties.__anext__()
+    assert prop == Property("prop1", "value1", "component1")
+    await prop.ack()
+    iotc_client._device_client.patch_twin_reported_properties.assert_called_with(
+        {
+            "component1": {
+                "__t": "c",
+                "prop1": {"value": "value1", "ac": 200, "ad": "Completed", "av": 1},
+            }
+        }
+    )
+    properties.close()
+    assert [prop async for prop in properties] == []
@@ -0,0 +1,92 @@
+import pytest
+import configparser
+import json
+import os
+import sys
+
+config = configparser.ConfigParser()
+config.read(os.path.join(os.path.dirname(__file__), "../tests.ini"))
+
+if config["TESTS"].getboolean("Local"):
+    sys.path.insert(0, "src")
+
+from iotc import IOTCConnectType, IOTCLogLevel
+from iotc.aio import IoTCFleet, ConsoleLogger
+from iotc.backoff import ExponentialBackoff
+from iotc.loadgen import LoadGenerator, format_report, main, make_payload
+
+
+@pytest.fixture()
+def sdk(mocker):
+    ProvisioningClient = mocker.patch("iotc.aio.ProvisioningDeviceClient")
+    DeviceClient = mocker.patch("iotc.aio.IoTHubDeviceClient")
+    ProvisioningClient.create_from_symmetric_key.return_value = mocker.AsyncMock()
+    DeviceClient.create_from_connection_string.side_effect = (
+        lambda *args, **kwargs: mocker.AsyncMock()
+    )
+    return DeviceClient
+
+
+def create_fleet(size):
+    fleet = IoTCFleet(
+        logger=ConsoleLogger(IOTCLogLevel.IOTC_LOGGING_DISABLED),
+        backoff=ExponentialBackoff(0),
+    )
+    for index in range(size):
+        fleet.add_device(
+            "device{}".format(index),
+            "scope_id",
+            IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
+            "device_key_base64",
+        )
+    return fleet
+
+
+def test_payload_size():
+    assert len(json.dumps(make_payload(256))) == 256
+    assert len(json.dumps(make_payload(1024, 12345))) == 1024
+
+
+@pytest.mark.asyncio
+async def test_load(sdk):
+    fleet = create_fleet(3)
+    report = await LoadGenerator(
+        fleet, telemetry_rate=20, property_rate=10, payload_size=128, duration=0.5, seed=1
+    ).run()
+    assert report["connected"] == 3
+    # 10 messages per device in half a second, the first one can start late
+    assert 27 <= report["messages"] <= 30
+    assert report["latency"]["telemetry"]["count"] == report["messages"]
+    assert report["latency"]["property"]["count"] >= 12
+    assert report["failures"] == {"telemetry": 0, "property": 0, "command": 0, "desired": 0}
+    assert report["payload_bytes_per_second"] == pytest.approx(
+        report["messages"] * 128 / report["duration_seconds"]
+    )
+    assert "payload KB/s" in format_report(report)
+
+
+@pytest.mark.asyncio
+async def test_failures(mocker, sdk):
+    def failing_client(*args, **kwargs):
+        device_client = mocker.AsyncMock()
+        device_client.send_message.side_effect = Exception("dropped")
+        return device_client
+
+    sdk.create_from_connection_string.side_effect = failing_client
+    report = await LoadGenerator(create_fleet(1), telemetry_rate=20, duration=0.2).run()
+    assert report["messages"] == 0
+    assert report["failures"]["telemetry"] >= 3
+    assert report["latency"]["telemetry"]["p50"] is None
+
+
+def test_commands_require_local_hub():
+    with pytest.raises(ValueError):
+        LoadGenerator(create_fleet(1), command_rate=1)
+    with pytest.raises(ValueError):
+        LoadGenerator(create_fleet(1), desired_rate=1)
+    with pytest.raises(SystemExit):
+        main(["--command-rate", "1", "--scope-id", "scope", "--group-key", "key"])
+    with pytest.raises(SystemExit):
+        main(["--desired-rate", "1", "--scope-id", "scope", "--group-key", "key"])
+    with pytest.raises(SystemExit):
+        main(["--devices", "1"])
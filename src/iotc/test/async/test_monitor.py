@@ -0,0 +1,130 @@
+import pytest
+import asyncio
+import configparser
+import gc
+import os
+import sys
+import time
+
+config = configparser.ConfigParser()
+config.read(os.path.join(os.path.dirname(__file__), "../tests.ini"))
+
+if config["TESTS"].getboolean("Local"):
+    sys.path.insert(0, "src")
+
+from iotc import IOTCConnectType, IOTCEvents, IOTCLogLevel
+from iotc.aio import IoTCClient, IoTCFleet, ConsoleLogger
+from iotc.aio import monitor as monitor_module
+from iotc.aio.monitor import LoopMonitor, loop_monitor
+
+
+@pytest.fixture()
+def sdk(mocker):
+    ProvisioningClient = mocker.patch("iotc.aio.ProvisioningDeviceClient")
+    DeviceClient = mocker.patch("iotc.aio.IoTHubDeviceClient")
+    ProvisioningClient.create_from_symmetric_key.return_value = mocker.AsyncMock()
+    DeviceClient.create_from_connection_string.side_effect = (
+        lambda *args, **kwargs: mocker.AsyncMock()
+    )
+    return DeviceClient
+
+
+def create_client(device_id="device_id"):
+    client = IoTCClient(
+        device_id,
+        "scope_id",
+        IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
+        "device_key_base64",
+        logger=ConsoleLogger(IOTCLogLevel.IOTC_LOGGING_DISABLED),
+    )
+    client.set_loop_monitor(interval=0.02, threshold=0.1)
+    return client
+
+
+def block_loop(seconds):
+    time.sleep(seconds)
+
+
+@pytest.mark.asyncio
+async def test_loop_monitor():
+    stalls = []
+
+    async def on_stall(stall):
+        stalls.append(stall)
+
+    monitor = LoopMonitor(interval=0.02, threshold=0.1)
+    monitor.subscribe(on_stall)
+    assert monitor.running()
+    await asyncio.sleep(0.1)
+    block_loop(0.3)
+    await asyncio.sleep(0.1)
+    await monitor.unsubscribe(on_stall)
+    assert not monitor.running()
+
+    assert len(stalls) == 1
+    assert stalls[0].lag >= 0.2
+    assert stalls[0].task is not None
+    assert "block_loop" in "".join(stalls[0].stack)
+    metrics = monitor.metrics().snapshot()
+    assert metrics["counters"]["iotc_loop_stalls_total"] == 1
+    assert metrics["histograms"]["iotc_loop_lag_seconds"]["count"] >= 5
+
+
+@pytest.mark.asyncio
+async def test_client_loop_stall_event(mocker, sdk):
+    stall_stub = mocker.AsyncMock()
+    client = create_client()
+    client.on(IOTCEvents.IOTC_LOOP_STALL, stall_stub)
+    await client.connect()
+    monitor = client.loop_monitor()
+    assert monitor is loop_monitor()
+    await asyncio.sleep(0.05)
+    block_loop(0.3)
+    await asyncio.sleep(0.05)
+    await client.disconnect()
+    stall = stall_stub.await_args[0][0]
+    assert stall.lag >= 0.2
+    assert client.loop_monitor() is None
+    assert not monitor.running()
+
+
+@pytest.mark.asyncio
+async def test_loop_monitor_shared_by_fleet(sdk):
+    fleet = IoTCFleet(logger=ConsoleLogger(IOTCLogLevel.IOTC_LOGGING_DISABLED))
+    for index in range(3):
+        fleet.add_device(
+            "device{}".format(index),
+            "scope_id",
+            IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
+            "device_key_base64",
+        ).set_loop_monitor(interval=0.02, threshold=0.1)
+    await fleet.connect()
+    monitors = set(id(client.loop_monitor()) for client in fleet)
+    assert len(monitors) == 1
+    monitor = next(iter(fleet)).loop_monitor()
+    await asyncio.sleep(0.05)
+    block_loop(0.2)
+    await asyncio.sleep(0.05)
+    # the stall is counted once, not once per client
+    assert fleet.metrics().snapshot()["counters"]["iotc_loop_stalls_total"] == 1
+    await fleet.disconnect()
+    assert not monitor.running()
+
+
+def test_loop_monitors_released():
+    async def on_stall(stall):
+        pass
+
+    async def monitored(stop):
+        monitor = loop_monitor(interval=0.02, threshold=0.1)
+        monitor.subscribe(on_stall)
+        await asyncio.sleep(0.05)
+        if stop:
+            await monitor.unsubscribe(on_stall)
+        return monitor
+
+    # monitors still running when their loop shuts down are released too
+    monitors = [asyncio.run(monitored(stop)) for stop in (True, False, True)]
+    gc.collect()
+    assert len(monitor_module._MONITORS) == 0
+    assert not any(monitor.running() for monitor in monitors)
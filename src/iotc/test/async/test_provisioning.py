@@ -0,0 +1,115 @@
+import pytest
+import asyncio
+import configparser
+import os
+import sys
+
+config = configparser.ConfigParser()
+config.read(os.path.join(os.path.dirname(__file__), "../tests.ini"))
+
+if config["TESTS"].getboolean("Local"):
+    sys.path.insert(0, "src")
+
+from iotc import IOTCConnectType, IOTCLogLevel
+from iotc.aio import ConsoleLogger, provision_many
+from iotc.storage import SQLiteStorage
+
+GROUP_KEY = "r0mxLzPr9gg5DfsaxVhOwKK2+8jEHNclmCeb9iACAyb2A7yHPDrB2/+PTmwnTAetvI6oQkwarWHxYbkIVLybEg=="
+DEVICE_KEY = "XLXPHX5ND3KBL0BU9Y4C3ZIg4/oSSv3QlYZ0eBfbQtE="
+LOGGER = ConsoleLogger(IOTCLogLevel.IOTC_LOGGING_DISABLED)
+
+
+def create_devices(count, cred_type=IOTCConnectType.IOTC_CONNECT_DEVICE_KEY):
+    return [
+        {
+            "device_id": "device{}".format(index),
+            "scope_id": "scope_id",
+            "cred_type": cred_type,
+            "key_or_cert": "device_key_base64",
+        }
+        for index in range(count)
+    ]
+
+
+@pytest.fixture()
+def provisioning(mocker):
+    ProvisioningClient = mocker.patch("iotc.aio.ProvisioningDeviceClient")
+    ProvisioningClient.create_from_symmetric_key.return_value = mocker.AsyncMock()
+    register = ProvisioningClient.create_from_symmetric_key.return_value.register
+    register.return_value.registration_state.assigned_hub = "hub_name"
+    return ProvisioningClient
+
+
+@pytest.mark.asyncio
+async def test_provision_many(mocker, provisioning):
+    storage = mocker.MagicMock()
+    results = await provision_many(
+        create_devices(5), concurrency=2, storage=storage, logger=LOGGER
+    )
+    assert sorted(results) == ["device{}".format(index) for index in range(5)]
+    assert all(result.succeeded for result in results.values())
+    assert results["device3"].credentials.hub_name == "hub_name"
+    assert results["device3"].duration >= 0
+    assert storage.persist.call_count == 5
+
+
+@pytest.mark.asyncio
+async def test_provision_many_storage_factory(provisioning, tmp_path):
+    db = SQLiteStorage(str(tmp_path / "devices.db"))
+    results = await provision_many(
+        create_devices(3), storage_factory=db.device, logger=LOGGER
+    )
+    assert all(result.succeeded for result in results.values())
+    assert db.device_ids() == ["device0", "device1", "device2"]
+    for index in range(3):
+        credentials = db.device("device{}".format(index)).retrieve()
+        assert credentials.device_id == "device{}".format(index)
+        assert credentials.hub_name == "hub_name"
+    db.close()
+
+
+@pytest.mark.asyncio
+async def test_provision_many_concurrency(mocker, provisioning):
+    registering = 0
+    peak = 0
+
+    async def register():
+        nonlocal registering, peak
+        registering += 1
+        peak = max(peak, registering)
+        await asyncio.sleep(0.01)
+        registering -= 1
+        return mocker.MagicMock()
+
+    provisioning.create_from_symmetric_key.return_value.register.side_effect = register
+    await provision_many(create_devices(8), concurrency=3, logger=LOGGER)
+    assert peak == 3
+
+
+@pytest.mark.asyncio
+async def test_provision_many_group_key(mocker, provisioning):
+    devices = create_devices(3, IOTCConnectType.IOTC_CONNECT_SYMM_KEY)
+    for device in devices:
+        device["key_or_cert"] = GROUP_KEY
+    devices[0]["device_id"] = "pytest"
+    sys.modules["iotc.keys"].clear_cache()
+    decode = mocker.spy(sys.modules["iotc.keys"].base64, "b64decode")
+    results = await provision_many(devices, logger=LOGGER)
+    assert decode.call_count == 1
+    assert results["pytest"].credentials.device_key == DEVICE_KEY
+    provisioning.create_from_symmetric_key.assert_any_call(
+        "global.azure-devices-provisioning.net", "pytest", "scope_id", DEVICE_KEY
+    )
+
+
+@pytest.mark.asyncio
+async def test_provision_many_cache(mocker, provisioning):
+    register = provisioning.create_from_symmetric_key.return_value.register
+    register.side_effect = [Exception("DPS error"), mocker.DEFAULT]
+    results = await provision_many(create_devices(2), concurrency=1, logger=LOGGER)
+    assert results["device0"].error is not None
+    assert results["device1"].succeeded
+    register.side_effect = None
+    await provision_many(create_devices(2), cache=results, logger=LOGGER)
+    assert results["device0"].succeeded
+    assert register.call_count == 3
@@ -0,0 +1,130 @@
+import pytest
+import asyncio
+import configparser
+import os
+import queue
+import sys
+import threading
+
+config = configparser.ConfigParser()
+config.read(os.path.join(os.path.dirname(__file__), "../tests.ini"))
+
+if config["TESTS"].getboolean("Local"):
+    sys.path.insert(0, "src")
+
+from iotc import IOTCConnectType, IOTCLogLevel
+from iotc.aio import ConsoleLogger
+from iotc.aio.sharding import shard_devices, _run_worker
+
+DEVICES = [
+    {
+        "device_id": "device{}".format(index),
+        "scope_id": "scope_id",
+        "cred_type": IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
+        "key_or_cert": "device_key_base64",
+    }
+    for index in range(5)
+]
+
+
+def test_shard_devices():
+    shards = shard_devices(DEVICES, 2)
+    assert [len(shard) for shard in shards] == [3, 2]
+    assert sorted(device["device_id"] for shard in shards for device in shard) == [
+        device["device_id"] for device in DEVICES
+    ]
+    assert len(shard_devices(DEVICES[:1], 4)) == 1
+
+
+@pytest.mark.asyncio
+async def test_worker_reports_stats_and_stops(mocker):
+    ProvisioningClient = mocker.patch("iotc.aio.ProvisioningDeviceClient")
+    DeviceClient = mocker.patch("iotc.aio.IoTHubDeviceClient")
+    ProvisioningClient.create_from_symmetric_key.return_value = mocker.AsyncMock()
+    DeviceClient.create_from_connection_string.side_effect = (
+        lambda *args, **kwargs: mocker.AsyncMock()
+    )
+    setup = mocker.AsyncMock()
+    stop_event = threading.Event()
+    stats_queue = queue.Queue()
+    worker = asyncio.ensure_future(
+        _run_worker(
+            1,
+            DEVICES[:3],
+            setup,
+            {"logger": ConsoleLogger(IOTCLogLevel.IOTC_LOGGING_DISABLED)},
+            stop_event,
+            stats_queue,
+            0.01,
+        )
+    )
+    stats = await asyncio.get_running_loop().run_in_executor(None, stats_queue.get)
+    while stats["connected"] < 3:
+        stats = await asyncio.get_running_loop().run_in_executor(None, stats_queue.get)
+    assert stats["worker"] == 1
+    assert stats["devices"] == 3
+    assert stats["metrics"]["counters"]["iotc_dps_registrations_total"] == 3
+    assert setup.call_count == 3
+    stop_event.set()
+    await asyncio.wait_for(worker, 5)
+
+
+@pytest.fixture()
+def sdk(mocker):
+    ProvisioningClient = mocker.patch("iotc.aio.ProvisioningDeviceClient")
+    DeviceClient = mocker.patch("iotc.aio.IoTHubDeviceClient")
+    ProvisioningClient.create_from_symmetric_key.return_value = mocker.AsyncMock()
+    DeviceClient.create_from_connection_string.side_effect = (
+        lambda *args, **kwargs: mocker.AsyncMock()
+    )
+    return DeviceClient
+
+
+@pytest.mark.asyncio
+async def test_worker_logs_connect_failure(mocker, sdk):
+    logger = ConsoleLogger(IOTCLogLevel.IOTC_LOGGING_DISABLED)
+    info = mocker.spy(logger, "info")
+    mocker.patch(
+        "iotc.aio.sharding.IoTCFleet.connect", side_effect=ValueError("fleet error")
+    )
+    stop_event = threading.Event()
+    stats_queue = queue.Queue()
+    worker = asyncio.ensure_future(
+        _run_worker(1, DEVICES[:1], None, {"logger": logger}, stop_event, stats_queue, 0.01)
+    )
+    await asyncio.get_running_loop().run_in_executor(None, stats_queue.get)
+    stop_event.set()
+    await asyncio.wait_for(worker, 5)
+    assert any("fleet error" in str(call) for call in info.call_args_list)
+
+
+def test_worker_failure_does_not_block_shutdown(mocker, sdk):
+    mocker.patch(
+        "iotc.aio.sharding._fleet_stats",
+        side_effect=[RuntimeError("stats error"), {}],
+    )
+    errors = []
+
+    def run():
+        try:
+            asyncio.run(
+                _run_worker(
+                    1,
+                    DEVICES[:1],
+                    None,
+                    {"logger": ConsoleLogger(IOTCLogLevel.IOTC_LOGGING_DISABLED)},
+                    threading.Event(),
+                    queue.Queue(),
+                    0.01,
+                )
+            )
+        except RuntimeError as e:
+            errors.append(e)
+
+    # the launcher never sets the stop event, the worker must still exit
+    worker = threading.Thread(target=run)
+    worker.daemon = True
+    worker.start()
+    worker.join(5)
+    assert not worker.is_alive()
+    assert str(errors[0]) == "stats error"
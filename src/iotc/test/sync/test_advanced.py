@@ -2,6 +2,8 @@ import pytest
 import configparser
 import os
 import sys
+import threading
+import time
 
 config = configparser.ConfigParser()
 config.read(os.path.join(os.path.dirname(__file__), "../tests.ini"))
@@ -9,8 +11,17 @@ config.read(os.path.join(os.path.dirname(__file__), "../tests.ini"))
 if config["TESTS"].getboolean("Local"):
     sys.path.insert(0, "src")
 
-from iotc import IOTCConnectType, IOTCLogLevel, IOTCEvents, IoTCClient
+from iotc import (
+    IOTCConnectType,
+    IOTCConnectionState,
+    IOTCLogLevel,
+    IOTCEvents,
+    IoTCClient,
+)
+from iotc.backoff import ExponentialBackoff
+from iotc.models import CredentialsCache, IoTCConnectionError
 from iotc.test import dummy_storage
+from azure.iot.device.exceptions import ConnectionFailedError
 
 
 @pytest.fixture()
@@ -44,15 +55,330 @@ def test_connect_succeeds(iotc_client):
 
 def test_dps_connect_failed(iotc_client):
     iotc_client._provisioning_client.register.return_value = None
-    with pytest.raises(SystemExit):
+    iotc_client.set_backoff_policy(ExponentialBackoff(0))
+    with pytest.raises(IoTCConnectionError):
         iotc_client.connect()
+    assert (
+        iotc_client.connection_state()
+        == IOTCConnectionState.IOTC_CONNECTION_RETRY_EXPIRED
+    )
+    assert iotc_client._provisioning_client.register.call_count == 6
+
+
+
+def test_broken_group_key(mocker, iotc_client):
+    iotc_client._cred_type = IOTCConnectType.IOTC_CONNECT_SYMM_KEY
+    iotc_client._key_or_cert = "abc"
+    sleep = mocker.patch("time.sleep")
+    with pytest.raises(IoTCConnectionError) as error:
+        iotc_client.connect()
+    assert "Broken base64 group key" in str(error.value.__cause__)
+    # the key can't be fixed by retrying
+    sleep.assert_not_called()
+    iotc_client._provisioning_client.register.assert_not_called()
 
 
+def test_unsupported_logger():
+    with pytest.raises(ValueError):
+        IoTCClient(
+            "device_id",
+            "scope_id",
+            IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
+            "device_key_base64",
+            logger=object(),
+        )
+
 
 def test_connect_force_dps(mocker, iotc_client):
     iotc_client._storage = dummy_storage()
-    spy = mocker.spy(iotc_client, "connect")
+    spy = mocker.spy(iotc_client, "_provision")
+    sleep = mocker.patch("time.sleep")
+    iotc_client.set_backoff_policy(ExponentialBackoff(1, jitter=False))
     iotc_client.connect()
     iotc_client.disconnect()
-    assert spy.call_count == 2
-    assert iotc_client.connect.mock_calls == [mocker.call(), mocker.call(True)]
+    assert spy.call_count == 1
+    # the fallback to dps waits like any other retry
+    sleep.assert_called_once_with(1)
+
+
+def test_connect_backoff(mocker, iotc_client):
+    iotc_client._provisioning_client.register.side_effect = [
+        Exception("DPS unavailable"),
+        Exception("DPS unavailable"),
+        mocker.DEFAULT,
+    ]
+    sleep = mocker.patch("time.sleep")
+    iotc_client.set_backoff_policy(ExponentialBackoff(1, jitter=False))
+    iotc_client.connect()
+    assert sleep.mock_calls == [mocker.call(1), mocker.call(2)]
+    assert iotc_client.connection_state() == IOTCConnectionState.IOTC_CONNECTION_OK
+
+
+def test_connection_state_change_reconnects(mocker, iotc_client):
+    state_stub = mocker.MagicMock()
+    iotc_client.on(IOTCEvents.IOTC_CONNECTION_STATE, state_stub)
+    iotc_client.connect()
+    assert iotc_client.connection_state() == IOTCConnectionState.IOTC_CONNECTION_OK
+    reconnect_spy = mocker.spy(iotc_client, "connect")
+    provision_spy = mocker.spy(iotc_client, "_provision")
+    iotc_client._device_client.connected = False
+    iotc_client._device_client.on_connection_state_change()
+    for _ in range(50):
+        if state_stub.call_count == 3:
+            break
+        time.sleep(0.1)
+    reconnect_spy.assert_called_once_with()
+    # the device reconnects to the cached hub without provisioning again
+    provision_spy.assert_not_called()
+    assert state_stub.mock_calls == [
+        mocker.call(IOTCConnectionState.IOTC_CONNECTION_OK),
+        mocker.call(IOTCConnectionState.IOTC_CONNECTION_COMMUNICATION_ERROR),
+        mocker.call(IOTCConnectionState.IOTC_CONNECTION_OK),
+    ]
+
+
+def test_concurrent_disconnections_reconnect_once(mocker, iotc_client):
+    iotc_client.connect()
+    reconnect = mocker.patch.object(iotc_client, "_reconnect")
+
+    def is_connected():
+        # widen the window between the check and the reconnection start
+        time.sleep(0.05)
+        return False
+
+    mocker.patch.object(iotc_client, "is_connected", side_effect=is_connected)
+    barrier = threading.Barrier(2)
+
+    def on_disconnected():
+        barrier.wait()
+        iotc_client._on_connection_state_change()
+
+    # the SDK calls handlers from a thread pool
+    handlers = [threading.Thread(target=on_disconnected) for _ in range(2)]
+    for handler in handlers:
+        handler.start()
+    for handler in handlers:
+        handler.join(5)
+    time.sleep(0.1)
+    reconnect.assert_called_once_with()
+
+
+def test_backoff_delays():
+    backoff = ExponentialBackoff(1, max_delay=5, jitter=False)
+    assert [backoff.delay(attempt) for attempt in range(1, 6)] == [1, 2, 4, 5, 5]
+    assert backoff.delay(5000) == 5
+    jittered = ExponentialBackoff(1, max_delay=5)
+    assert all(0 <= jittered.delay(3) <= 4 for _ in range(100))
+
+
+class memory_storage:
+    def __init__(self, credentials=None):
+        self.credentials = credentials
+
+    def retrieve(self):
+        return self.credentials
+
+    def persist(self, credentials):
+        self.credentials = credentials
+
+
+def test_connect_cached_credentials(mocker, iotc_client):
+    storage = memory_storage(CredentialsCache("hub_name", "device_id", "device_key"))
+    iotc_client._storage = storage
+    spy = mocker.spy(iotc_client, "_provision")
+    iotc_client.connect()
+    spy.assert_not_called()
+    assert storage.credentials.last_verified is not None
+
+
+def test_connect_expired_credentials(mocker, iotc_client):
+    storage = memory_storage(
+        CredentialsCache(
+            "hub_name", "device_id", "device_key", created_at=time.time() - 3600
+        )
+    )
+    iotc_client._storage = storage
+    iotc_client.set_credentials_ttl(60)
+    spy = mocker.spy(iotc_client, "_provision")
+    iotc_client.connect()
+    assert spy.call_count == 1
+    assert storage.credentials.created_at > time.time() - 60
+
+
+def test_connect_network_error_keeps_cached_hub(mocker, iotc_client):
+    storage = memory_storage(CredentialsCache("hub_name", "device_id", "device_key"))
+    iotc_client._storage = storage
+    iotc_client._device_client.connect.side_effect = [
+        ConnectionFailedError("unreachable"),
+        mocker.DEFAULT,
+    ]
+    mocker.patch("time.sleep")
+    spy = mocker.spy(iotc_client, "_provision")
+    iotc_client.connect()
+    spy.assert_not_called()
+    assert iotc_client._device_client.connect.call_count == 2
+
+
+def test_credentials_cache_serialization():
+    credentials = CredentialsCache(
+        "hub_name",
+        "device_id",
+        certificate={
+            "cert_file": "device.pem",
+            "key_file": "device.key",
+            "cert_phrase": "secret",
+        },
+        created_at=10,
+    )
+    credentials.mark_verified(20)
+    restored = CredentialsCache.from_dict(credentials.todict())
+    # the passphrase is not persisted
+    assert restored.certificate == {"cert_file": "device.pem", "key_file": "device.key"}
+    assert restored.created_at == 10
+    assert restored.last_verified == 20
+    assert not restored.is_expired(None)
+    assert not restored.is_expired(15, now=30)
+    assert restored.is_expired(5, now=30)
+
+
+def test_listeners_set_before_connect(mocker, iotc_client):
+    DeviceClient = sys.modules["iotc"].IoTHubDeviceClient
+    device_client = DeviceClient.create_from_connection_string.return_value
+    listeners = []
+    device_client.connect.side_effect = lambda: listeners.append(
+        device_client.on_method_request_received
+    )
+    iotc_client.connect()
+    assert listeners == [iotc_client._on_commands]
+    assert iotc_client.is_ready()
+
+
+def test_background_twin_sync(mocker, iotc_client):
+    DeviceClient = sys.modules["iotc"].IoTHubDeviceClient
+    device_client = DeviceClient.create_from_connection_string.return_value
+    twin_requested = threading.Event()
+    release_twin = threading.Event()
+
+    def get_twin():
+        twin_requested.set()
+        release_twin.wait(5)
+        return {"desired": {"$version": 1}, "reported": {}}
+
+    device_client.get_twin.side_effect = get_twin
+    ready_stub = mocker.MagicMock()
+    iotc_client.on(IOTCEvents.IOTC_READY, ready_stub)
+    iotc_client.set_background_twin_sync(True)
+    iotc_client.connect()
+    assert iotc_client.connection_state() == IOTCConnectionState.IOTC_CONNECTION_OK
+    assert twin_requested.wait(5)
+    assert not iotc_client.is_ready()
+    assert not iotc_client.wait_until_ready(0.01)
+    release_twin.set()
+    assert iotc_client.wait_until_ready(5)
+    ready_stub.assert_called_once_with()
+
+
+def test_background_twin_sync_retries(mocker, iotc_client):
+    DeviceClient = sys.modules["iotc"].IoTHubDeviceClient
+    device_client = DeviceClient.create_from_connection_string.return_value
+    device_client.get_twin.side_effect = [
+        Exception("twin unavailable"),
+        {"desired": {"$version": 1}, "reported": {}},
+    ]
+    sleep = mocker.patch("time.sleep")
+    iotc_client.set_backoff_policy(ExponentialBackoff(1, jitter=False))
+    iotc_client.set_background_twin_sync(True)
+    iotc_client.connect()
+    assert iotc_client.wait_until_ready(5)
+    sleep.assert_called_once_with(1)
+
+
+def test_background_twin_sync_failed(mocker, iotc_client):
+    DeviceClient = sys.modules["iotc"].IoTHubDeviceClient
+    device_client = DeviceClient.create_from_connection_string.return_value
+    device_client.get_twin.side_effect = Exception("twin unavailable")
+    mocker.patch("time.sleep")
+    iotc_client.set_background_twin_sync(True)
+    iotc_client.connect()
+    with pytest.raises(IoTCConnectionError):
+        iotc_client.wait_until_ready(5)
+    assert not iotc_client.is_ready()
+    assert device_client.get_twin.call_count == 6
+
+
+def test_twin_released_after_sync(mocker, iotc_client):
+    DeviceClient = sys.modules["iotc"].IoTHubDeviceClient
+    device_client = DeviceClient.create_from_connection_string.return_value
+    device_client.get_twin.return_value = {
+        "desired": {"$version": 2, "prop1": {"value": 1}},
+        "reported": {},
+    }
+    iotc_client.connect()
+    device_client.patch_twin_reported_properties.assert_called()
+    assert iotc_client._twin is None
+
+
+def test_shared_default_logger(mocker):
+    first, second = [
+        IoTCClient(
+            device_id,
+            "scope_id",
+            IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
+            "device_key_base64",
+        )
+        for device_id in ("first", "second")
+    ]
+    assert first._logger is second._logger
+    first.set_log_level(IOTCLogLevel.IOTC_LOGGING_ALL)
+    assert first._logger._log_level == IOTCLogLevel.IOTC_LOGGING_ALL
+    assert second._logger._log_level == IOTCLogLevel.IOTC_LOGGING_API_ONLY
+    # defaults are shared until a setter is called
+    first.set_model_id("model")
+    assert (first._model_id, second._model_id) == ("model", None)
+
+
+def test_metrics(mocker, iotc_client):
+    iotc_client.connect()
+    iotc_client.send_telemetry({"temperature": 21})
+    iotc_client._device_client.send_message.side_effect = Exception("Send failed")
+    with pytest.raises(Exception):
+        iotc_client.send_telemetry({"temperature": 21})
+    metrics = iotc_client.metrics().snapshot()
+    assert metrics["counters"]["iotc_messages_sent_total"] == 1
+    assert metrics["counters"]["iotc_bytes_sent_total"] == len('{"temperature": 21}')
+    assert metrics["counters"]["iotc_send_failures_total"] == 1
+    assert metrics["counters"]["iotc_dps_registrations_total"] == 1
+    assert metrics["histograms"]["iotc_send_latency_seconds"]["count"] == 1
+    assert metrics["histograms"]["iotc_dps_latency_seconds"]["count"] == 1
+    assert metrics["histograms"]["iotc_twin_fetch_latency_seconds"]["count"] == 1
+
+
+def test_handler_profiling(mocker, iotc_client):
+    def on_command(command):
+        time.sleep(0.05)
+
+    slow_stub = mocker.MagicMock()
+    iotc_client.on(IOTCEvents.IOTC_COMMAND, on_command)
+    iotc_client.on(IOTCEvents.IOTC_PROPERTIES, lambda prop: True)
+    iotc_client.on(IOTCEvents.IOTC_SLOW_HANDLER, slow_stub)
+    iotc_client.connect()
+    method_request = mocker.MagicMock()
+    method_request.name = "reboot"
+    iotc_client._on_commands(method_request)
+    assert iotc_client.metrics().snapshot()["histograms"][
+        "iotc_command_handler_seconds"
+    ]["count"] == 0
+
+    iotc_client.set_handler_profiling(threshold=0.01)
+    iotc_client._on_commands(method_request)
+    iotc_client._on_properties({"fanSpeed": 10, "$version": 2})
+    slow_stub.assert_called_once()
+    slow_handler = slow_stub.call_args[0][0]
+    assert slow_handler.event == IOTCEvents.IOTC_COMMAND
+    assert slow_handler.handler.endswith("on_command")
+    assert slow_handler.duration >= 0.05
+    assert slow_handler.blocking_duration is None
+    metrics = iotc_client.metrics().snapshot()
+    assert metrics["histograms"]["iotc_command_handler_seconds"]["count"] == 1
+    assert metrics["histograms"]["iotc_property_handler_seconds"]["count"] == 1
+    assert metrics["counters"]["iotc_slow_handlers_total"] == 1
@@ -0,0 +1,33 @@
+import configparser
+import os
+import subprocess
+import sys
+
+config = configparser.ConfigParser()
+config.read(os.path.join(os.path.dirname(__file__), "../tests.ini"))
+
+if config["TESTS"].getboolean("Local"):
+    sys.path.insert(0, "src")
+
+import iotc
+
+
+def test_import_defers_sdk():
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            "-c",
+            "import sys; sys.path[:0] = {!r}; import iotc, iotc.aio; "
+            "print('azure.iot.device' in sys.modules)".format(sys.path),
+        ]
+    )
+    assert output.strip() == b"False"
+
+
+def test_lazy_sdk_attributes():
+    from azure.iot.device import IoTHubDeviceClient
+    from azure.iot.device.aio import IoTHubDeviceClient as AsyncIoTHubDeviceClient
+    import iotc.aio
+
+    assert iotc.IoTHubDeviceClient is IoTHubDeviceClient
+    assert iotc.aio.IoTHubDeviceClient is AsyncIoTHubDeviceClient
@@ -10,6 +10,7 @@ if config["TESTS"].getboolean("Local"):
     sys.path.insert(0, "src")
 
 from iotc import IOTCConnectType, IOTCLogLevel, IOTCEvents,IoTCClient
+from iotc import keys
 from iotc.test import dummy_storage
 
 def init_compute_key_tests(mocker, key_type, key, device_id):
@@ -63,4 +64,22 @@ def test_compute_device_key_failed(mocker):
         mocker, IOTCConnectType.IOTC_CONNECT_SYMM_KEY, group_key, device_id
     )
     spy.assert_called_once_with(group_key, device_id)
-    assert spy.spy_return != device_key
\ No newline at end of file
+    assert spy.spy_return != device_key
+
+def test_derived_keys_cached(mocker):
+    group_key = "r0mxLzPr9gg5DfsaxVhOwKK2+8jEHNclmCeb9iACAyb2A7yHPDrB2/+PTmwnTAetvI6oQkwarWHxYbkIVLybEg=="
+    device_key = "XLXPHX5ND3KBL0BU9Y4C3ZIg4/oSSv3QlYZ0eBfbQtE="
+    keys.clear_cache()
+    derive = mocker.spy(keys, "_derive")
+    assert keys.derive_device_keys(group_key, ["pytest", "other"])["pytest"] == device_key
+    assert keys.derive_device_key(group_key, "pytest") == device_key
+    assert keys.derive_device_keys(group_key, ["pytest", "other"])["pytest"] == device_key
+    assert derive.call_count == 2
+    keys.clear_cache()
+    assert keys.derive_device_key(group_key, "pytest") == device_key
+    assert derive.call_count == 3
+
+
+def test_derived_keys_broken_group_key():
+    with pytest.raises(ValueError):
+        keys.derive_device_key("not base64!", "pytest")
@@ -0,0 +1,111 @@
+import pytest
+import configparser
+import os
+import sys
+
+config = configparser.ConfigParser()
+config.read(os.path.join(os.path.dirname(__file__), "../tests.ini"))
+
+if config["TESTS"].getboolean("Local"):
+    sys.path.insert(0, "src")
+
+from iotc import IOTCConnectType, IOTCLogLevel, IoTCClient
+from iotc import latency
+from iotc.latency import LatencyTracker, percentiles
+
+
+@pytest.fixture()
+def iotc_client(mocker):
+    ProvisioningClient = mocker.patch("iotc.ProvisioningDeviceClient")
+    DeviceClient = mocker.patch("iotc.IoTHubDeviceClient")
+    ProvisioningClient.create_from_symmetric_key.return_value = mocker.MagicMock()
+    DeviceClient.create_from_connection_string.return_value = mocker.MagicMock()
+    client = IoTCClient(
+        "device_id",
+        "scope_id",
+        IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
+        "device_key_base64",
+    )
+    client.set_log_level(IOTCLogLevel.IOTC_LOGGING_DISABLED)
+    yield client
+    client.disconnect()
+
+
+def stamped(stream, sequence, timestamp):
+    properties = {}
+    latency.stamp(properties, stream, sequence, timestamp)
+    return properties
+
+
+def test_percentiles():
+    samples = list(range(1, 101))
+    assert percentiles(samples) == {50: 50, 90: 90, 99: 99}
+    assert percentiles([5]) == {50: 5, 90: 5, 99: 5}
+    assert percentiles([]) == {50: None, 90: None, 99: None}
+
+
+def test_stamping(iotc_client):
+    iotc_client.connect()
+    iotc_client.send_telemetry({"temperature": 21})
+    message = iotc_client._device_client.send_message.call_args[0][0]
+    assert latency.SEQUENCE not in message.custom_properties
+
+    iotc_client.set_latency_stamping()
+    for _ in range(3):
+        iotc_client.send_telemetry({"temperature": 21}, {"priority": "high"})
+    properties = [
+        call[0][0].custom_properties
+        for call in iotc_client._device_client.send_message.call_args_list[-3:]
+    ]
+    assert [p[latency.SEQUENCE] for p in properties] == ["0", "1", "2"]
+    assert len(set(p[latency.STREAM] for p in properties)) == 1
+    assert properties[0]["priority"] == "high"
+    assert float(properties[0][latency.TIMESTAMP]) > 0
+
+    # a new stream restarts the sequence
+    iotc_client.set_latency_stamping()
+    iotc_client.send_telemetry({"temperature": 21})
+    message = iotc_client._device_client.send_message.call_args[0][0]
+    assert message.custom_properties[latency.SEQUENCE] == "0"
+    assert message.custom_properties[latency.STREAM] != properties[0][latency.STREAM]
+
+
+def test_tracker():
+    tracker = LatencyTracker()
+    assert tracker.add("device1", stamped("a", 0, 100.0), 100.25) == 0.25
+    tracker.add("device1", stamped("a", 1, 100.0), 100.5)
+    # 2 and 3 lost
+    tracker.add("device1", stamped("a", 4, 100.0), 100.75)
+    # late 2 and redelivered 1
+    tracker.add("device1", stamped("a", 2, 100.0), 101.0)
+    assert tracker.add("device1", stamped("a", 1, 100.0), 101.0) is None
+    # same sequence numbers from another device or stream are not duplicates
+    tracker.add("device2", stamped("a", 0, 100.0), 100.25)
+    tracker.add("device1", stamped("b", 0, 100.0), 100.25)
+    assert tracker.add("device1", {"priority": "high"}, 100.0) is None
+
+    report = tracker.report()
+    assert report["messages"] == 8
+    assert report["devices"] == 2
+    assert report["unstamped"] == 1
+    assert report["gaps"] == 1
+    assert report["missing"] == 1
+    assert report["duplicates"] == 1
+    assert report["reordered"] == 1
+    assert report["latency"]["count"] == 6
+    assert report["latency"]["p50"] == pytest.approx(0.25)
+    assert report["latency"]["max"] == pytest.approx(1.0)
+    assert tracker.missing() == {("device1", "a"): [3]}
+
+    tracker.reset()
+    assert tracker.report()["messages"] == 0
+
+
+def test_tracker_event_hubs_properties():
+    # event hubs consumers get bytes keys and values
+    properties = {
+        key.encode("utf-8"): value.encode("utf-8")
+        for key, value in stamped("a", 0, 100.0).items()
+    }
+    tracker = LatencyTracker()
+    assert tracker.add(b"device1", properties, 100.5) == pytest.approx(0.5)
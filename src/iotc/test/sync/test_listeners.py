@@ -1,6 +1,6 @@
 from iotc import IOTCConnectType, IOTCLogLevel, IOTCEvents, IoTCClient
 from iotc.test import dummy_storage
-from iotc.models import Command, Property
+from iotc.models import Command, Property, EnqueuedCommandsCache
 from azure.iot.device import MethodRequest, Message
 import pytest
 import configparser
@@ -143,3 +143,63 @@ def test_on_enqueued_command_triggered_with_component(mocker, iotc_client):
     iotc_client._device_client.on_message_received(COMPONENT_ENQUEUED)
     cmd_stub.assert_called_with(
         Command("command_name", "sample_data", "component"))
+
+
+def test_on_command_reply_with_status_and_payload(mocker, iotc_client):
+    def on_command(command):
+        command.reply(202, {"progress": 0})
+
+    iotc_client.on(IOTCEvents.IOTC_COMMAND, on_command)
+    iotc_client.connect()
+    iotc_client._device_client.on_method_request_received(DEFAULT_COMMAND)
+    response = iotc_client._device_client.send_method_response.call_args[0][0]
+    assert response.request_id == DEFAULT_COMMAND.request_id
+    assert response.status == 202
+    assert response.payload == {"progress": 0}
+
+
+def test_on_command_complete_reports_property(mocker, iotc_client):
+    def on_command(command):
+        command.reply(202)
+        command.complete("done")
+
+    iotc_client.on(IOTCEvents.IOTC_COMMAND, on_command)
+    iotc_client.connect()
+    iotc_client._device_client.on_method_request_received(COMPONENT_COMMAND)
+    iotc_client._device_client.patch_twin_reported_properties.assert_called_with(
+        {"commandComponent": {"__t": "c", "cmd1": {"value": "done"}}}
+    )
+
+
+def test_on_enqueued_command_duplicate_dropped(mocker, iotc_client):
+    cmd_stub = mocker.MagicMock()
+    iotc_client.on(IOTCEvents.IOTC_ENQUEUED_COMMAND, cmd_stub)
+    iotc_client.connect()
+    enqueued = Message("sample_data", message_id="msg1")
+    enqueued.custom_properties = {"method-name": "command_name"}
+    iotc_client._device_client.on_message_received(enqueued)
+    iotc_client._device_client.on_message_received(enqueued)
+    assert cmd_stub.call_count == 1
+
+
+def test_enqueued_commands_cache_persisted(mocker):
+    storage = mocker.MagicMock()
+    storage.retrieve_enqueued_ids.return_value = ["msg1", "msg2"]
+    cache = EnqueuedCommandsCache(2, storage)
+    assert cache.add("msg1") is False
+    assert cache.add("msg3") is True
+    assert "msg2" not in cache
+    storage.persist_enqueued_ids.assert_called_with(["msg1", "msg3"])
+
+
+def test_models_are_slotted():
+    command = Command("cmd1", "sample", "component")
+    command.reply = lambda: None
+    prop = Property("prop1", {"value": "value1"})
+    prop.ack = lambda: None
+    for model in (command, prop):
+        assert not hasattr(model, "__dict__")
+        with pytest.raises(AttributeError):
+            model.extra = True
+    assert (command.name, command.value, command.component_name) == ("cmd1", "sample", "component")
+    assert prop.component_name is None
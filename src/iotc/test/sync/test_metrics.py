@@ -0,0 +1,70 @@
+import configparser
+import os
+import sys
+
+config = configparser.ConfigParser()
+config.read(os.path.join(os.path.dirname(__file__), "../tests.ini"))
+
+if config["TESTS"].getboolean("Local"):
+    sys.path.insert(0, "src")
+
+from iotc.metrics import MetricsRegistry
+
+
+def create_registry(sent, latencies):
+    registry = MetricsRegistry(definitions=None)
+    registry.counter("iotc_messages_sent_total", "Telemetry messages sent").inc(sent)
+    histogram = registry.histogram(
+        "iotc_send_latency_seconds", "Telemetry send latency", buckets=(0.1, 1.0)
+    )
+    for latency in latencies:
+        histogram.observe(latency)
+    return registry
+
+
+def test_histogram_buckets():
+    histogram = create_registry(0, [0.05, 0.1, 0.5, 2])._metrics[
+        "iotc_send_latency_seconds"
+    ]
+    assert histogram.cumulative_counts() == [2, 3, 4]
+    assert histogram.count == 4
+    assert histogram.sum == 2.65
+
+
+def test_histogram_without_observations():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("iotc_send_latency_seconds")
+    assert histogram.count == 0
+    assert histogram.cumulative_counts() == [0] * (len(histogram.buckets) + 1)
+    snapshot = MetricsRegistry.aggregate([registry, registry]).snapshot()
+    assert snapshot["histograms"]["iotc_send_latency_seconds"]["count"] == 0
+
+
+def test_aggregate():
+    registry = MetricsRegistry.aggregate(
+        [create_registry(1, [0.05]), create_registry(2, [0.5, 2])]
+    )
+    snapshot = registry.snapshot()
+    assert snapshot["counters"] == {"iotc_messages_sent_total": 3}
+    assert snapshot["histograms"]["iotc_send_latency_seconds"] == {
+        "buckets": [0.1, 1.0],
+        "counts": [1, 2, 3],
+        "sum": 2.55,
+        "count": 3,
+    }
+
+
+def test_prometheus_text():
+    text = create_registry(3, [0.05, 2]).to_prometheus()
+    assert text == (
+        "# HELP iotc_messages_sent_total Telemetry messages sent\n"
+        "# TYPE iotc_messages_sent_total counter\n"
+        "iotc_messages_sent_total 3\n"
+        "# HELP iotc_send_latency_seconds Telemetry send latency\n"
+        "# TYPE iotc_send_latency_seconds histogram\n"
+        'iotc_send_latency_seconds_bucket{le="0.1"} 1\n'
+        'iotc_send_latency_seconds_bucket{le="1.0"} 1\n'
+        'iotc_send_latency_seconds_bucket{le="+Inf"} 2\n'
+        "iotc_send_latency_seconds_sum 2.05\n"
+        "iotc_send_latency_seconds_count 2\n"
+    )
@@ -0,0 +1,85 @@
+import pytest
+import configparser
+import os
+import sys
+import threading
+import time
+
+config = configparser.ConfigParser()
+config.read(os.path.join(os.path.dirname(__file__), "../tests.ini"))
+
+if config["TESTS"].getboolean("Local"):
+    sys.path.insert(0, "src")
+
+from iotc.sas import SasTokenProvider, generate_sas_credentials, generate_sas_token
+
+DEVICE_KEY = "XLXPHX5ND3KBL0BU9Y4C3ZIg4/oSSv3QlYZ0eBfbQtE="
+
+
+def test_generate_sas_token():
+    token = generate_sas_token("hub/devices/pytest", DEVICE_KEY, ttl=60, now=1000)
+    assert token.expiry == 1060
+    assert str(token).startswith(
+        "SharedAccessSignature sr=hub%2Fdevices%2Fpytest&sig="
+    )
+    assert str(token).endswith("&se=1060")
+    assert str(token) == str(
+        generate_sas_token("hub/devices/pytest", DEVICE_KEY, ttl=60, now=1000)
+    )
+
+
+def test_generate_sas_credentials():
+    username, password = generate_sas_credentials("hub", "pytest", DEVICE_KEY)
+    assert username == "hub/pytest/?api-version=2019-03-30"
+    assert password.startswith("SharedAccessSignature sr=hub%2Fdevices%2Fpytest")
+
+
+def test_broken_key():
+    with pytest.raises(ValueError):
+        generate_sas_token("hub/devices/pytest", "broken", ttl=60)
+
+
+def test_provider_caches_token(mocker):
+    provider = SasTokenProvider("hub/devices/pytest", DEVICE_KEY, ttl=100)
+    token = provider.get_token()
+    assert provider.get_token() is token
+    assert 85 < provider.seconds_until_renewal() <= 90
+    # within the renewal margin a new token is generated
+    now = time.time()
+    mocker.patch("time.time", return_value=now + 95)
+    assert provider.get_token() is not token
+
+
+def test_provider_background_renewal():
+    provider = SasTokenProvider("hub/devices/pytest", DEVICE_KEY, ttl=4, renew_before=3)
+    renewed = threading.Event()
+    tokens = []
+
+    def on_renewal(token):
+        tokens.append(token)
+        renewed.set()
+
+    provider.start(on_renewal)
+    assert renewed.wait(4)
+    provider.stop()
+    assert tokens[0].expires_in() > 2
+
+
+def test_provider_renewal_survives_callback_error(mocker):
+    provider = SasTokenProvider("hub/devices/pytest", DEVICE_KEY, ttl=2, renew_before=1)
+    logger = mocker.MagicMock()
+    renewed = threading.Event()
+    tokens = []
+
+    def on_renewal(token):
+        tokens.append(token)
+        if len(tokens) == 1:
+            raise RuntimeError("update failed")
+        renewed.set()
+
+    provider.start(on_renewal, logger)
+    assert renewed.wait(4)
+    provider.stop()
+    assert len(tokens) == 2
+    logger.info.assert_called_once()
+    assert "update failed" in logger.info.call_args[0][0]
@@ -0,0 +1,145 @@
+import pytest
+import configparser
+import gc
+import os
+import pickle
+import sqlite3
+import subprocess
+import sys
+import time
+
+config = configparser.ConfigParser()
+config.read(os.path.join(os.path.dirname(__file__), "../tests.ini"))
+
+if config["TESTS"].getboolean("Local"):
+    sys.path.insert(0, "src")
+
+import iotc
+from iotc.models import CredentialsCache
+from iotc.storage import FileStorage, SQLiteStorage
+
+
+def test_file_storage(tmp_path):
+    path = str(tmp_path / "device.json")
+    storage = FileStorage(path)
+    assert storage.retrieve() is None
+    storage.persist(CredentialsCache("hub_name", "device_id", "device_key"))
+    storage.persist_enqueued_ids(["1", "2"])
+    restored = FileStorage(path)
+    assert restored.retrieve().connection_string == (
+        "HostName=hub_name;DeviceId=device_id;SharedAccessKey=device_key"
+    )
+    assert restored.retrieve_enqueued_ids() == ["1", "2"]
+    # no temporary files left behind
+    assert os.listdir(str(tmp_path)) == ["device.json"]
+
+
+def test_file_storage_fsyncs_directory(mocker, tmp_path):
+    fsync = mocker.spy(os, "fsync")
+    FileStorage(str(tmp_path / "device.json")).persist_enqueued_ids(["1"])
+    # the file, then the directory holding the renamed entry
+    assert fsync.call_count == (2 if os.name == "posix" else 1)
+
+
+def test_credentials_pickle():
+    # slotted credentials still cross process boundaries
+    credentials = CredentialsCache("hub_name", "device_id", "device_key", created_at=1)
+    restored = pickle.loads(pickle.dumps(credentials))
+    assert restored.todict() == credentials.todict()
+
+
+def test_file_storage_corrupted(tmp_path):
+    path = tmp_path / "device.json"
+    path.write_text("{")
+    assert FileStorage(str(path)).retrieve() is None
+
+
+def test_sqlite_storage(tmp_path):
+    path = str(tmp_path / "devices.db")
+    database = SQLiteStorage(path, batch_size=2)
+    first = database.device("first")
+    second = database.device("second")
+    first.persist(CredentialsCache("hub_name", "first", "first_key"))
+    # pending writes are visible before being committed
+    assert first.retrieve().device_key == "first_key"
+    assert second.retrieve() is None
+    second.persist(CredentialsCache("hub_name", "second", "second_key"))
+    second.persist_enqueued_ids(["1"])
+    database.close()
+
+    database = SQLiteStorage(path)
+    assert database.device_ids() == ["first", "second"]
+    assert database.device("first").retrieve().device_key == "first_key"
+    assert database.device("first").retrieve_enqueued_ids() is None
+    assert database.device("second").retrieve().device_key == "second_key"
+    assert database.device("second").retrieve_enqueued_ids() == ["1"]
+    journal_mode = database._connection.execute("PRAGMA journal_mode").fetchone()
+    assert journal_mode[0] == "wal"
+    database.close()
+
+
+def committed_device_ids(path):
+    connection = sqlite3.connect(path)
+    try:
+        return [row[0] for row in connection.execute("SELECT device_id FROM devices")]
+    finally:
+        connection.close()
+
+
+def test_sqlite_storage_batch(tmp_path):
+    path = str(tmp_path / "devices.db")
+    database = SQLiteStorage(path, batch_size=2, flush_interval=None)
+    device = database.device("device_id")
+    device.persist(CredentialsCache("hub_name", "device_id", "device_key"))
+    assert committed_device_ids(path) == []
+    # batches count writes, not devices
+    device.persist_enqueued_ids(["1"])
+    assert committed_device_ids(path) == ["device_id"]
+    database.close()
+
+
+def test_sqlite_storage_flush_interval(tmp_path):
+    path = str(tmp_path / "devices.db")
+    database = SQLiteStorage(path, flush_interval=0.05)
+    database.device("device_id").persist_enqueued_ids(["1"])
+    deadline = time.time() + 5
+    while not committed_device_ids(path) and time.time() < deadline:
+        time.sleep(0.05)
+    assert committed_device_ids(path) == ["device_id"]
+    database.close()
+
+
+def test_sqlite_storage_flush_at_exit(tmp_path):
+    path = str(tmp_path / "devices.db")
+    script = (
+        "from iotc.storage import SQLiteStorage\n"
+        "database = SQLiteStorage({!r}, flush_interval=None)\n"
+        "database.device('device_id').persist_enqueued_ids(['1'])\n"
+    ).format(path)
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(iotc.__file__)))
+    subprocess.check_call([sys.executable, "-c", script], env=env)
+    assert committed_device_ids(path) == ["device_id"]
+
+
+def test_sqlite_storage_closed(tmp_path):
+    database = SQLiteStorage(str(tmp_path / "devices.db"))
+    device = database.device("device_id")
+    database.close()
+    with pytest.raises(ValueError):
+        device.persist_enqueued_ids(["1"])
+    # closing again or flushing is harmless
+    database.close()
+    database.flush()
+
+
+def test_sqlite_storage_collected(tmp_path):
+    path = str(tmp_path / "devices.db")
+    database = SQLiteStorage(path, flush_interval=None)
+    database.device("device_id").persist_enqueued_ids(["1"])
+    connection = database._connection
+    del database
+    gc.collect()
+    # pending writes are committed and the connection released
+    assert committed_device_ids(path) == ["device_id"]
+    with pytest.raises(sqlite3.ProgrammingError):
+        connection.execute("SELECT 1")
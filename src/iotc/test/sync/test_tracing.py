@@ -0,0 +1,102 @@
+import pytest
+import configparser
+import os
+import sys
+
+config = configparser.ConfigParser()
+config.read(os.path.join(os.path.dirname(__file__), "../tests.ini"))
+
+if config["TESTS"].getboolean("Local"):
+    sys.path.insert(0, "src")
+
+from iotc import IOTCConnectType, IOTCEvents, IOTCLogLevel, IoTCClient
+from iotc import tracing
+from iotc.test import fake_tracer
+
+
+@pytest.fixture()
+def iotc_client(mocker):
+    ProvisioningClient = mocker.patch("iotc.ProvisioningDeviceClient")
+    DeviceClient = mocker.patch("iotc.IoTHubDeviceClient")
+    ProvisioningClient.create_from_symmetric_key.return_value = mocker.MagicMock()
+    DeviceClient.create_from_connection_string.return_value = mocker.MagicMock()
+    client = IoTCClient(
+        "device_id",
+        "scope_id",
+        IOTCConnectType.IOTC_CONNECT_DEVICE_KEY,
+        "device_key_base64",
+    )
+    client.set_log_level(IOTCLogLevel.IOTC_LOGGING_DISABLED)
+    yield client
+    client.disconnect()
+
+
+@pytest.fixture()
+def tracer():
+    return fake_tracer()
+
+
+def test_tracing_disabled(mocker, iotc_client):
+    iotc_client.connect()
+    iotc_client.send_telemetry({"temperature": 21})
+    message = iotc_client._device_client.send_message.call_args[0][0]
+    assert tracing.TRACEPARENT not in message.custom_properties
+
+
+def test_tracing_without_opentelemetry(mocker):
+    mocker.patch.dict(sys.modules, {"opentelemetry": None})
+    assert tracing.get_tracer() is None
+    with tracing.span(None, "iotc.telemetry.send") as span:
+        assert span is None
+    assert tracing.traceparent(None) is None
+
+
+def test_tracer_without_version(mocker):
+    # iotc running from sources has no installed version
+    trace = mocker.MagicMock()
+    mocker.patch.dict(sys.modules, {"opentelemetry": mocker.MagicMock(trace=trace)})
+    mocker.patch.dict(sys.modules["iotc"].__dict__)
+    sys.modules["iotc"].__dict__.pop("__version__", None)
+    mocker.patch("iotc._version", side_effect=AttributeError("__version__"))
+    assert tracing.get_tracer() is trace.get_tracer.return_value
+    trace.get_tracer.assert_called_once_with("iotc", None)
+
+
+def test_spans(mocker, iotc_client, tracer):
+    iotc_client.set_tracing(tracer=tracer)
+    iotc_client.on(IOTCEvents.IOTC_COMMAND, lambda command: None)
+    iotc_client.connect()
+    iotc_client.send_telemetry({"temperature": 21})
+    iotc_client.send_property({"firmware": "1.0"})
+    method_request = mocker.MagicMock()
+    method_request.name = "reboot"
+    iotc_client._on_commands(method_request)
+    spans = {span.name: span for span in tracer.get_finished_spans()}
+    assert set(spans) == {
+        "iotc.dps.register",
+        "iotc.hub.connect",
+        "iotc.twin.get",
+        "iotc.telemetry.send",
+        "iotc.property.send",
+        "iotc.command.handle",
+    }
+    assert spans["iotc.command.handle"].attributes["iotc.command.name"] == "reboot"
+    assert spans["iotc.telemetry.send"].attributes["iotc.device_id"] == "device_id"
+    context = spans["iotc.telemetry.send"].get_span_context()
+    message = iotc_client._device_client.send_message.call_args[0][0]
+    assert message.custom_properties[tracing.TRACEPARENT] == "00-{:032x}-{:016x}-{:02x}".format(
+        context.trace_id, context.span_id, int(context.trace_flags)
+    )
+
+
+def test_traceparent_from_caller(mocker, iotc_client, tracer):
+    iotc_client.set_tracing(tracer=tracer)
+    iotc_client.connect()
+    with tracer.start_as_current_span("sample") as parent:
+        iotc_client.send_telemetry({"temperature": 21})
+    message = iotc_client._device_client.send_message.call_args[0][0]
+    trace_id = message.custom_properties[tracing.TRACEPARENT].split("-")[1]
+    assert trace_id == "{:032x}".format(parent.get_span_context().trace_id)
+    iotc_client.send_telemetry({"temperature": 21}, {"traceparent": "custom"})
+    message = iotc_client._device_client.send_message.call_args[0][0]
+    assert message.custom_properties[tracing.TRACEPARENT] == "custom"
@@ -0,0 +1,54 @@
+import contextlib
+
+TRACEPARENT = "traceparent"
+
+_NO_SPAN = contextlib.nullcontext()
+
+
+def get_tracer(tracer=None):
+    """
+    Get the tracer used by the clients
+    :param tracer: OpenTelemetry tracer or any object with a compatible start_as_current_span. Default (tracer from the global tracer provider)
+    :returns: The tracer, or None if opentelemetry is not installed
+    """
+    if tracer is not None:
+        return tracer
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        return None
+    try:
+        from . import __version__ as version
+    except ImportError:
+        # running from sources, the package is not installed
+        version = None
+    return trace.get_tracer("iotc", version)
+
+
+def span(tracer, name, attributes=None):
+    """
+    Start a span as the current span
+    :param tracer: Tracer or None to disable tracing
+    :param str name: Span name
+    :param dict attributes: Span attributes. Default (None)
+    :returns: Context manager yielding the span, or None when tracing is disabled
+    """
+    if tracer is None:
+        return _NO_SPAN
+    return tracer.start_as_current_span(name, attributes=attributes)
+
+
+def traceparent(current_span):
+    """
+    Format the context of a span as a W3C traceparent header
+    :returns: Header value or None if the span is not recording a valid trace
+    :rtype: str
+    """
+    if current_span is None:
+        return None
+    context = current_span.get_span_context()
+    if not context.is_valid:
+        return None
+    return "00-{:032x}-{:016x}-{:02x}".format(
+        context.trace_id, context.span_id, int(context.trace_flags)
+    )